@@ -1,11 +1,13 @@
 __all__ = []
 # Enable native features
-from .protocol_support import protocol, call
-__all__.extend(['protocol','call'])
-from .experiment_support import experiment
-__all__.extend(['experiment'])
+from .protocol_support import protocol, call, call_many
+__all__.extend(['protocol','call','call_many'])
+from .experiment_support import experiment, sweep
+__all__.extend(['experiment','sweep'])
 from .data_bundles import Data_Bundle as Bundle, Void_Bundle
 __all__.extend(['Bundle','Void_Bundle'])
+from .streams import Stream
+__all__.extend(['Stream'])
 from .config import config
 __all__.extend(['config'])
 from .log import log
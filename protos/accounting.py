@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+import os
+import os.path
+import time
+import re
+import resource
+
+# Python context for measuring the resources used by a protocol.
+# The measurements are collected into a dictionary which is handed back when
+# the context is entered and filled in when it exits:
+#   wall_time : seconds elapsed
+#   cpu_time : user+system seconds used by this process
+#   child_cpu_time : user+system seconds used by finished subprocesses
+#                    (e.g.- anything run through protos.call)
+#   peak_rss : high-water mark of this process's resident set while the
+#              protocol ran, in bytes. The kernel only keeps one high-water
+#              mark per process, so this resets it when the context is entered
+#              (see reset_peak_rss). Where that isn't possible (anything but
+#              Linux 4.0 and later), peak_rss is left out: the high-water mark
+#              for the whole life of the process says nothing about a protocol.
+#   scratch_bytes : size of the files left in the scratch directory
+class resource_usage:
+  def __init__(self, directory=None):
+    self.directory = directory
+    self.usage = dict()
+  def __enter__(self):
+    self._wall = time.time()
+    self._self = resource.getrusage(resource.RUSAGE_SELF)
+    self._children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self._peak = reset_peak_rss()
+    return self.usage
+  def __exit__(self, type, value, traceback):
+    s = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self.usage['wall_time'] = time.time()-self._wall
+    self.usage['cpu_time'] = (s.ru_utime+s.ru_stime)-(self._self.ru_utime+self._self.ru_stime)
+    self.usage['child_cpu_time'] = (c.ru_utime+c.ru_stime)-(self._children.ru_utime+self._children.ru_stime)
+    if self._peak:
+      peak = peak_rss()
+      if peak is not None:
+        self.usage['peak_rss'] = peak
+    if self.directory is not None:
+      self.usage['scratch_bytes'] = directory_size(self.directory)
+    return False # Don't suppress errors
+
+def reset_peak_rss():
+  ''' Resets this process's resident set high-water mark, if the OS allows it. Returns whether it did. '''
+  try:
+    with open('/proc/self/clear_refs','w') as f:
+      f.write('5')
+    return True
+  except (IOError, OSError):
+    return False
+
+def peak_rss():
+  ''' This process's resident set high-water mark since it was last reset, in bytes, or None if it's unknown. '''
+  try:
+    with open('/proc/self/status') as f:
+      m = re.search(r'^VmHWM:\s+(\d+) kB', f.read(), re.MULTILINE)
+  except (IOError, OSError):
+    return None
+  if m is None:
+    return None
+  return int(m.group(1))*1024
+
+def directory_size(path):
+  total = 0
+  for (dpath,_,fnames) in os.walk(path):
+    for fname in fnames:
+      try:
+        total += os.lstat(os.path.join(dpath,fname)).st_size
+      except OSError:
+        pass # Removed out from under us. Not our problem.
+  return total
+
+def accumulate(totals, usage, name):
+  '''Rolls the usage of one protocol into a running total for an experiment.'''
+  for k in ['wall_time','cpu_time','child_cpu_time','scratch_bytes']:
+    totals[k] = totals.get(k,0)+usage.get(k,0)
+  totals['peak_rss'] = max(totals.get('peak_rss',0), usage.get('peak_rss',0))
+  # Wall time per protocol, to show where an experiment spends its time.
+  per_protocol = totals.setdefault('protocols',{})
+  per_protocol[name] = per_protocol.get(name,0)+usage.get('wall_time',0)
+  return totals
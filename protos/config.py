@@ -8,15 +8,33 @@ class config:
   experiments_dir = ''
   protocol_dir = ''
   data_dir = ''
+  scratch_dir = '/tmp' # where temporary directories are created (e.g.- a tmpfs)
+  spool_dir = '' # if set, protocols are run by workers watching this directory
 
   # Behavior
   reset = True
   preserve = False
+  jobs = 1 # number of protocols allowed to run concurrently
+  memoize = False # reuse bundles from earlier runs of unchanged protocols
+  deduplicate = False # run identical protocol invocations only once
+  memory_budget = 0 # megabytes of live bundle data kept in memory, the rest is spilled to disk (0 for no limit)
+  progress_interval = 5.0 # seconds between experiment metadata writes
+  progress_count = 100 # ...or protocols completed between writes, if sooner
+  cost_history = 10 # earlier runs of an experiment used to predict how long its protocols take
+  stream_buffer = 1000 # chunks a streaming protocol can get ahead of the slowest consumer reading it (0 for no limit)
+  stream_timeout = 3600.0 # seconds a protocol waits for the next chunk of a stream before giving up (0 to wait forever)
+  spool_lease = 60.0 # seconds a spool worker can go without checking in before its task is given to another
+  spool_timeout = 0 # seconds to wait for a protocol sent to spool workers before failing it (0 to wait forever)
 
   # Storage
   storage = 'fake' # mechanism name
   storage_server = '127.0.0.1' # if necessary
   storage_readonly = False # Disables all writes, but still allows querying
+  file_store = True # keep bundle files in a content-addressed store in data_dir
+  async_persist = False # write bundles from a background thread
+  persist_queue_size = 16 # bundles waiting to be written before protocols block
+  codec = 'json' # how bundles and metadata are encoded: 'json' or 'marshal'
+  compression = '' # ...and compressed: '', 'gzip' or 'lzma'
 
   # Parameters
   project_name = 'default'
@@ -0,0 +1,112 @@
+from __future__ import absolute_import
+import logging
+import json
+import hashlib
+import heapq
+import time
+
+from .data_bundles import Bundle_Token
+from .config import config
+
+# How long a protocol will take is predicted from how long it took before.
+# Every bundle records the resources its protocol used, along with a cost key:
+# a hash of the protocol's name and its arguments (constant arguments by value,
+# bundles just as bundles). Unlike a cache key, a cost key survives changes to
+# the protocol's source and to its inputs, since those rarely change how long
+# it takes. Past costs are read from the most recent earlier runs of the same
+# experiments (not the runs we're predicting for). Protocols that have never
+# been run are assumed to take as long as the average of those that have.
+DEFAULT_COST = 1.0 # seconds, if there's no history at all
+
+def cost_keys(schedule):
+  ''' A cost key for each entry of an experiment schedule. '''
+  def signature(arg):
+    if isinstance(arg, Bundle_Token):
+      return 'bundle'
+    return repr(arg)
+  keys = []
+  for (f,tok,a,kw) in schedule:
+    name = getattr(f, 'dotted_name', None) or str(f.__name__)
+    sig = [name, [signature(arg) for arg in a], sorted([(k,signature(v)) for (k,v) in kw.items()])]
+    keys.append(hashlib.sha1(json.dumps(sig)).hexdigest())
+  return keys
+
+class Cost_Model:
+  def __init__(self, storage, names, history=None, exclude=()):
+    if history is None:
+      history = config.cost_history
+    self._costs = {} # cost key -> wall times, most recent first
+    for xid in self._recent_experiments(storage, names, history, set([str(x) for x in exclude])):
+      for b in storage.find_bundle_metadata({}, xid):
+        md = b['metadata']
+        if 'cost_key' in md and 'wall_time' in md.get('resources',{}):
+          self._costs.setdefault(md['cost_key'],[]).append(md['resources']['wall_time'])
+
+  def _recent_experiments(self, storage, names, history, exclude):
+    xids = []
+    for name in names:
+      # Unfinished runs are still useful, but our own have nothing in them yet.
+      found = storage.find_recent_experiments({'metadata':{'name':name}}, history+len(exclude))
+      xids.extend([xid for xid in found if str(xid) not in exclude][0:history])
+    return xids
+
+  def predict(self, key):
+    ''' Predicted wall time of a protocol invocation, or None if it's never been run. '''
+    if key not in self._costs:
+      return None
+    costs = sorted(self._costs[key])
+    return costs[len(costs)//2] # median, so one bad run doesn't skew it
+
+  def predict_all(self, keys):
+    ''' Predicted wall time for every cost key, filling in guesses for unknown ones. '''
+    costs = [self.predict(k) for k in keys]
+    known = [c for c in costs if c is not None]
+    guess = DEFAULT_COST
+    if len(known)>0:
+      guess = sum(known)/len(known)
+    logging.debug('Cost history found for '+str(len(known))+' of '+str(len(keys))+' protocols')
+    return [guess if c is None else c for c in costs]
+
+def critical_paths(costs, deps):
+  ''' For each schedule entry, the cost of the longest chain of work from it to the end of the experiment. '''
+  paths = list(costs)
+  for i in xrange(len(costs)-1,-1,-1): # dependents come after what they depend on
+    for j in deps[i]:
+      paths[j] = max(paths[j], costs[j]+paths[i])
+  return paths
+
+# Keeps track of how much predicted work is left as protocols finish. Without
+# a cost history, the predictions are only guesses, so they are scaled by how
+# long the work finished so far actually took.
+class Schedule_Estimate:
+  def __init__(self, costs, paths, jobs=1, calibrate=False):
+    self._costs = costs
+    self._paths = paths
+    self._jobs = max(1,jobs)
+    self._calibrate = calibrate
+    self._started = time.time()
+    self._spent = 0.0 # predicted seconds of finished work
+    self._left = sum(costs)
+    self._finished = set([])
+    self._longest = [(-paths[i],i) for i in xrange(len(paths))] # heap of unfinished chains
+    heapq.heapify(self._longest)
+
+  def finish(self, sched):
+    if sched not in self._finished:
+      self._finished.add(sched)
+      self._left -= self._costs[sched]
+      self._spent += self._costs[sched]
+
+  def remaining(self):
+    ''' Predicted seconds until everything finishes. '''
+    while len(self._longest)>0 and self._longest[0][1] in self._finished:
+      heapq.heappop(self._longest)
+    path = 0.0
+    if len(self._longest)>0:
+      path = -self._longest[0][0]
+    # Can't finish before the longest chain does, or before all the work is
+    # spread across every job.
+    remaining = max(path, self._left/self._jobs)
+    if self._calibrate and self._spent>0:
+      remaining *= (time.time()-self._started)/self._spent
+    return remaining
@@ -9,6 +9,8 @@ from functools import reduce
 
 from .config import config
 from .time import timestamp
+from .fs_layout import place_file
+from .file_store import default_store, resolve
 
 # Experiment data is strictly a data packaging mechanism for transferring
 # information about the experiment in progress to the data bundles it uses.
@@ -16,11 +18,12 @@ from .time import timestamp
 # useful for error checking.
 # FIXME? This interface between Experiments and Bundles seems clunky.
 class Experiment_Data:
-  def __init__(self, bundle_tag, storage, storage_xid, xscratch):
+  def __init__(self, bundle_tag, storage, storage_xid, xscratch, pscratch=None):
     self.bundle_tag = bundle_tag
     self.storage = storage
     self.storage_xid = storage_xid
     self.xscratch = xscratch
+    self.pscratch = pscratch # the running protocol's scratch directory, if any
   @property
   def directory(self):
     '''
@@ -67,6 +70,8 @@ class Data_Bundle:
     self._storage = xdata.storage
     self._storage_xid = xdata.storage_xid
     self._xscratch = xdata.directory
+    self._pscratch = xdata.pscratch
+    self._file_refs = {} # file path -> file store reference
 
     # When protos creates a bundle from precomputed data, it uses all of the
     # fields from the old bundle, so there's no reason to initialize anything.
@@ -93,7 +98,15 @@ class Data_Bundle:
   def _internalize(self, json_dict):
     self.data = json_dict['data']
     self.metadata = json_dict['metadata']
-    self.files = json_dict['files']
+    # Files are stored as references into the file store. Resolving one is
+    # just a matter of working out its path; nothing is read or copied until a
+    # protocol actually opens it.
+    self.files = []
+    for name in json_dict['files']:
+      path = resolve(name)
+      if path!=name:
+        self._file_refs[path] = name
+      self.files.append(path)
     # We record our name in two places. This is the second one.
     self._name = self.metadata['bundle_type']
 
@@ -106,25 +119,63 @@ class Data_Bundle:
     s = dict()
     s['data'] = self.data
     s['metadata'] = self.metadata
-    s['files'] = self.files
+    s['files'] = self._file_references()
     return s
 
-  def _persist(self):
+  def _file_references(self):
+    # Moves our files into the file store (if there is one), and returns the
+    # references that replace their paths in the externalized bundle.
+    store = default_store()
+    if store is None:
+      return list(self.files)
+    refs = []
+    for name in self.files:
+      if name not in self._file_refs:
+        if not os.path.isfile(name):
+          logging.warning('Bundle file "'+name+'" no longer exists, so it cannot be stored')
+          refs.append(name)
+          continue
+        self._file_refs[name] = store.put(name, owned=self._owns(name))
+      refs.append(self._file_refs[name])
+    return refs
+
+  def _owns(self, name):
+    # Files in the experiment's scratch directory belong to protos, unless they
+    # are links to somebody else's (see add_file).
+    if self._xscratch is None:
+      return False
+    scratch = os.path.join(os.path.realpath(self._xscratch),'')
+    return os.path.realpath(name).startswith(scratch) and os.stat(name).st_nlink==1
+
+  def _persist(self, writer=None):
     ''' Persistently stores a copy of the bundle for archiving and/or reuse. '''
     if not config.storage_readonly:
-      self._storage.write_bundle( self._externalize(), self._storage_xid )
+      if writer is not None: # Let a background writer take care of it
+        writer.put( self._externalize(), self._storage_xid )
+      else:
+        self._storage.write_bundle( self._externalize(), self._storage_xid )
     return True
 
   ### User-facing ###
 
   def add_file(self, f, copy=False):
+    '''
+Adds a file to the bundle. With copy=True, the file is placed in the
+experiment directory first, so it outlives the protocol's scratch directory.
+Rather than actually copying, this hard links (or reflinks) the file where
+possible, so modifying the original afterwards may modify the bundle's copy.
+Files in the protocol's scratch directory may instead be moved.
+'''
     abs_f = os.path.abspath(f)
     assert os.path.isfile(abs_f), 'No file "'+str(abs_f)+'" to add to '+str(self)
     assert os.path.isdir(self._xscratch), 'Corrupted experiment state: experiment scratch directory "'+str(self._xscratch)+'" doesnt exist'
 
     if copy:
-      shutil.copy(abs_f, self._xscratch)
       name = os.path.join( self._xscratch, os.path.basename(abs_f) )
+      # The protocol's scratch directory is about to disappear anyway.
+      movable = self._pscratch is not None and os.path.realpath(abs_f).startswith(os.path.join(os.path.realpath(self._pscratch),''))
+      how = place_file(abs_f, name, movable=movable)
+      logging.debug('Added file '+name+' to '+str(self)+' ('+how+')')
     else:
       name = abs_f
 
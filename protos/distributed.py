@@ -0,0 +1,341 @@
+from __future__ import absolute_import
+import logging
+import os
+import os.path
+import sys
+import traceback
+import json
+import uuid
+import time
+import hashlib
+import threading
+
+from .config import config
+from .data_bundles import Experiment_Data, Bundle_Token
+from .fs_layout import scratch_directory
+from .experiment_support import _invoke, _protocol_source, _ship, _unship
+from .storage import mechanisms as storage_mechanisms
+
+# Protocols can be run by worker processes on other hosts, which share a
+# directory (the "spool") with the process running the experiment. The spool
+# holds a file per protocol invocation, which moves through three directories:
+#   tasks/ : written by the experiment once the protocol's inputs are ready
+#   claimed/ : moved here by whichever worker gets to it first
+#   results/ : the worker's answer: the protocol's bundle, or an error
+# Every file is written under a temporary name and renamed into place, and
+# renames are atomic, so nobody ever reads a partial file and no task is
+# claimed by two workers at once. Workers also need to load the same protocols
+# and reach the same datastore as the experiment, so the experiment publishes
+# its settings in config.json when it starts.
+# A claim is a lease: the worker touches its claim file every so often while
+# the protocol runs, and if it goes config.spool_lease seconds without doing
+# so, the experiment assumes the worker died and moves the task back to tasks/
+# for someone else. (The lease is measured against the experiment's clock, so
+# it should be generous.) A worker seals its claim before storing its bundle
+# and answering, which ends the lease: a task that was taken away can't be
+# sealed, so it's never stored twice, and a sealed one is never taken away.
+# If config.spool_timeout is set, a protocol with no result after that many
+# seconds fails instead of being waited on forever (including one whose worker
+# died after sealing it). Workers pick up new settings whenever an experiment
+# publishes them, and keep running until a "stop" file appears in the spool.
+POLL_INTERVAL = 0.1 # seconds
+
+# Settings a worker takes from the experiment, rather than its own config.
+SHARED_CONFIG = ['protocol_dir','data_dir','storage','storage_server','storage_readonly','file_store','codec','compression','project_name','spool_lease']
+
+class Spool:
+  def __init__(self, root):
+    self.root = os.path.abspath(root)
+    self._config_stamp = None # identifies the config.json we last adopted
+    for d in ['tasks','claimed','results']:
+      path = os.path.join(self.root, d)
+      if not os.path.isdir(path):
+        try:
+          os.makedirs(path)
+        except OSError: # Someone else just made it
+          pass
+
+  def _write(self, path, contents):
+    (head,tail) = os.path.split(path)
+    tmp = os.path.join(head, '.'+tail+'.'+uuid.uuid4().hex)
+    text = json.dumps(contents)
+    with open(tmp,'w') as f:
+      f.write(text)
+    os.rename(tmp, path)
+
+  def _read(self, path):
+    with open(path) as f:
+      return json.load(f)
+
+  def publish_config(self):
+    self._write(os.path.join(self.root,'config.json'), dict([(k,getattr(config,k)) for k in SHARED_CONFIG]))
+
+  def load_config(self):
+    ''' Waits for an experiment to publish its settings, then adopts them. Returns False if told to stop first. '''
+    path = os.path.join(self.root,'config.json')
+    while not os.path.isfile(path):
+      if self.stopping():
+        return False
+      time.sleep(POLL_INTERVAL)
+    # Noted first, so a config published while we read shows up as a change.
+    self._config_stamp = self._stamp(path)
+    for (k,v) in self._read(path).items():
+      setattr(config, k, v)
+    return True
+
+  def config_changed(self):
+    ''' True if an experiment has published settings since load_config last adopted them. '''
+    return self._stamp(os.path.join(self.root,'config.json'))!=self._config_stamp
+
+  def _stamp(self, path):
+    # config.json is replaced by renaming a new file into place, so its inode
+    # changes every time it's published.
+    try:
+      st = os.stat(path)
+      return (st.st_ino, st.st_mtime, st.st_size)
+    except OSError:
+      return None
+
+  def submit(self, task_id, task):
+    self._write(os.path.join(self.root,'tasks',task_id+'.json'), task)
+
+  def _claim_path(self, task_id, worker):
+    return os.path.join(self.root,'claimed',task_id+'@'+worker+'.json')
+
+  def claim(self, worker):
+    ''' Takes the oldest waiting task for the named worker, returning (task id, task), or None if there isn't one. '''
+    for name in sorted(os.listdir(os.path.join(self.root,'tasks'))):
+      if name.startswith('.'):
+        continue
+      task_id = name[:-len('.json')]
+      claimed = self._claim_path(task_id, worker)
+      try:
+        os.rename(os.path.join(self.root,'tasks',name), claimed)
+      except OSError: # Another worker beat us to it
+        continue
+      self.renew(task_id, worker) # the lease starts now, not when the task was written
+      return (task_id, self._read(claimed))
+    return None
+
+  def renew(self, task_id, worker):
+    ''' Extends a worker's lease on a task. Returns False if the task has been taken away from it. '''
+    try:
+      os.utime(self._claim_path(task_id, worker), None)
+      return True
+    except OSError:
+      return False
+
+  def _sealed_path(self, task_id, worker):
+    return os.path.join(self.root,'claimed',task_id+'@'+worker+'.sealed')
+
+  def seal(self, task_id, worker):
+    ''' Ends a worker's lease on a task it's about to finish, so the task can't be taken away from it any more. Returns False if it already has been. '''
+    try:
+      os.rename(self._claim_path(task_id, worker), self._sealed_path(task_id, worker))
+      return True
+    except OSError:
+      return False
+
+  def finish(self, task_id, worker, result):
+    ''' Answers a task sealed by the named worker. '''
+    self._write(os.path.join(self.root,'results',task_id+'.json'), result)
+    os.remove(self._sealed_path(task_id, worker))
+
+  def requeue(self, task_ids, lease):
+    ''' Moves any of the given tasks whose claims haven't been renewed for lease seconds back to tasks/. Returns their ids. '''
+    requeued = []
+    for name in os.listdir(os.path.join(self.root,'claimed')):
+      task_id = name.split('@')[0]
+      if name.startswith('.') or not name.endswith('.json') or task_id not in task_ids:
+        continue # (sealed claims can't be taken back)
+      path = os.path.join(self.root,'claimed',name)
+      try:
+        if time.time()-os.stat(path).st_mtime<lease:
+          continue
+        os.rename(path, os.path.join(self.root,'tasks',task_id+'.json'))
+      except OSError: # It just finished
+        continue
+      requeued.append(task_id)
+    return requeued
+
+  def withdraw(self, task_id):
+    ''' Removes a task nobody has claimed yet, so it isn't run. '''
+    try:
+      os.remove(os.path.join(self.root,'tasks',task_id+'.json'))
+    except OSError:
+      pass
+
+  def results(self, task_ids):
+    ''' Removes and returns the results which have arrived for any of the given tasks, as {task id: result}. '''
+    found = {}
+    for name in os.listdir(os.path.join(self.root,'results')):
+      task_id = name[:-len('.json')]
+      if not name.startswith('.') and task_id in task_ids:
+        path = os.path.join(self.root,'results',name)
+        found[task_id] = self._read(path)
+        os.remove(path)
+    return found
+
+  def stop(self):
+    open(os.path.join(self.root,'stop'),'w').close()
+
+  def stopping(self):
+    return os.path.isfile(os.path.join(self.root,'stop'))
+
+# The experiment's side of the spool. See Experiment._run_dataflow.
+class Spool_Executor:
+  def __init__(self, spool, experiment):
+    self.spool = spool
+    self.x = experiment
+    self._prefix = uuid.uuid4().hex # keeps our tasks apart from other experiments'
+    self._count = 0
+    self._pending = {} # task id -> schedule entry
+    self._submitted = {} # task id -> when it was submitted
+    self._arrived = [] # results collected but not yet handed back
+    self._next_check = 0 # when to look for abandoned tasks again
+    self._producers = dict([(p[1].id,p[0]) for p in experiment._schedule]) # token id -> protocol
+    if spool.stopping():
+      logging.warning('Workers on '+spool.root+' have been told to stop. Remove '+os.path.join(spool.root,'stop')+' before starting new ones.')
+    spool.publish_config()
+    print('Sending protocols to workers on '+spool.root)
+
+  def submit(self, sched, inputs):
+    (f,tok,a,kw) = self.x._schedule[sched]
+    assert f.dotted_name is not None, 'Protocol "'+str(f.__name__)+'" was not loaded from the protocol directory, so workers cannot run it'
+    def encode(arg):
+      if isinstance(arg, Bundle_Token):
+        # Workers look up a bundle's class where its producer is defined.
+        return {'bundle': _ship(inputs[arg.id], json.dumps), 'tag': arg.id, 'protocol': self._producers[arg.id].dotted_name}
+      return {'value': arg}
+    task = {
+      'protocol': f.dotted_name,
+      'source': hashlib.sha1(_protocol_source(f)).hexdigest(),
+      'xid': self.x._owners[sched].xid,
+      'tag': tok.id,
+      'cache_key': self.x._keys[sched],
+      'cost_key': self.x._cost_keys[sched],
+      'args': [encode(arg) for arg in a],
+      'kwargs': dict([(k,encode(v)) for (k,v) in kw.items()]),
+    }
+    # Tasks are claimed in name order, so number them in submission order.
+    task_id = '%08d-%s-%d' % (self._count, self._prefix, sched)
+    self._count += 1
+    try:
+      self.spool.submit(task_id, task)
+    except TypeError:
+      raise TypeError('Arguments to protocol "'+str(f.__name__)+'" must be JSON-serializable to run on a worker')
+    self._pending[task_id] = sched
+    self._submitted[task_id] = time.time()
+
+  def collect(self):
+    while len(self._arrived)==0:
+      found = self.spool.results(self._pending)
+      for (task_id,result) in found.items():
+        self.spool.withdraw(task_id) # in case it was requeued in the meantime
+        del self._submitted[task_id]
+        self._arrived.append( (self._pending.pop(task_id), result['bundle'], result['error']) )
+      if len(found)==0:
+        self._check_workers()
+        if len(self._arrived)==0:
+          time.sleep(POLL_INTERVAL)
+    return self._arrived.pop(0)
+
+  def _check_workers(self):
+    # Takes tasks back from workers which have stopped renewing their claims,
+    # and gives up on tasks which have been out too long.
+    now = time.time()
+    if now>=self._next_check:
+      self._next_check = now+config.spool_lease/4.
+      for task_id in self.spool.requeue(self._pending, config.spool_lease):
+        f = self.x._schedule[self._pending[task_id]][0]
+        logging.warning('The worker running protocol "'+str(f.__name__)+'" stopped responding. Giving it to another worker.')
+    if config.spool_timeout>0:
+      for (task_id,t) in sorted(self._submitted.items()):
+        if now-t>config.spool_timeout:
+          self.spool.withdraw(task_id)
+          del self._submitted[task_id]
+          self._arrived.append( (self._pending.pop(task_id), None, 'No result from a worker after '+str(config.spool_timeout)+' seconds') )
+
+def run_worker(spool, protocols, load_protocols=None):
+  '''
+Runs tasks from a spool until it is stopped. protocols is a dictionary of
+dotted protocol names to protocols, as loaded from the experiment's protocol
+directory. If an experiment publishes a different protocol directory, the
+protocols are reloaded with load_protocols(protocol_dir), if it's given.
+'''
+  storage = storage_mechanisms[config.storage]()
+  worker = uuid.uuid4().hex
+  with scratch_directory() as xscratch:
+    while not spool.stopping():
+      if spool.config_changed():
+        protocol_dir = config.protocol_dir
+        spool.load_config()
+        logging.info('Adopted new settings from '+spool.root)
+        storage = storage_mechanisms[config.storage]()
+        if load_protocols is not None and config.protocol_dir!=protocol_dir:
+          protocols = load_protocols(config.protocol_dir)
+      claimed = spool.claim(worker)
+      if claimed is None:
+        time.sleep(POLL_INTERVAL)
+        continue
+      (task_id,task) = claimed
+      logging.debug('Running task '+task_id)
+      with Lease(spool, task_id, worker):
+        (bundle,result) = _run_task(task, protocols, storage, xscratch)
+      if not spool.seal(task_id, worker):
+        # Another worker has it now, and will store its own bundle.
+        logging.warning('Task '+task_id+' was given to another worker before this one finished. Discarding its result.')
+        continue
+      if bundle is not None:
+        try:
+          bundle._persist()
+        except:
+          logging.error(traceback.format_exc())
+          result = {'bundle': None, 'error': str(sys.exc_info()[1])}
+      spool.finish(task_id, worker, result)
+
+# Renews a worker's claim on a task from a background thread while it runs.
+class Lease:
+  def __init__(self, spool, task_id, worker):
+    self.spool = spool
+    self.task_id = task_id
+    self.worker = worker
+    self._done = threading.Event()
+    self._thread = threading.Thread(target=self._renew, name='protos-lease')
+    self._thread.daemon = True
+
+  def __enter__(self):
+    self._thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, trace):
+    self._done.set()
+    self._thread.join()
+
+  def _renew(self):
+    while not self._done.wait(config.spool_lease/4.):
+      if not self.spool.renew(self.task_id, self.worker):
+        logging.warning('Task '+self.task_id+' was given to another worker')
+        return
+
+def _run_task(task, protocols, storage, xscratch):
+  # Returns the bundle to be stored (if the protocol succeeded) and the result
+  # to send back.
+  try:
+    assert task['protocol'] in protocols, 'No protocol "'+task['protocol']+'" in '+str(config.protocol_dir)
+    f = protocols[task['protocol']]
+    assert hashlib.sha1(_protocol_source(f)).hexdigest()==task['source'], 'Protocol "'+task['protocol']+'" differs from the one the experiment was started with'
+    def decode(arg):
+      if 'bundle' in arg:
+        producer = protocols[arg['protocol']] if arg['protocol'] in protocols else None
+        return _unship(producer, Experiment_Data(arg['tag'], storage, task['xid'], xscratch), arg['bundle'])
+      return arg['value']
+    a = [decode(arg) for arg in task['args']]
+    kw = dict([(k,decode(v)) for (k,v) in task['kwargs'].items()])
+    bundle = _invoke(f, Experiment_Data(task['tag'], storage, task['xid'], xscratch), a, kw)
+    bundle.metadata['cache_key'] = task['cache_key']
+    bundle.metadata['cost_key'] = task['cost_key']
+    return (bundle, {'bundle': _ship(bundle, json.dumps), 'error': None})
+  except:
+    logging.error(traceback.format_exc())
+    return (None, {'bundle': None, 'error': str(sys.exc_info()[1])})
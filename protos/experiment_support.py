@@ -6,10 +6,28 @@ from functools import reduce
 import socket
 import pwd
 import platform
+import traceback
+import multiprocessing
+import Queue
+import json
+import pickle
+import hashlib
+import inspect
+import marshal
+import itertools
+import heapq
+import copy
 
 from .data_bundles import Experiment_Data, Data_Bundle, Bundle_Token
 from .config import config
 from .fs_layout import scratch_directory
+from .file_store import resolve
+from .accounting import resource_usage, accumulate
+from .progress import Progress_Reporter
+from .persistence import Bundle_Writer
+from .streams import Stream, Stream_Writer, drain, remove as remove_stream
+from .spill import Spill_Area
+from .cost_model import Cost_Model, cost_keys, critical_paths, Schedule_Estimate
 from .time import timestamp
 
 from .storage import mechanisms as storage_mechanisms
@@ -58,35 +76,80 @@ class Builtins(Namespace):
     self.exp._metadata['tags'].append(str(t))
     return None
 
+# A single recorded run of an experiment, with its own experiment id and
+# metadata. An Experiment normally holds one of these, but a sweep holds one per
+# point in its parameter grid, all of which are scheduled and run together.
+class Experiment_Run:
+  def __init__(self, name, storage, xid=None):
+    self.name = name
+    self.metadata = {
+      'name': self.name,
+      'tags': [],
+    }
+    self.built = False # Has an experiment function populated this run yet?
+    self.total = 0 # protocols scheduled
+    self.count = 0 # protocols completed
+    self.resuming = xid is not None
+    self.resources = {} # used by earlier attempts at this run
+    if self.resuming:
+      # Picking up where an earlier run of this experiment left off.
+      assert len(storage.find_experiments({'metadata':{'id':str(xid)}}))==1, 'No experiment "'+str(xid)+'" to resume'
+      earlier = storage.read_experiment_metadata(xid)
+      assert earlier['name']==self.name, 'Experiment "'+str(xid)+'" is not a run of "'+self.name+'"'
+      self.resources = earlier.get('resources') or {}
+      self.xid = xid
+    elif not config.storage_readonly:
+      self.xid = storage.create_experiment_id(self.name)
+    else:
+      self.xid = 'INVALID-XID' # should never appear in persistent storage
+    self.metadata['id'] = str(self.xid)
+    if not config.storage_readonly:
+      storage.write_experiment_metadata(self.metadata, self.xid)
+
 class Experiment:
   # Be careful, this class is exposed to the user. Don't let stray data escape.
-  def __init__(self,exp_deco):
+  def __init__(self,exp_deco,xid=None):
     self._schedule = []
+    self._owners = [] # which of self._runs each schedule entry belongs to
     self._bundles = {}
     self._path = reduce(os.path.join, [config.data_dir, exp_deco.name])
     self._name = exp_deco.name
-    self._metadata = {
-      'name': self._name,
-      'tags': [],
-    }
     self._nsroot = self # for namespace resolution
     self.builtin = Builtins(self, self._nsroot) # instantiate our builtin protocols
 
     # Initialize our storage interface
     assert config.storage in storage_mechanisms, 'Could not find a data storage adapter name "'+config.storage+'"'
     self._storage = storage_mechanisms[config.storage]()
-    if not config.storage_readonly:
-      self._storage_xid = self._storage.create_experiment_id(self._name)
-    else:
-      self._storage_xid = 'INVALID-XID' # should never appear in persistent storage
-    self._metadata['id'] = str(self._storage_xid)
-    if not config.storage_readonly:
-      self._storage.write_experiment_metadata(self._metadata, self._storage_xid)
+    self._runs = []
+    self._begin_run(self._name, xid)
+
+  def _begin_run(self, name, xid=None):
+    # Protocols added from now on belong to a new run, with its own id.
+    run = Experiment_Run(name, self._storage, xid)
+    self._runs.append(run)
+    self._metadata = run.metadata
+    self._storage_xid = run.xid
+    return run
+
+  def _build(self, exp_deco):
+    # Runs an experiment function to populate the schedule. Sweeps run it once
+    # for every point in their parameter grid, each in a run of its own.
+    for point in exp_deco.points():
+      if self._runs[-1].built:
+        self._begin_run(exp_deco.name)
+      run = self._runs[-1]
+      if exp_deco.grid is not None:
+        run.metadata['sweep'] = point
+      exp_deco(self, **point)
+      run.built = True
+    return self
 
   def _add(self, func, data_tok, args, kwargs):
     logging.debug('Adding function '+str(func.__name__))
     # list(args) is needed later when we substitute bundles for bundle tokens
     self._schedule.append( (func,data_tok,list(args),kwargs) )
+    self._owners.append(self._runs[-1])
+    self._runs[-1].total += 1
     self._bundles[data_tok] = None
     pass
 
@@ -123,80 +186,612 @@ class Experiment:
 
     return killsets
 
+  def _dependencies(self):
+    # Given a schedule, this produces the set of schedule entries that each
+    # protocol must wait for. This is the same dataflow graph that _killsets
+    # walks: an edge exists wherever a bundle token is passed as an argument.
+    # This function only works *before* _run is run.
+
+    producers = dict([(self._schedule[i][1].id,i) for i in xrange(len(self._schedule))])
+    deps = [set([]) for p in self._schedule]
+    for i in xrange(len(self._schedule)):
+      (f,tok,a,kw) = self._schedule[i]
+      for arg in list(a)+list(kw.values()):
+        if isinstance(arg, Bundle_Token):
+          assert arg.id in producers and producers[arg.id]<i, 'Bundle referenced before being defined'
+          deps[i].add(producers[arg.id])
+
+    return deps
+
+  def _cache_keys(self):
+    # Given a schedule, this produces a key for each protocol invocation. Keys
+    # are derived from the protocol's source, its constant arguments, and the
+    # keys of the bundles it is passed, so two invocations with the same key
+    # should produce the same bundle. Note that changes to code which a
+    # protocol calls (but which isn't part of the protocol itself) are missed.
+    # This function only works *before* _run is run.
+
+    keys = []
+    producers = {}
+    for i in xrange(len(self._schedule)):
+      (f,tok,a,kw) = self._schedule[i]
+      def signature(arg):
+        if isinstance(arg, Bundle_Token):
+          return ['bundle', keys[producers[arg.id]]]
+        return repr(arg)
+      sig = [_protocol_source(f), [signature(arg) for arg in a], sorted([(k,signature(v)) for (k,v) in kw.items()])]
+      keys.append(hashlib.sha1(json.dumps(sig)).hexdigest())
+      producers[tok.id] = i
+
+    return keys
+
+  def _eliminate_duplicates(self):
+    # Finds protocol invocations with identical cache keys and keeps only the
+    # first of each. Later uses of a duplicate's bundle are rewritten to use
+    # the original's, so the usual liveness analysis (_killsets) keeps the
+    # shared bundle alive for as long as any of them need it. Returns a
+    # dictionary mapping each surviving schedule entry to the runs of the
+    # duplicates it stands in for.
+    # This function only works *before* _run is run.
+
+    keys = self._cache_keys()
+    first = {} # cache key -> index in the new schedule
+    alias = {} # duplicate token id -> surviving token
+    schedule = []
+    owners = []
+    duplicates = {}
+    for i in xrange(len(self._schedule)):
+      (f,tok,a,kw) = self._schedule[i]
+      a = [alias.get(arg.id,arg) if isinstance(arg,Bundle_Token) else arg for arg in a]
+      kw = dict([(k,alias.get(v.id,v) if isinstance(v,Bundle_Token) else v) for (k,v) in kw.items()])
+      if keys[i] in first:
+        j = first[keys[i]]
+        logging.debug('Protocol '+str(f.__name__)+' duplicates an earlier invocation')
+        alias[tok.id] = schedule[j][1]
+        duplicates.setdefault(j,[]).append(self._owners[i])
+        continue
+      first[keys[i]] = len(schedule)
+      schedule.append( (f,tok,a,kw) )
+      owners.append(self._owners[i])
+    if len(alias)>0:
+      logging.info('Eliminated '+str(len(alias))+' duplicate protocol invocations')
+    self._schedule = schedule
+    self._owners = owners
+    return duplicates
+
+  def _lookup_cached(self):
+    # Searches earlier runs of this experiment for bundles produced by an
+    # identical protocol invocation. Returns a dictionary mapping schedule
+    # entries to the externalized bundles that can stand in for them. Each
+    # earlier run is searched once for all of the cache keys, and only the
+    # bundles that match are read.
+    ours = set([str(run.xid) for run in self._runs])
+    cached = {}
+    for name in set([run.name for run in self._runs]):
+      wanted = [i for i in xrange(len(self._schedule)) if self._owners[i].name==name]
+      for xid in self._storage.find_experiments({'metadata':{'name':name}}):
+        if len(wanted)==0:
+          break
+        if str(xid) in ours:
+          continue
+        stored = {} # cache key -> bundle ids
+        for b in self._storage.find_bundle_metadata({}, xid):
+          stored.setdefault(b['metadata'].get('cache_key'),[]).append(str(b['metadata']['id']))
+        matches = dict([(i,stored[self._keys[i]]) for i in wanted if self._keys[i] in stored])
+        if len(matches)==0:
+          continue
+        bids = set([bid for found in matches.values() for bid in found])
+        bundles = dict([(str(b['metadata']['id']),b) for b in self._storage.read_bundles(bids, xid)])
+        for (i,found) in matches.items():
+          # Bundles whose files have since been cleaned up are no use to us.
+          found = [bundles[bid] for bid in found if bid in bundles and all([os.path.isfile(resolve(f)) for f in bundles[bid]['files']])]
+          if len(found)>0:
+            logging.debug('Found cached bundle for protocol '+str(self._schedule[i][0].__name__)+' in experiment '+str(xid))
+            cached[i] = found[0]
+        wanted = [i for i in wanted if i not in cached]
+    return cached
+
+  def _lookup_persisted(self):
+    # Matches the bundles already stored for this experiment against the
+    # schedule, so that a resumed run can skip every protocol that completed.
+    # Returns a dictionary mapping schedule entries to externalized bundles.
+    stored = {}
+    for run in self._runs:
+      if run.resuming:
+        for b in self._storage.find_bundles({}, run.xid):
+          stored.setdefault((run.xid, b['metadata'].get('cache_key')), []).append(b)
+    persisted = {}
+    for i in xrange(len(self._schedule)):
+      k = (self._owners[i].xid, self._keys[i])
+      if len(stored.get(k,[]))>0:
+        persisted[i] = stored[k].pop(0)
+    return persisted
+
+  def _rerun_streams(self):
+    # Only a bundle is kept from a streaming protocol, not its chunks. If any
+    # protocol using a stream has to run, so does the protocol producing it.
+    # It won't be stored again if it was already part of this run, though.
+    deps = self._dependencies()
+    for i in xrange(len(self._schedule)-1,-1,-1): # consumers come after producers
+      if i in self._cached:
+        continue
+      for j in deps[i]:
+        if j in self._cached and self._schedule[j][1].id in self._streams:
+          logging.debug('Re-running streaming protocol '+str(self._schedule[j][0].__name__))
+          del self._cached[j]
+
+  def _predict_costs(self):
+    # Predicted seconds for each schedule entry, from earlier runs, and whether
+    # any of them were found. Bundles we already have cost nothing.
+    model = Cost_Model(self._storage, set([run.name for run in self._runs]), exclude=[run.xid for run in self._runs])
+    costs = model.predict_all(self._cost_keys)
+    known = any([model.predict(k) is not None for k in self._cost_keys])
+    return ([0.0 if i in self._cached else costs[i] for i in xrange(len(costs))], known)
+
+  def _estimate_progress(self, jobs):
+    # Progress and ETAs are measured in predicted time rather than protocols,
+    # since one slow protocol can take longer than all of the others together.
+    # Without any history, the ETA is measured as the run goes instead. The
+    # critical paths only decide what runs first when there's a choice, so a
+    # serial run doesn't need them: its own cost bounds each entry.
+    (self._costs, known) = self._predict_costs()
+    if jobs>1 or config.spool_dir!='':
+      self._paths = critical_paths(self._costs, self._dependencies())
+    else:
+      self._paths = list(self._costs)
+    self._estimate = Schedule_Estimate(self._costs, self._paths, jobs, calibrate=not known)
+    for run in self._runs:
+      run.work = 0.0 # predicted seconds of protocols scheduled
+      run.done = 0.0 # ...and of protocols completed
+    for i in xrange(len(self._schedule)):
+      for run in set([self._owners[i]]+self._duplicates.get(i,[])):
+        run.work += self._costs[i]
+    eta = timestamp(self._estimate.remaining())
+    for run in self._runs:
+      run.metadata['eta'] = eta
+      self._reporter.update(run.xid, eta=eta)
+    self._reporter.flush() # Anyone planning around us wants this right away
+
+  def _stream_path(self, tok_id):
+    return os.path.join(self._xscratch, '.streams', str(tok_id))
+
+  def _stream_for(self, sched):
+    # Where a schedule entry's chunks go, if it's a streaming protocol.
+    tok = self._schedule[sched][1]
+    if tok.id in self._streams:
+      return self._stream_path(tok.id)
+    return None
+
+  def _token_uses(self):
+    # For each bundle token, the schedule entries which use it, in order.
+    uses = {}
+    for i in xrange(len(self._schedule)):
+      (f,tok,a,kw) = self._schedule[i]
+      for arg in list(a)+list(kw.values()):
+        if isinstance(arg, Bundle_Token):
+          uses.setdefault(arg.id,[]).append(i)
+    return uses
+
+  def _keep(self, sched, tok_id, value):
+    # Holds on to a bundle (or stream) produced by sched for later protocols.
+    self._bundles[tok_id] = value
+    if self._spill is not None and isinstance(value, Data_Bundle):
+      self._spill.add(tok_id, value, sched)
+
+  def _fetch(self, sched, tok_id):
+    # Retrieves a bundle for use by sched, reloading it if it was spilled.
+    if self._spill is not None:
+      self._spill.fetch(tok_id, sched)
+    return self._bundles[tok_id]
+
+  def _inputs_used(self, sched):
+    # sched has whatever it needs from its input bundles, so they can be
+    # spilled ahead of the protocols still waiting for them.
+    if self._spill is not None:
+      self._spill.done(sched)
+
+  def _release(self, tok_id):
+    # Drops a bundle (or stream) once nothing else needs it.
+    self._bundles[tok_id] = None
+    if self._spill is not None:
+      self._spill.discard(tok_id)
+    if tok_id in self._streams:
+      remove_stream(self._stream_path(tok_id))
+
+  def _announce_reuse(self, sched):
+    f = self._schedule[sched][0]
+    if sched in self._restored:
+      print('  Skipping completed protocol '+str(f.__name__))
+    else:
+      print('  Reusing protocol '+str(f.__name__))
+
+  def _resolve(self, sched, lookup):
+    # Produces copies of a schedule entry's arguments with every data bundle
+    # token replaced by lookup(token).
+    (f,tok,a,kw) = self._schedule[sched]
+    # FIXME: buggy inverted data dependencies can cause these lookups to fail
+    a = [lookup(arg) if isinstance(arg,Bundle_Token) else arg for arg in a]
+    kw = dict([(k,lookup(v) if isinstance(v,Bundle_Token) else v) for (k,v) in kw.items()])
+    return (a,kw)
+
+  def _fail(self, sched, e):
+    f = self._schedule[sched][0]
+    owner = self._owners[sched]
+    logging.error('Protocol "'+str(f.__name__)+'" failed.')
+    owner.metadata['last_error'] = str(e)
+    self._reporter.update(owner.xid, last_error=owner.metadata['last_error'])
+    # Nothing else gets to finish, either.
+    for run in self._runs:
+      if run is not owner and run.count<run.total:
+        run.metadata['last_error'] = 'Stopped after a failure in experiment '+str(owner.xid)
+        self._reporter.update(run.xid, last_error=run.metadata['last_error'])
+    self._reporter.flush()
+
+  def _complete(self, sched, bundle, persisted=False):
+    owner = self._owners[sched]
+    bundle.metadata['cache_key'] = self._keys[sched]
+    bundle.metadata['cost_key'] = self._cost_keys[sched]
+    # Now persist the bundle, for the record and for incremental re-eval later
+    if sched not in self._restored and not persisted:
+      bundle._persist(self._writer)
+    if sched not in self._cached:
+      accumulate(owner.metadata['resources'], bundle.metadata['resources'], str(self._schedule[sched][0].__name__))
+
+    self._estimate.finish(sched)
+    self._advance(owner, sched)
+
+    # Eliminated duplicates finish along with the entry that replaced them.
+    # Those belonging to other runs get a copy of the bundle in their record.
+    # A run's work counts the entry once, however many of its invocations it
+    # stands in for, so its cost is only added to each run's progress once.
+    recorded = set([owner])
+    credited = set([owner])
+    for run in self._duplicates.get(sched,[]):
+      if run not in recorded and sched not in self._restored:
+        xdata = Experiment_Data(self._schedule[sched][1].id, self._storage, run.xid, self._xscratch)
+        Data_Bundle(xdata, _init=bundle._externalize())._persist(self._writer)
+        recorded.add(run)
+      self._advance(run, sched, credit=run not in credited)
+      credited.add(run)
+
+  def _advance(self, run, sched, credit=True):
+    # Update our progress
+    run.count += 1
+    if credit:
+      run.done += self._costs[sched]
+    if run.count==run.total:
+      run.metadata['progress'] = '100'
+      run.metadata['eta'] = timestamp()
+    else:
+      if run.work>0:
+        run.metadata['progress'] = str(min(99,int(100*run.done/run.work)))
+      else:
+        run.metadata['progress'] = str(100*run.count/run.total)
+      run.metadata['eta'] = timestamp(self._estimate.remaining())
+    self._reporter.update(run.xid, progress=run.metadata['progress'], eta=run.metadata['eta'], resources=run.metadata['resources'])
+
+  def _xdata(self, sched, bundle_tag=None):
+    # Experiment data for a bundle belonging to a schedule entry's run.
+    if bundle_tag is None:
+      bundle_tag = self._schedule[sched][1].id
+    return Experiment_Data(bundle_tag, self._storage, self._owners[sched].xid, self._xscratch)
+
   def _run(self):
     #logging.debug('Running experiment')
-    print('--- Running Experiment "'+str(self._name)+'" ---')
-    self._metadata['time'] = timestamp()
+    names = []
+    for run in self._runs:
+      if run.name not in names:
+        names.append(run.name)
+    for name in names:
+      print('--- Running Experiment "'+str(name)+'" ---')
     hostname = socket.getfqdn()
     dot_loc = hostname.find('.')
     if dot_loc>0:
       hostname = hostname[0:dot_loc]
-    self._metadata['host'] = hostname
-    self._metadata['platform'] = platform.platform()
-    self._metadata['user'] = pwd.getpwuid(os.getuid())[0]
-    self._metadata['progress'] = 0
-    self._metadata['last_error'] = ''
-    if not config.storage_readonly:
-      self._storage.write_experiment_metadata(self._metadata, self._storage_xid)
+    # From here on, metadata is written behind our backs by the reporter.
+    self._reporter = Progress_Reporter()
+    for run in self._runs:
+      run.metadata['time'] = timestamp()
+      run.metadata['host'] = hostname
+      run.metadata['platform'] = platform.platform()
+      run.metadata['user'] = pwd.getpwuid(os.getuid())[0]
+      run.metadata['progress'] = 0
+      run.metadata['last_error'] = ''
+      # Protocols restored from an earlier attempt aren't counted again, so
+      # its usage is carried over.
+      run.metadata['resources'] = copy.deepcopy(run.resources)
+      self._reporter.track(run.metadata, run.xid)
+    self._reporter.flush()
+    self._writer = None
 
+    try:
+      with scratch_directory() as xscratch:
+        self._xscratch = xscratch
+        self._duplicates = {}
+        if config.deduplicate:
+          self._duplicates = self._eliminate_duplicates()
+        self._keys = self._cache_keys()
+        self._cached = {}
+        if config.memoize:
+          self._cached = self._lookup_cached()
+        persisted = self._lookup_persisted()
+        self._cached.update(persisted)
+        self._restored = set(persisted.keys())
+        self._streams = set([p[1].id for p in self._schedule if getattr(p[0],'streaming',False)])
+        self._rerun_streams()
+        self._cost_keys = cost_keys(self._schedule)
+        self._estimate_progress(config.jobs)
+        self._spill = None
+        if config.memory_budget>0:
+          self._spill = Spill_Area(os.path.join(xscratch,'.spill'), int(config.memory_budget*1024*1024), self._token_uses())
+        if config.spool_dir!='':
+          self._start_threads()
+          self._run_distributed(config.spool_dir)
+        elif config.jobs>1:
+          self._run_parallel(config.jobs)
+        else:
+          self._start_threads()
+          self._run_serial()
+    finally:
+      try:
+        # Everything that finished should be stored, even if something failed.
+        if self._writer is not None:
+          self._writer.close()
+      finally:
+        self._reporter.close()
+
+    return True
+
+  def _start_threads(self):
+    # Only once any worker processes have been forked. Forking copies just the
+    # forking thread, so a lock held by any other thread at the time would stay
+    # held in the workers forever.
+    self._reporter.start()
+    if config.async_persist and not config.storage_readonly:
+      self._writer = Bundle_Writer()
+
+  def _run_serial(self):
     killsets = self._killsets()
 
-    with scratch_directory() as xscratch:
-      self._xscratch = xscratch
-      progress_count = 0
-      progress_total = len(self._schedule)
-      for (sched,killset) in zip(xrange(0,len(self._schedule)), killsets):
-        (f,tok,a,kw) = self._schedule[sched]
-        # Replace data bundle tokens with actual data bundles
-        # First for keyword arguments
-        for (k,v) in kw.items():
-          if isinstance(v,Bundle_Token):
-            # FIXME: buggy inverted data dependencies can cause this lookup to fail
-            kw[k] = self._bundles[v.id]
-        # And for positional arguments
-        for i in xrange(0,len(a)):
-          arg = a[i]
-          if isinstance(arg,Bundle_Token):
-            # FIXME: buggy inverted data dependencies can cause this lookup to fail
-            a[i] = self._bundles[arg.id]
-
-        # Now run the function and store the resulting bundle object
-        xdata = Experiment_Data(tok.id, self._storage, self._storage_xid, self._xscratch)
-        with scratch_directory() as d:
-          os.chdir(d)
-          # FIXME: Capture timing information?
-          print('  Running protocol '+str(f.__name__))
-          try:
-            bundle = f(xdata,*a,**kw)
-            assert isinstance(bundle,Data_Bundle), 'Protocol "'+str(f.__name__)+'" returned a '+str(type(bundle))+' instead of a bundle object'
-          except:
-            e = sys.exc_info()[1]
-            logging.error('Protocol "'+str(f.__name__)+'" failed.')
-            self._metadata['last_error'] = str(e)
-            if not config.storage_readonly:
-              self._storage.write_experiment_metadata(self._metadata, self._storage_xid)
-            raise
-
-        # Now persist the bundle, for the record and for incremental re-eval later
-        bundle._persist()
-
-        # Update our progress
-        progress_count += 1
-        self._metadata['progress'] = str(100*progress_count/progress_total)
-        if not config.storage_readonly:
-          self._storage.write_experiment_metadata(self._metadata, self._storage_xid)
-
-        if tok.id not in killset:
-          # Add the bundle we've generated, if it will be used later
-          self._bundles[tok.id] = bundle
-
-        # Remove references to all bundles
-        for vic in killset:
-          self._bundles[vic] = None
-        self._schedule[sched] = None
-        
+    for (sched,killset) in zip(xrange(0,len(self._schedule)), killsets):
+      (f,tok,a,kw) = self._schedule[sched]
+      # Replace data bundle tokens with actual data bundles
+      (a,kw) = self._resolve(sched, lambda t: self._fetch(sched, t.id))
 
-    return True
+      # Now run the function and store the resulting bundle object
+      if sched in self._cached:
+        self._announce_reuse(sched)
+        bundle = Data_Bundle(self._xdata(sched), _init=self._cached[sched])
+      else:
+        try:
+          bundle = _invoke(f, self._xdata(sched), a, kw, stream=self._stream_for(sched))
+        except:
+          self._fail(sched, sys.exc_info()[1])
+          raise
+      self._inputs_used(sched)
+
+      self._complete(sched, bundle)
+
+      if tok.id not in killset:
+        # Add the bundle we've generated, if it will be used later
+        if tok.id in self._streams:
+          self._keep(sched, tok.id, Stream(self._stream_path(tok.id), self._xdata(sched)))
+        else:
+          self._keep(sched, tok.id, bundle)
+
+      # Remove references to all bundles
+      for vic in killset:
+        self._release(vic)
+      self._schedule[sched] = None
+
+  def _run_parallel(self, jobs):
+    # Protocols are dispatched to a pool of worker processes. Bundles cross the
+    # process boundary as shipped by _ship, so they keep their class and any
+    # attributes a protocol gave them.
+    global _forked_experiment
+    results = Queue.Queue()
+    # Workers are forked from this process, so they inherit the schedule.
+    _forked_experiment = self
+    pool = multiprocessing.Pool(jobs)
+    try:
+      self._start_threads()
+      def submit(sched, inputs):
+        inputs = dict([(k,_ship(b, pickle.dumps)) for (k,b) in inputs.items()])
+        pool.apply_async(_parallel_worker, (sched, inputs), callback=results.put)
+      # The pool runs protocols in the order they're submitted, so a stream's
+      # producer is always running by the time any of its consumers are. Only
+      # as many protocols as there are workers are handed over at once, so the
+      # pool's queue doesn't decide what runs next.
+      self._run_dataflow(submit, results.get, pipelined=True, slots=jobs)
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+      _forked_experiment = None
+
+  def _run_distributed(self, spool_dir):
+    # Protocols are handed to worker processes (possibly on other hosts) through
+    # a spool directory. Workers store the bundles they produce themselves.
+    # Imported here because the distributed executor is built on this module.
+    from .distributed import Spool, Spool_Executor
+    assert len(self._streams)==0, 'Streaming protocols cannot be run on workers'
+    executor = Spool_Executor(Spool(spool_dir), self)
+    self._run_dataflow(executor.submit, executor.collect, persisted=True)
+
+  def _run_dataflow(self, submit, collect, persisted=False, pipelined=False, slots=None):
+    # Runs each protocol as soon as every protocol it depends on has finished.
+    # Protocols are run elsewhere: submit(sched, inputs) hands off a schedule
+    # entry along with its input bundles (by token id; streams aren't
+    # included), and collect() waits for any submitted entry to finish,
+    # returning (sched, shipped bundle, error). See _ship. If persisted is set,
+    # whoever ran a protocol has already stored its bundle. If pipelined is set,
+    # consumers of a stream are submitted as soon as its producer is. If slots
+    # is set, no more than that many protocols are submitted at a time.
+    deps = self._dependencies()
+    waiting = [set(d) for d in deps]
+    dependents = [[] for p in self._schedule]
+    uses = dict([(p[1].id,0) for p in self._schedule])
+    for i in xrange(len(self._schedule)):
+      for j in deps[i]:
+        dependents[j].append(i)
+        uses[self._schedule[j][1].id] += 1
+
+    # Of the protocols ready to run, those at the head of the longest
+    # (predicted) chain of work go first, so it isn't left until the end.
+    ready = [(-self._paths[i],i) for i in xrange(len(self._schedule)) if len(waiting[i])==0]
+    heapq.heapify(ready)
+    def satisfy(dep, i):
+      if dep in waiting[i]:
+        waiting[i].remove(dep)
+        if len(waiting[i])==0:
+          heapq.heappush(ready, (-self._paths[i],i))
+    running = 0
+    submitted = 0
+    finished = [] # results we already have
+    while len(ready)>0 or running>0:
+      while len(ready)>0 and (slots is None or submitted<slots):
+        (_,sched) = heapq.heappop(ready)
+        tok = self._schedule[sched][1]
+        if sched in self._cached:
+          # No need to bother anyone with a result we already have.
+          self._announce_reuse(sched)
+          finished.append( (sched, {'bundle':self._cached[sched], 'class':None, 'state':{}}, None) )
+        else:
+          inputs = dict([(self._schedule[j][1].id, self._fetch(sched, self._schedule[j][1].id)) for j in deps[sched] if self._schedule[j][1].id not in self._streams])
+          submit(sched, inputs)
+          submitted += 1
+          if pipelined and tok.id in self._streams:
+            for i in dependents[sched]:
+              satisfy(sched, i)
+        self._inputs_used(sched) # Whoever runs it has its own copies
+        running += 1
+
+      if len(finished)>0:
+        (sched, shipped, error) = finished.pop(0)
+      else:
+        (sched, shipped, error) = collect()
+        submitted -= 1
+      running -= 1
+      (f,tok,a,kw) = self._schedule[sched]
+      if error is not None:
+        self._fail(sched, error)
+        raise RuntimeError('Protocol "'+str(f.__name__)+'" failed: '+error)
+      try:
+        bundle = _unship(f, self._xdata(sched), shipped)
+      except:
+        self._fail(sched, sys.exc_info()[1])
+        raise
+
+      self._complete(sched, bundle, persisted=persisted and sched not in self._cached)
+
+      if uses[tok.id]>0:
+        # Add the bundle we've generated, if it will be used later
+        self._keep(sched, tok.id, bundle)
+      # Remove references to bundles with no remaining consumers
+      for j in deps[sched]:
+        vic = self._schedule[j][1].id
+        uses[vic] -= 1
+        if uses[vic]==0:
+          self._release(vic)
+      for i in dependents[sched]:
+        satisfy(sched, i)
+
+
+def _protocol_source(f):
+  # Protocols are usually decorated, so look through to the wrapped function.
+  func = getattr(f, 'function', f)
+  try:
+    return inspect.getsource(func)
+  except (IOError, TypeError):
+    # No source available (e.g.- interactively defined), so fall back on bytecode.
+    return hashlib.sha1(marshal.dumps(func.__code__)).hexdigest()
+
+def _invoke(f, xdata, a, kw, stream=None):
+  # Runs a single protocol in its own scratch directory and returns its bundle.
+  # Protocol scratch directories live inside the experiment's, so files can
+  # be linked between them, and are recycled between protocols. Streaming
+  # protocols write their chunks to the given stream file as they go.
+  writer = None
+  if stream is not None:
+    writer = Stream_Writer(stream) # Consumers can start following it now
+  with scratch_directory(root=xdata.xscratch, reuse=True) as d:
+    xdata.pscratch = d
+    os.chdir(d)
+    print('  Running protocol '+str(f.__name__))
+    with resource_usage(d) as usage:
+      try:
+        bundle = f(xdata,*a,**kw)
+      except:
+        if writer is not None:
+          writer.fail(str(sys.exc_info()[1]))
+        raise
+      if writer is not None:
+        bundle = drain(bundle, writer)
+    assert isinstance(bundle,Data_Bundle), 'Protocol "'+str(f.__name__)+'" returned a '+str(type(bundle))+' instead of a bundle object'
+  bundle.metadata['resources'] = usage
+  return bundle
+
+# Attributes every bundle has. Anything else was added by a protocol.
+_BUNDLE_FIELDS = set(['_name','_tag','_storage','_storage_xid','_xscratch','_pscratch','_file_refs','metadata','data','files'])
+
+def _ship(bundle, encode):
+  # Bundles cross process boundaries in their externalized form. If a protocol
+  # returned its own subclass of Data_Bundle, the class's name and the
+  # attributes the protocol added go along too, so the bundle can be rebuilt
+  # as it was. encode is how the attributes will be sent (pickle.dumps or
+  # json.dumps); attributes it can't handle are an error, not a silent loss.
+  shipped = {'bundle': bundle._externalize(), 'class': None, 'state': {}}
+  if bundle.__class__ is not Data_Bundle:
+    shipped['class'] = bundle.__class__.__name__
+    shipped['module'] = getattr(bundle.__class__, '__module__', None)
+    shipped['state'] = dict([(k,v) for (k,v) in vars(bundle).items() if k not in _BUNDLE_FIELDS])
+    try:
+      encode(shipped['state'])
+    except Exception:
+      raise TypeError('The attributes of a '+shipped['class']+' bundle cannot be sent to another process: '+str(sys.exc_info()[1]))
+  return shipped
+
+def _unship(f, xdata, shipped):
+  # Rebuilds a bundle shipped by _ship. Its class is looked up in the module
+  # it came from or, since protocol files aren't imported as modules, where
+  # the protocol f that produced it was defined.
+  bundle = Data_Bundle(xdata, _init=shipped['bundle'])
+  if shipped['class'] is not None:
+    module = sys.modules.get(shipped['module'])
+    cls = getattr(module, shipped['class'], None)
+    if cls is None and f is not None:
+      cls = getattr(f, 'function', f).__globals__.get(shipped['class'])
+    if not (inspect.isclass(cls) and issubclass(cls, Data_Bundle)):
+      raise RuntimeError('Protocol "'+str(getattr(f,'__name__',None))+'" returned a '+shipped['class']+' bundle, but that class is not defined alongside the protocol, so it cannot be rebuilt in another process')
+    bundle.__class__ = cls
+    bundle.__dict__.update(shipped['state'])
+  return bundle
+
+# The experiment being run in parallel. Worker processes get a copy of this when
+# the pool forks them, so only schedule indices and bundles need to be sent.
+_forked_experiment = None
+
+def _parallel_worker(sched, inputs):
+  x = _forked_experiment
+  (f,tok,a,kw) = x._schedule[sched]
+  producers = dict([(p[1].id,p[0]) for p in x._schedule])
+  def rebuild(t):
+    if t.id in x._streams:
+      return Stream(x._stream_path(t.id), x._xdata(sched, t.id))
+    return _unship(producers[t.id], x._xdata(sched, t.id), inputs[t.id])
+  stream = x._stream_for(sched)
+  try:
+    (a,kw) = x._resolve(sched, rebuild)
+    bundle = _invoke(f, x._xdata(sched), a, kw, stream=stream)
+    return (sched, _ship(bundle, pickle.dumps), None)
+  except:
+    logging.error(traceback.format_exc())
+    if stream is not None and not os.path.isfile(stream):
+      # Failed before the protocol started. Its consumers may already be waiting.
+      Stream_Writer(stream).fail(str(sys.exc_info()[1]))
+    return (sched, None, str(sys.exc_info()[1]))
 
 
 # Experiment decorator
@@ -205,6 +800,7 @@ class experiment:
     self.name = str(wrapped_func.__name__)
     logging.debug('Found experiment "'+self.name+'"')
     self.func = wrapped_func
+    self.grid = None # parameter name -> list of values, for sweeps
 
   # the 'experiment' arg is presented to the user as something that looks like a
   # protocol module. It's not. It's an Experiment instance which we use to chain
@@ -213,3 +809,31 @@ class experiment:
     logging.debug('Building experiment')
     self.func(experiment, *args, **kwargs)
     return experiment
+
+  def points(self):
+    ''' Every combination of sweep parameters, as a list of keyword argument dictionaries. '''
+    if self.grid is None:
+      return [{}]
+    names = sorted(self.grid.keys())
+    return [dict(zip(names,values)) for values in itertools.product(*[self.grid[n] for n in names])]
+
+# Sweep decorator
+# Declares a grid of parameters for an experiment, which is run once for every
+# combination of values. The values are passed to the experiment function as
+# keyword arguments. For example:
+#
+# @protos.sweep(size=[1,2,4], mode=['fast','slow'])
+# @protos.experiment
+# def example(protocols, size, mode):
+#   ...
+#
+# Every point is recorded as a separate experiment, with its parameters in the
+# 'sweep' metadata field, but they are all scheduled and run together.
+def sweep(**grid):
+  def decorator(exp):
+    assert isinstance(exp, experiment), 'Sweeps must be declared on experiments (put @protos.sweep above @protos.experiment)'
+    for (k,v) in grid.items():
+      assert isinstance(v, (list,tuple)), 'Sweep parameter "'+str(k)+'" must be a list of values'
+    exp.grid = dict([(k,list(v)) for (k,v) in grid.items()])
+    return exp
+  return decorator
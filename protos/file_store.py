@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+import logging
+import os
+import os.path
+import stat
+import hashlib
+import tempfile
+import time
+
+from .config import config
+from .fs_layout import place_file
+
+# Bundle files are kept in a content-addressed store under the data directory,
+# so they outlive the scratch directory they were created in. Each file is
+# stored once, named by the hash of its contents, no matter how many bundles or
+# experiments refer to it. Stored bundles refer to files by a reference string:
+#   sha256:<hex digest>/<original file name>
+# which resolves to a path inside the store without touching the file itself.
+# Nothing is removed from the store when the bundles referring to a file are
+# deleted, since other bundles (in any project sharing the data directory) may
+# refer to it too. File_Store.sweep removes files nothing refers to any more;
+# run it with `protos-clean --sweep-files`.
+REFERENCE_PREFIX = 'sha256:'
+
+def is_reference(name):
+  return name.startswith(REFERENCE_PREFIX)
+
+def store_root():
+  return os.path.join(config.data_dir, '.files')
+
+def default_store():
+  ''' The store new bundle files should go to, or None if they shouldn't be stored. '''
+  if not config.file_store or config.storage_readonly or config.data_dir=='':
+    return None
+  return File_Store(store_root())
+
+def referenced_digests(storage):
+  ''' The digests of every stored file referred to by a bundle in the given datastore. '''
+  digests = set([])
+  for xid in storage.find_experiments({}):
+    for bundle in storage.find_bundles({}, xid):
+      for name in bundle.get('files',[]):
+        if is_reference(name):
+          digests.add(_digest(name))
+  return digests
+
+def _digest(ref):
+  return ref[len(REFERENCE_PREFIX):].split('/',1)[0]
+
+def resolve(name):
+  ''' Turns a stored bundle's file entry into a path, whether or not it is a reference. '''
+  if is_reference(name):
+    return File_Store(store_root()).path(name)
+  return name
+
+class File_Store:
+  def __init__(self, root):
+    self.root = root
+
+  def path(self, ref):
+    digest = _digest(ref)
+    return os.path.join(self.root, digest[0:2], digest)
+
+  def put(self, filename, owned=False):
+    ''' Adds a file to the store (if its contents aren't already there) and returns a reference to it. Only files protos owns (see Data_Bundle._owns) may be linked into the store; anybody else's could be modified afterwards, so they're copied. '''
+    h = hashlib.sha256()
+    with open(filename,'rb') as f:
+      for block in iter(lambda: f.read(1<<20), b''):
+        h.update(block)
+    ref = REFERENCE_PREFIX+h.hexdigest()+'/'+os.path.basename(filename)
+    blob = self.path(ref)
+    if not os.path.isfile(blob):
+      if not os.path.isdir(os.path.dirname(blob)):
+        try:
+          os.makedirs(os.path.dirname(blob))
+        except OSError: # Someone else just made it
+          pass
+      # Place it under a temporary name first, so that a half-written file is
+      # never mistaken for a stored one.
+      (fd,tmp) = tempfile.mkstemp(prefix='.incoming_', dir=os.path.dirname(blob))
+      os.close(fd)
+      how = place_file(filename, tmp, link=owned)
+      # Stored files are shared, so nobody should modify them. (If this one is
+      # linked, the other link is in a scratch directory, so it's ours too.)
+      os.chmod(tmp, stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH)
+      os.rename(tmp, blob)
+      logging.debug('Stored file '+filename+' as '+ref+' ('+how+')')
+    else:
+      # Someone is about to refer to it again, so a sweep shouldn't take it.
+      try:
+        os.utime(blob, None)
+      except OSError: # Stored by another user. Their sweeps will see our bundle.
+        pass
+    return ref
+
+  def exists(self, ref):
+    return os.path.isfile(self.path(ref))
+
+  def fetch(self, ref, dest):
+    ''' Makes a stored file available at dest, linking rather than copying it where possible. '''
+    return place_file(self.path(ref), dest)
+
+  def sweep(self, referenced, grace=86400.):
+    ''' Deletes stored files whose digests aren't in referenced (see referenced_digests), along with files left half-stored. Files stored or reused in the last grace seconds are kept, since the bundles referring to them may not have been written yet. Returns the number of files deleted and their total size in bytes. '''
+    (count,size) = (0,0)
+    if not os.path.isdir(self.root):
+      return (count,size)
+    cutoff = time.time()-grace
+    for shard in os.listdir(self.root):
+      d = os.path.join(self.root, shard)
+      if not os.path.isdir(d):
+        continue
+      for name in os.listdir(d):
+        if name in referenced:
+          continue
+        path = os.path.join(d, name)
+        try:
+          # Storing a file (chmod, rename) or reusing one (utime) updates its ctime.
+          st = os.stat(path)
+          if st.st_ctime>=cutoff:
+            continue
+          os.remove(path)
+        except OSError: # Someone else just removed it
+          continue
+        logging.debug('Removed unreferenced file '+path)
+        count += 1
+        size += st.st_size
+    return (count,size)
@@ -2,6 +2,7 @@ import logging
 import os.path
 import tempfile
 import shutil
+import fcntl
 
 from .config import config
 
@@ -34,12 +35,27 @@ def infer_from_exf(exf_path,config):
 
 
 # Python context for temporary directory
+# Scratch directories are created under config.scratch_dir unless a different
+# root is given. Directories created with reuse=True are emptied instead of
+# removed when the context exits, and handed out again by the next context
+# with the same root. Their root should be another scratch directory, which
+# removes them when it is cleaned up.
 class scratch_directory:
-  def __init__(self):
+  _free = {} # root directory -> emptied scratch directories under it
+  def __init__(self, root=None, reuse=False):
+    self.root = root
+    self.reuse = reuse and not config.preserve
     self.dir = None
   def __enter__(self):
-    self.dir = tempfile.mkdtemp(prefix='/tmp/protos_temp_')
-    logging.debug('Creating scratch directory '+self.dir)
+    if self.root is None:
+      self.root = config.scratch_dir
+    free = scratch_directory._free.get(self.root, [])
+    if self.reuse and len(free)>0:
+      self.dir = free.pop()
+      logging.debug('Reusing scratch directory '+self.dir)
+    else:
+      self.dir = tempfile.mkdtemp(prefix='protos_temp_', dir=self.root)
+      logging.debug('Creating scratch directory '+self.dir)
     return self.dir
   def __exit__(self, type, value, traceback):
     if not config.preserve:
@@ -47,7 +63,55 @@ class scratch_directory:
       # recursively delete whatever is in the scratch space
       assert os.path.isdir(self.dir), 'Scratch directory not found--something is wrong'
       assert len(self.dir)>1, 'Bad scratch directory name: "'+str(self.dir)+'"'
-      shutil.rmtree(self.dir)
+      if self.reuse:
+        for name in os.listdir(self.dir):
+          path = os.path.join(self.dir, name)
+          if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+          else:
+            os.remove(path)
+        scratch_directory._free.setdefault(self.root, []).append(self.dir)
+      else:
+        shutil.rmtree(self.dir)
+        # Anything we were keeping around for reuse inside it is gone, too.
+        scratch_directory._free.pop(self.dir, None)
     return False # Don't suppress errors
 
 
+# Linux ioctl for sharing the data blocks of one file with another (a "reflink").
+# Only some filesystems support this (e.g.- btrfs, xfs).
+FICLONE = 0x40049409
+
+def place_file(src, dst, movable=False, link=True):
+  '''
+  Makes the file src available at dst as cheaply as possible. In order, this
+  tries a hard link (only if link), a reflink, and (only if movable) a rename,
+  before falling back on copying. Returns the method that worked.
+  '''
+  if os.path.exists(dst):
+    if os.path.samefile(src, dst):
+      return 'none'
+    os.remove(dst)
+  if link:
+    try:
+      os.link(src, dst)
+      return 'link'
+    except OSError:
+      pass
+  try:
+    with open(src,'rb') as s:
+      with open(dst,'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+    return 'reflink'
+  except (IOError, OSError):
+    if os.path.exists(dst):
+      os.remove(dst)
+  if movable:
+    try:
+      os.rename(src, dst)
+      return 'rename'
+    except OSError:
+      pass
+  shutil.copy(src, dst)
+  return 'copy'
@@ -0,0 +1,72 @@
+import logging
+import threading
+import traceback
+import sys
+import copy
+import Queue
+
+from .config import config
+from .storage import mechanisms as storage_mechanisms
+
+# Writes bundles to the datastore from a background thread, so that protocols
+# don't wait on storage. Bundles are queued in externalized form and written in
+# batches of whatever has piled up. The queue is bounded by
+# config.persist_queue_size: if storage falls that far behind, put() blocks
+# until it catches up. A failed write is reported by the next call to put() or
+# close(), and close() waits until everything queued has been written.
+# One writer can serve any number of experiments.
+class Bundle_Writer:
+  def __init__(self):
+    self._queue = Queue.Queue(config.persist_queue_size)
+    self._error = None
+    # Like the progress reporter, the writer gets its own adapter instance.
+    self._storage = storage_mechanisms[config.storage]()
+    self._thread = threading.Thread(target=self._background, name='protos-persist')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def put(self, bundle, xid):
+    self._check()
+    # Protocols are free to modify their input bundles, so take a snapshot.
+    self._queue.put( (xid, copy.deepcopy(bundle)) )
+
+  def close(self):
+    ''' Waits for every queued bundle to be written, then stops the writer. '''
+    if self._thread is not None:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+    self._check()
+
+  def _check(self):
+    if self._error is not None:
+      raise RuntimeError('Failed to persist bundle: '+self._error)
+
+  def _background(self):
+    stopping = False
+    while not stopping:
+      batch = [self._queue.get()]
+      while True:
+        try:
+          batch.append(self._queue.get_nowait())
+        except Queue.Empty:
+          break
+      if None in batch:
+        stopping = True
+        batch = [b for b in batch if b is not None]
+      if len(batch)==0 or self._error is not None:
+        continue # Don't pile more writes onto a broken datastore.
+      # Keep each experiment's bundles in the order they were queued.
+      xids = []
+      by_xid = {}
+      for (xid,bundle) in batch:
+        if xid not in by_xid:
+          xids.append(xid)
+        by_xid.setdefault(xid,[]).append(bundle)
+      try:
+        for xid in xids:
+          logging.debug('Persisting '+str(len(by_xid[xid]))+' bundles')
+          self._storage.write_bundles(by_xid[xid], xid)
+      except:
+        logging.error(traceback.format_exc())
+        self._error = str(sys.exc_info()[1])
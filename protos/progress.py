@@ -0,0 +1,105 @@
+import logging
+import threading
+import copy
+
+from .config import config
+from .storage import mechanisms as storage_mechanisms
+
+# Experiment metadata changes after every protocol, but nobody needs to see
+# every change. The reporter keeps the metadata in memory and writes it to the
+# datastore from a background thread, either every config.progress_interval
+# seconds or after config.progress_count updates, whichever comes first.
+# Important changes (errors, completion) can be forced out with flush().
+# One reporter can track any number of experiments. Until start() is called,
+# nothing is written unless it's flushed.
+class Progress_Reporter:
+  def __init__(self):
+    self._metadata = {} # xid -> metadata
+    self._dirty = {} # xid -> fields changed since the last write
+    self._written = set([]) # xids with nothing to update until their full metadata is stored
+    self._partial = True # Assume the adapter can update single fields until told otherwise
+    self._updates = 0
+    self._lock = threading.Lock() # for the metadata
+    self._write_lock = threading.Lock() # for the datastore
+    self._wakeup = threading.Event()
+    self._stopping = False
+    self._thread = None
+    if not config.storage_readonly:
+      # The reporter writes from its own thread, so it gets its own adapter
+      # instead of sharing a connection with the experiment.
+      self._storage = storage_mechanisms[config.storage]()
+
+  def start(self):
+    ''' Starts writing changes from the background thread. '''
+    if not config.storage_readonly and self._thread is None:
+      self._thread = threading.Thread(target=self._background, name='protos-progress')
+      self._thread.daemon = True
+      self._thread.start()
+
+  def track(self, metadata, xid):
+    with self._lock:
+      self._metadata[xid] = copy.deepcopy(metadata)
+      self._dirty[xid] = set(metadata.keys())
+
+  def update(self, xid, **fields):
+    with self._lock:
+      for (k,v) in fields.items():
+        self._metadata[xid][k] = copy.deepcopy(v)
+        self._dirty[xid].add(k)
+      self._updates += 1
+      if self._updates>=config.progress_count:
+        self._wakeup.set()
+
+  def flush(self):
+    if config.storage_readonly:
+      return True
+    # One flush writes at a time, so an older copy can't overwrite a newer one.
+    with self._write_lock:
+      # Copy the changes, then write them without holding the lock, so update()
+      # never has to wait for the datastore.
+      with self._lock:
+        pending = [(xid,dirty,copy.deepcopy(self._metadata[xid])) for (xid,dirty) in self._dirty.items() if len(dirty)>0]
+        for (xid,dirty,metadata) in pending:
+          self._dirty[xid] = set([])
+        self._updates = 0
+      for (i,(xid,dirty,metadata)) in enumerate(pending):
+        try:
+          self._write(xid, dirty, metadata)
+        except:
+          # Whatever wasn't written goes out with the next flush.
+          with self._lock:
+            for (xid,dirty,metadata) in pending[i:]:
+              self._dirty[xid] |= dirty
+          raise
+    return True
+
+  def _write(self, xid, dirty, metadata):
+    if xid in self._written and self._partial:
+      try:
+        self._storage.update_experiment_metadata(dict([(k,metadata[k]) for k in dirty]), xid)
+        return
+      except NotImplementedError:
+        self._partial = False
+    self._storage.write_experiment_metadata(metadata, xid)
+    self._written.add(xid)
+
+  def close(self):
+    ''' Stops the background thread and writes out anything left over. '''
+    if self._thread is not None:
+      self._stopping = True
+      self._wakeup.set()
+      self._thread.join()
+      self._thread = None
+    return self.flush()
+
+  def _background(self):
+    while not self._stopping:
+      self._wakeup.wait(config.progress_interval)
+      self._wakeup.clear()
+      if self._stopping:
+        break
+      try:
+        self.flush()
+      except Exception as e:
+        # Leave the changes dirty. They'll go out with the next flush.
+        logging.error('Failed to write experiment progress: '+str(e))
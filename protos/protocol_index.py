@@ -0,0 +1,153 @@
+from __future__ import absolute_import
+import logging
+import os
+import os.path
+import sys
+import json
+import marshal
+import hashlib
+import tempfile
+
+from .protocol_support import protocol
+
+# Loading a protocol means executing the file it's defined in, which can be
+# slow (protocol files are free to import whatever they like), and most
+# experiments only use a few of them. So instead of loading every protocol file
+# up front, a manifest records which protocols each file defines, along with
+# the file's modification time and size. Files that haven't changed since the
+# manifest was written aren't loaded until one of their protocols is actually
+# used. Their compiled code is cached, too. Both live in a cache directory in
+# the protocol directory, and are simply not used if it isn't writable.
+# Note that protocols imported into a protocol file from somewhere else are
+# only noticed when the protocol file itself changes.
+CACHE_DIR = '.protos_cache'
+MANIFEST_VERSION = 1
+
+def dotted_name(filename, func_name):
+  # Convert to dotted name:
+  # 1) Convert path to dotted string. (foo/bar => foo.bar)
+  # 2) Strip suffix(es) from file name. (file.py => file)
+  #   WARNING: This strips *all* suffixes, because dot's are disallowed.
+  #            So "file.v1.py" becomes "file"
+  # 3) Append protocol function name. ("foo" => path.name.foo)
+  (head,tail) = os.path.split(filename)
+  front = head.replace(os.sep, '.') # 1)
+  middle = tail.split('.')[0] # 2)
+  back = func_name
+  if len(front)>0:
+    return '.'.join([front,middle,back])
+  return '.'.join([middle,back])
+
+# A dictionary of dotted protocol names to protocols, which loads protocol
+# files as their protocols are looked up.
+class Protocol_Index:
+  def __init__(self, pdir, protocol_files):
+    self.pdir = pdir
+    self._cache_dir = os.path.join(pdir, CACHE_DIR)
+    self._files = {} # dotted name -> protocol file
+    self._stamps = {} # protocol file -> [mtime, size]
+    self._protocols = {} # dotted name -> protocol, once loaded
+    self._loaded = set([]) # protocol files already executed
+
+    manifest = self._read_manifest()
+    entries = {}
+    for filename in protocol_files:
+      st = os.stat(os.path.join(pdir,filename))
+      self._stamps[filename] = [st.st_mtime, st.st_size]
+      entry = manifest.get(filename)
+      if entry is None or entry['stamp']!=self._stamps[filename]:
+        # New or changed, so we have to load it to see what's in it.
+        entry = {'stamp':self._stamps[filename], 'protocols':self._load(filename)}
+      entries[filename] = entry
+      for func_name in entry['protocols']:
+        name = dotted_name(str(filename), str(func_name))
+        logging.info('Providing protocol "'+name+'":')
+        self._files[name] = filename
+    if entries!=manifest:
+      self._write_manifest(entries)
+
+  def keys(self):
+    return self._files.keys()
+
+  def __iter__(self):
+    return iter(self._files)
+
+  def __len__(self):
+    return len(self._files)
+
+  def __contains__(self, name):
+    return name in self._files
+
+  def __getitem__(self, name):
+    if name not in self._protocols:
+      self._load(self._files[name]) # KeyError for unknown protocols
+    return self._protocols[name]
+
+  def items(self):
+    return [(name,self[name]) for name in self.keys()]
+
+  def _load(self, filename):
+    # Executes a protocol file (once) and returns the names of the protocols it defines.
+    filepath = os.path.join(self.pdir,filename)
+    logging.debug('Loading protocol file '+filepath)
+    scope = dict()
+    # using the same scope dict makes exec behave as if it's in the global
+    # namespace. Otherwise, import statements don't work. (Python quirk)
+    exec(self._code(filename), scope, scope)
+    self._loaded.add(filename)
+
+    # Now dig through the objects defined by the program and pick out all
+    # of the things that are protocol-decorated functions.
+    func_names = []
+    for (func_name,thing) in scope.items():
+      if isinstance(thing, protocol):
+        name = dotted_name(filename, func_name)
+        thing.dotted_name = name # so distributed workers can find it
+        self._protocols[name] = thing
+        func_names.append(func_name)
+    return sorted(func_names)
+
+  def _code(self, filename):
+    # Compiled code for a protocol file, from the cache if it's up to date.
+    filepath = os.path.join(self.pdir,filename)
+    stamp = self._stamps[filename]
+    key = hashlib.sha1(json.dumps([filename, sys.version])).hexdigest()
+    cached = os.path.join(self._cache_dir, key)
+    try:
+      with open(cached,'rb') as f:
+        (cached_stamp,code) = marshal.load(f)
+      if cached_stamp==stamp:
+        return code
+    except (IOError, EOFError, ValueError, TypeError):
+      pass # Not cached (or a corrupted cache file). Just compile it.
+    with open(filepath) as f:
+      # A bit faster, but more importantly, associates a filename to errors
+      code = compile(f.read(), filepath, 'exec')
+    self._store(cached, marshal.dumps((stamp,code)))
+    return code
+
+  def _read_manifest(self):
+    try:
+      with open(os.path.join(self._cache_dir,'manifest')) as f:
+        manifest = json.load(f)
+      if manifest.get('version')==MANIFEST_VERSION:
+        return manifest['files']
+    except (IOError, ValueError):
+      pass
+    return {}
+
+  def _write_manifest(self, entries):
+    self._store(os.path.join(self._cache_dir,'manifest'), json.dumps({'version':MANIFEST_VERSION, 'files':entries}))
+
+  def _store(self, path, contents):
+    # Writes a cache file, if we can. Other protos processes may be reading
+    # the cache at the same time, so files are replaced atomically.
+    try:
+      if not os.path.isdir(self._cache_dir):
+        os.makedirs(self._cache_dir)
+      (fd,tmp) = tempfile.mkstemp(prefix='.incoming_', dir=self._cache_dir)
+      with os.fdopen(fd,'wb') as f:
+        f.write(contents)
+      os.rename(tmp, path)
+    except (IOError, OSError) as e:
+      logging.debug('Could not write protocol cache: '+str(e))
@@ -1,5 +1,11 @@
 import sys
+import os
 import logging
+import inspect
+import signal
+import threading
+import multiprocessing
+import Queue
 import subprocess as sub
 
 from .data_bundles import Data_Bundle
@@ -12,6 +18,8 @@ class protocol:
     self._is_protocol = True
     self.function = function
     self.__name__ = str(function.__name__)+'-thunk'
+    self.dotted_name = None # set when loaded from the protocol directory
+    self.streaming = inspect.isgeneratorfunction(function) # see streams.py
   def __call__(self, *args, **kwargs):
     #logging.debug('proto func called')
     return self.function(*args,**kwargs)
@@ -35,3 +43,97 @@ def call(cmd):
   assert ret==0, 'Failed to run "'+cmd+'"'
   return (out,err)
 
+def call_many(cmds, jobs=None, stdout=None, stderr=None, timeout=None):
+  '''
+Runs a list of shell commands, up to jobs at a time (by default, one per
+processor), and returns their exit codes. Their output is never held in memory.
+stdout and stderr can each be a file name, which is formatted with the index of
+the command (e.g.- 'sim{0}.out'), or a function, which is called with the index
+and each line of output (one call at a time). By default, output is logged, like
+call() does. Commands still running after timeout seconds are killed. Like
+call(), this fails unless every command succeeds, but not until all of them
+have finished.
+'''
+  if jobs is None:
+    jobs = multiprocessing.cpu_count()
+  results = [None for cmd in cmds]
+  errors = []
+  todo = Queue.Queue()
+  for i in xrange(len(cmds)):
+    todo.put(i)
+  lock = threading.Lock() # for callbacks
+  def worker():
+    while True:
+      try:
+        i = todo.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = _call_one(i, cmds[i], stdout, stderr, timeout, lock)
+      except Exception as e:
+        errors.append(e)
+  threads = [threading.Thread(target=worker) for j in xrange(min(jobs,len(cmds)))]
+  for t in threads:
+    t.daemon = True
+    t.start()
+  for t in threads:
+    t.join()
+  if len(errors)>0:
+    raise errors[0]
+  failed = [cmds[i] for i in xrange(len(cmds)) if results[i]!=0]
+  assert len(failed)==0, 'Failed to run '+str(len(failed))+' of '+str(len(cmds))+' commands, including "'+failed[0]+'"'
+  return results
+
+def _call_one(i, cmd, stdout, stderr, timeout, lock):
+  logging.debug('Running "'+cmd+'"')
+  opened = []
+  readers = []
+  def destination(target, log):
+    # Returns what the command should write to, and who reads it if it's a pipe.
+    if isinstance(target, basestring):
+      f = open(target.format(i),'w')
+      opened.append(f)
+      return (f, None)
+    if target is None:
+      return (sub.PIPE, lambda line: log(line.rstrip('\n')))
+    return (sub.PIPE, lambda line: target(i, line))
+  try:
+    (out,out_reader) = destination(stdout, logging.debug)
+    (err,err_reader) = destination(stderr, logging.error)
+    # With a timeout, the command gets its own process group, so that anything
+    # the shell started can be killed along with it.
+    setsid = os.setsid if timeout is not None else None
+    proc = sub.Popen( cmd, shell=True, stdout=out, stderr=err, universal_newlines=True, preexec_fn=setsid )
+    for (pipe,reader) in [(proc.stdout,out_reader), (proc.stderr,err_reader)]:
+      if reader is not None:
+        t = threading.Thread(target=_pump, args=(pipe,reader,lock))
+        t.daemon = True
+        t.start()
+        readers.append(t)
+    expired = []
+    if timeout is not None:
+      def kill():
+        expired.append(True)
+        try:
+          os.killpg(proc.pid, signal.SIGKILL)
+        except OSError: # Already gone
+          pass
+      timer = threading.Timer(timeout, kill)
+      timer.start()
+    for t in readers:
+      t.join()
+    ret = proc.wait()
+    if timeout is not None:
+      timer.cancel()
+      if len(expired)>0:
+        logging.error('Killed "'+cmd+'" after '+str(timeout)+' seconds')
+  finally:
+    for f in opened:
+      f.close()
+  return ret
+
+def _pump(pipe, reader, lock):
+  for line in iter(pipe.readline, ''):
+    with lock:
+      reader(line)
+  pipe.close()
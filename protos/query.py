@@ -5,6 +5,58 @@ from .config import config
 from .storage import mechanisms as storage_mechanisms
 
 
+# Bundles found by a query are handles which only carry their metadata at first.
+# Their data and files are read from the datastore the first time they're used,
+# or all at once for a whole list of handles with prefetch(). Handles look like
+# the stored bundles they stand in for (b['metadata'], b['data'], b['files']),
+# so they can be used anywhere a stored bundle can, including as the _init of a
+# Data_Bundle.
+class Bundle_Handle:
+  def __init__(self, datastore, xid, found):
+    self._datastore = datastore
+    self._xid = xid
+    self._bundle = found # whatever parts of the bundle we have so far
+
+  @property
+  def id(self):
+    return str(self._bundle['metadata']['id'])
+
+  @property
+  def loaded(self):
+    return 'data' in self._bundle and 'files' in self._bundle
+
+  def keys(self):
+    return ['data','metadata','files']
+
+  def __contains__(self, key):
+    return key in self.keys()
+
+  def __getitem__(self, key):
+    if key not in self._bundle and key in self.keys():
+      prefetch([self])
+    return self._bundle[key]
+
+  def get(self, key, default=None):
+    if key not in self:
+      return default
+    return self[key]
+
+  def __repr__(self):
+    return '<bundle handle '+self.id+'>'
+
+def prefetch(handles):
+  ''' Reads the data and files of every handle given which doesn't have them yet, in one request per experiment. '''
+  groups = {}
+  for h in handles:
+    if not h.loaded:
+      groups.setdefault((id(h._datastore),h._xid),[]).append(h)
+  for hs in groups.values():
+    found = dict([(str(b['metadata']['id']),b) for b in hs[0]._datastore.read_bundles([h.id for h in hs], hs[0]._xid)])
+    for h in hs:
+      assert h.id in found, 'Bundle "'+h.id+'" is no longer in the datastore'
+      h._bundle = found[h.id]
+  return handles
+
 class Query_Result:
   def __init__(self, datastore=None, xid=None):
     self._datastore = datastore
@@ -18,11 +70,11 @@ class Query_Result:
     return self._datastore.read_experiment_metadata(self._xid)
 
   def search_bundles(self,pattern):
-    bundles = self._datastore.find_bundles(pattern, self._xid)
-    return bundles
+    bundles = self._datastore.find_bundle_metadata(pattern, self._xid)
+    return [Bundle_Handle(self._datastore, self._xid, b) for b in bundles]
 
   def exact_bundle(self,bid):
-    bundles = self._datastore.find_bundles({'metadata':{'id':str(bid)}}, self._xid)
+    bundles = self.search_bundles({'metadata':{'id':str(bid)}})
     if len(bundles)==0:
       logging.warn('No bundle id matched "'+str(bid)+'"')
       return None
@@ -34,10 +86,14 @@ class Query_Result:
     return bundles[0]
 
 
-def search_experiments(pattern):
+def search_experiments(pattern, since=None, until=None):
   assert config.storage in storage_mechanisms, 'Could not find a data storage adapter name "'+config.storage+'"'
   datastore = storage_mechanisms[config.storage]()
-  xids = list(datastore.find_experiments(pattern))
+  if since is None and until is None:
+    xids = list(datastore.find_experiments(pattern))
+  else:
+    # Only experiments run within a range of time (see protos.timestamp)
+    xids = list(datastore.find_experiments_between(pattern, since, until))
   return [Query_Result(datastore,xid) for xid in xids]
 
 def exact_experiment(xid):
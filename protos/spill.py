@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+import logging
+import os
+import os.path
+import marshal
+
+# Bundles stay in memory from the protocol that produces them until the last
+# protocol that uses them, which can be a long time for bundles used far
+# downstream. A spill area keeps the data of these live bundles within a memory
+# budget. Since the whole schedule is known in advance, when the budget is
+# exceeded, the data of the bundle whose next use is furthest away is written
+# to disk, and it is read back right before that use. Only a bundle's data
+# dictionary is spilled; the bundle object itself (metadata, files, and any
+# attributes a protocol-specific subclass adds) stays where it is.
+# Protocols don't necessarily run in schedule order (see _run_dataflow), so a
+# bundle's next use is the earliest schedule entry which hasn't finished with
+# it yet, as reported by done().
+class Spill_Area:
+  def __init__(self, directory, budget, uses):
+    self.directory = directory
+    self.budget = budget # bytes
+    self._uses = dict([(t,list(entries)) for (t,entries) in uses.items()]) # token id -> sorted schedule entries which still need the bundle
+    self._inputs = {} # schedule entry -> token ids it uses
+    for (t,entries) in uses.items():
+      for i in entries:
+        self._inputs.setdefault(i,[]).append(t)
+    self._loaded = {} # token id -> bundle with its data in memory
+    self._spilled = {} # token id -> bundle with its data on disk
+    self._sizes = {} # token id -> size of a bundle's data
+    self._used = 0
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def add(self, tok_id, bundle, now):
+    ''' Starts tracking a live bundle, which was produced by schedule entry now. '''
+    try:
+      self._sizes[tok_id] = len(marshal.dumps(bundle.data))
+    except ValueError:
+      # Only plain data can be written out, so this one stays in memory.
+      logging.debug('Bundle '+str(tok_id)+' cannot be spilled')
+      return
+    self._loaded[tok_id] = bundle
+    self._used += self._sizes[tok_id]
+    self._make_room(now)
+
+  def fetch(self, tok_id, now):
+    ''' Makes sure a bundle's data is in memory, for use by schedule entry now. '''
+    if tok_id in self._spilled:
+      bundle = self._spilled.pop(tok_id)
+      with open(self._path(tok_id),'rb') as f:
+        bundle.data = marshal.load(f)
+      os.remove(self._path(tok_id))
+      logging.debug('Reloaded bundle '+str(tok_id)+' ('+str(self._sizes[tok_id])+' bytes)')
+      self._loaded[tok_id] = bundle
+      self._used += self._sizes[tok_id]
+      self._make_room(now)
+
+  def done(self, sched):
+    ''' Schedule entry sched no longer needs any of its inputs. '''
+    for t in self._inputs.pop(sched,[]):
+      if sched in self._uses.get(t,[]):
+        self._uses[t].remove(sched)
+
+  def discard(self, tok_id):
+    if tok_id in self._loaded:
+      del self._loaded[tok_id]
+      self._used -= self._sizes[tok_id]
+    if tok_id in self._spilled:
+      del self._spilled[tok_id]
+      os.remove(self._path(tok_id))
+    self._sizes.pop(tok_id, None)
+
+  def _path(self, tok_id):
+    return os.path.join(self.directory, str(tok_id))
+
+  def _next_use(self, tok_id):
+    uses = self._uses.get(tok_id,[])
+    if len(uses)==0:
+      return None
+    return uses[0]
+
+  def _make_room(self, now):
+    # Spill the bundles needed furthest in the future first. Bundles used by
+    # the entry about to run have to stay, even if that busts the budget.
+    while self._used>self.budget:
+      candidates = [(self._next_use(t),t) for t in self._loaded if now not in self._uses.get(t,[])]
+      if len(candidates)==0:
+        logging.debug('Bundles needed right now exceed the memory budget')
+        return
+      (_,victim) = max(candidates, key=lambda c: (c[0] is None, c[0]))
+      bundle = self._loaded.pop(victim)
+      with open(self._path(victim),'wb') as f:
+        marshal.dump(bundle.data, f)
+      bundle.data = None
+      logging.debug('Spilled bundle '+str(victim)+' ('+str(self._sizes[victim])+' bytes)')
+      self._spilled[victim] = bundle
+      self._used -= self._sizes[victim]
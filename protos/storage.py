@@ -25,3 +25,9 @@ try:
   mechanisms['postgres'] = Postgres
 except Exception as e:
   logging.warn('Failed to import storage adapter Postgres: '+str(e)+'. Disabling adapter.')
+
+try:
+  from .storage_adapters.sqlite import Sqlite
+  mechanisms['sqlite'] = Sqlite
+except Exception as e:
+  logging.warn('Failed to import storage adapter Sqlite: '+str(e)+'. Disabling adapter.')
@@ -42,6 +42,24 @@ class Datastore: # Abstract interface class
     '''Returns a list of xid's for experiments that match the pattern given.'''
     raise NotImplementedError('Missing implementation in storage adapter')
 
+  def find_experiments_between(self, pattern, since=None, until=None):
+    ''' Optional. Like find_experiments, but only experiments whose 'time' metadata falls between the since and until timestamps (inclusive, either of which can be None) are returned. Timestamps can be shortened, so '2016-03' is all of March 2016. By default, this checks the metadata of every experiment matching the pattern.'''
+    found = []
+    for xid in self.find_experiments(pattern):
+      t = self.read_experiment_metadata(xid).get('time')
+      if t is None:
+        continue
+      if (since is None or t>=since) and (until is None or t[0:len(until)]<=until):
+        found.append(xid)
+    return found
+
+  def find_recent_experiments(self, pattern, count):
+    ''' Optional. Like find_experiments, but only the count experiments with the latest 'time' metadata are returned, most recent first. By default, this checks the metadata of every experiment matching the pattern.'''
+    found = []
+    for xid in self.find_experiments(pattern):
+      found.append( (self.read_experiment_metadata(xid).get('time',''), xid) ) # timestamps sort chronologically
+    return [xid for (t,xid) in sorted(found, reverse=True)[0:count]]
+
   def read_experiment_metadata(self, xid):
     '''Returns a JSON dictionary of metadata.'''
     raise NotImplementedError('Missing implementation in storage adapter')
@@ -50,14 +68,31 @@ class Datastore: # Abstract interface class
     ''' This should take a JSON dictionary of metadata and write it to the datastore, associated with the experiment as a whole. Bundles have their own metadata which is handled separately.'''
     raise NotImplementedError('Missing implementation in storage adapter')
 
+  def update_experiment_metadata(self, fields, xid):
+    ''' Optional. Like write_experiment_metadata, but only the fields given have changed, and all other fields should be left alone. Adapters which cannot do this more cheaply than a full write should leave this unimplemented.'''
+    raise NotImplementedError('Missing implementation in storage adapter')
+
   def find_bundles(self, pattern, xid):
     ''' Returns a list of data bundle objects.'''
     raise NotImplementedError('Missing implementation in storage adapter')
 
+  def find_bundle_metadata(self, pattern, xid):
+    ''' Optional. Like find_bundles, but only the metadata of each bundle is needed; data and files may be left out, and will be fetched with read_bundles if anyone asks for them. Adapters which can avoid reading whole bundles should override this; by default, it just calls find_bundles.'''
+    return self.find_bundles(pattern, xid)
+
+  def read_bundles(self, bids, xid):
+    ''' Returns a list of the complete bundles with the given ids, in any order. Adapters which can look up bundles by id should override this; by default, it searches every bundle in the experiment.'''
+    bids = set([str(bid) for bid in bids])
+    return [b for b in self.find_bundles({}, xid) if str(b['metadata']['id']) in bids]
+
   def write_bundle(self, bundle, xid):
     ''' This function should take a serialized bundle and write it to whatever backing store it uses.'''
     raise NotImplementedError('Missing implementation in storage adapter')
 
+  def write_bundles(self, bundles, xid):
+    ''' Writes a list of serialized bundles. Adapters which can batch writes should override this; by default, it just writes them one at a time.'''
+    return [self.write_bundle(bundle, xid) for bundle in bundles]
+
   def delete_experiment(self, xid):
     ''' Deletes a single experiment and all its associated data bundles. '''
     raise NotImplementedError('Missing implementation in storage adapter')
@@ -9,6 +9,9 @@ import shutil
 from ..config import config
 from ..time import timestamp
 from .adapters import Datastore, _json_subset
+from .disk_index import experiment_index, bundle_manifest
+from .disk_layout import project_layout, shard, move
+from .serialization import encode, decode, debugging
 
 class Disk(Datastore):
   def __init__(self):
@@ -23,38 +26,56 @@ class Disk(Datastore):
     self._project_path = os.path.join(config.data_dir, config.project_name)
     if not os.path.isdir(self._project_path):
       os.mkdir(self._project_path)
+    self._layout = project_layout(self._project_path)
 
   def create_experiment_id(self, experiment_name):
     # This is probably good enough to be unique. Don't run 1B parallel copies.
-    xid = experiment_name+'_'+timestamp()
-    # Check/create an experiment directory
-    xpath = self._get_xpath(xid)
-    if not os.path.isdir(xpath):
-      os.mkdir(xpath)
-    return xid
+    # (Sweeps do create ids in quick succession, though, so make sure.)
+    while True:
+      xid = experiment_name+'_'+timestamp()
+      # Check/create an experiment directory
+      xpath = self._get_xpath(xid)
+      try:
+        experiment_index(self._project_path).record(xid, None, change=lambda: self._mkdir(xpath), dirs=self._parents(xpath))
+        return xid
+      except OSError:
+        if not os.path.isdir(xpath):
+          raise
 
   def _get_xpath(self, xid):
-    xpath = os.path.join(self._project_path, xid)
-    return xpath
+    return self._layout.experiment_path(xid)
+
+  def _mkdir(self, path):
+    # Makes a directory (which shouldn't exist yet) inside a shard (which might).
+    if not os.path.isdir(os.path.dirname(path)):
+      try:
+        os.mkdir(os.path.dirname(path))
+      except OSError: # Someone else just made it
+        pass
+    os.mkdir(path)
+
+  def _parents(self, xpath):
+    # The directories (relative to the project) that change when an experiment
+    # directory is added or removed.
+    parent = os.path.dirname(xpath)
+    if parent==self._project_path:
+      return ['']
+    return ['', os.path.basename(parent)]
 
   def find_experiments(self, pattern):
-    project_dir = os.path.join(config.data_dir, config.project_name)
-    possible_experiments = os.listdir(project_dir)
-    found_experiments = []
-    for xdir in possible_experiments:
-      mdfile = reduce(os.path.join, [project_dir, xdir, 'metadata'])
-      if not os.path.isfile(mdfile):
-        continue # Someone's polluted the data directory
-      exp = {'metadata':json.load(open(mdfile,'r'))}
-      assert 'id' in exp['metadata'], 'Corrupted experiment metadata file'
-      if _json_subset(pattern, exp):
-        xid = exp['metadata']['id']
-        found_experiments.append(xid)
-    return found_experiments
+    # Searches an index of every experiment's metadata (see disk_index.py)
+    return experiment_index(self._project_path).find(pattern)
+
+  def find_experiments_between(self, pattern, since=None, until=None):
+    return experiment_index(self._project_path).find(pattern, since, until)
+
+  def find_recent_experiments(self, pattern, count):
+    return experiment_index(self._project_path).recent(pattern, count)
 
   def read_experiment_metadata(self, xid):
     metapath = os.path.join(self._get_xpath(xid), 'metadata')
-    metadata = json.load(open(metapath,'r'))
+    with open(metapath,'rb') as f:
+      metadata = decode(f.read())
     assert 'id' in metadata, 'Experiment metadata file is corrupted'
     return metadata
 
@@ -62,33 +83,106 @@ class Disk(Datastore):
     # XID is the path to the experiment directory
     # FYI: Blows away previous metadata, even if it had more information.
     metapath = os.path.join(self._get_xpath(xid), 'metadata')
-    f = open(metapath,'w')
-    logging.debug('Writing experiment metadata to disk:\n'+json.dumps(metadata,indent=2))
-    json.dump(metadata,f,indent=2)
+    if debugging():
+      logging.debug('Writing experiment metadata to disk:\n'+json.dumps(metadata,indent=2))
+    with open(metapath,'wb') as f:
+      f.write(encode(metadata))
+    experiment_index(self._project_path).record(xid, metadata)
 
   def find_bundles(self, pattern, xid):
     xpath = self._get_xpath(xid)
-    fnames = os.listdir(xpath)
-    assert 'metadata' in fnames, 'Bad experiment id: '+str(xid)+' (no metadata)'
-    fnames.remove('metadata')
-    candidates = [json.load(open(os.path.join(xpath,f),'r')) for f in fnames]
-    return [b for b in candidates if _json_subset(pattern,b)]
+    assert os.path.isfile(os.path.join(xpath,'metadata')), 'Bad experiment id: '+str(xid)+' (no metadata)'
+    md = pattern.get('metadata',{}) if type(pattern) is dict else {}
+    if type(md) is dict and 'id' in md:
+      # Bundle files are named by their ids, so there's no need to search.
+      return self._read_matching([md['id']], xid, pattern)
+    # Otherwise, only bundles whose metadata matches are read.
+    manifest = bundle_manifest(xpath, self._layout)
+    missing = []
+    bundles = self._read_matching([b['id'] for b in manifest.find(pattern)], xid, pattern, missing)
+    if len(missing)>0 and manifest.trusted():
+      # It lists bundles that aren't there, so it can't be trusted to list all
+      # of the ones that are, either.
+      logging.warning('The manifest of '+xpath+' disagrees with its bundle files. Searching them instead.')
+      manifest.distrust()
+      return self.find_bundles(pattern, xid)
+    return bundles
+
+  def find_bundle_metadata(self, pattern, xid):
+    md = pattern.get('metadata',{}) if type(pattern) is dict else {}
+    if type(pattern) is dict and set(pattern.keys())<=set(['metadata']) and 'id' not in md:
+      # The manifest has everything we need.
+      xpath = self._get_xpath(xid)
+      assert os.path.isfile(os.path.join(xpath,'metadata')), 'Bad experiment id: '+str(xid)+' (no metadata)'
+      return [{'metadata':b} for b in bundle_manifest(xpath, self._layout).find(pattern)]
+    return self.find_bundles(pattern, xid)
+
+  def read_bundles(self, bids, xid):
+    return self._read_matching(bids, xid, {})
+
+  def _read_matching(self, bids, xid, pattern, missing=None):
+    # Bundle files are named by their ids. The ids of any that don't exist are
+    # added to missing, if it's given.
+    xpath = self._get_xpath(xid)
+    bundles = []
+    for bid in bids:
+      bpath = self._layout.bundle_path(xpath, bid)
+      if str(bid).startswith('.') or not os.path.isfile(bpath):
+        if missing is not None:
+          missing.append(bid)
+        continue
+      with open(bpath,'rb') as f:
+        b = decode(f.read())
+      if _json_subset(pattern,b):
+        bundles.append(b)
+    return bundles
 
   def write_bundle(self, bundle, xid):
     assert 'metadata' in bundle, 'Data bundle corrupted? No metadata found.'
     assert 'id' in bundle['metadata'], 'Data bundle corrupted? No ID in metadata.'
     bundle_id = bundle['metadata']['id']
 
-    f = open(os.path.join(self._get_xpath(xid), bundle_id), 'w')
-    logging.debug('Writing data bundle to disk:\n'+json.dumps(bundle,indent=2))
-    json.dump(bundle,f,indent=2)
+    if debugging():
+      logging.debug('Writing data bundle to disk:\n'+json.dumps(bundle,indent=2))
+    xpath = self._get_xpath(xid)
+    bpath = self._layout.bundle_path(xpath, bundle_id)
+    if not os.path.isdir(os.path.dirname(bpath)):
+      try:
+        os.mkdir(os.path.dirname(bpath))
+      except OSError: # Someone else just made it
+        pass
+    with open(bpath, 'wb') as f:
+      f.write(encode(bundle))
+    bundle_manifest(xpath, self._layout).record(bundle_id, bundle['metadata'])
 
 
   def delete_experiment(self, xid):
     xpath = self._get_xpath(xid)
     assert os.path.isdir(xpath), 'Experiment does not exist'
-    shutil.rmtree(xpath)
+    experiment_index(self._project_path).record(xid, None, change=lambda: shutil.rmtree(xpath), dirs=self._parents(xpath))
     if os.path.isdir(xpath):
       logging.error('Failed to delete experiment '+str(xid)+' at '+str(xpath))
       return False
     return True
+
+  def migrate_layout(self):
+    ''' Moves a flat project into the sharded layout (see disk_layout.py), in place. Experiments shouldn't be run in the project until this finishes, but it can be interrupted and run again. Returns the number of experiments moved. '''
+    # The project is only marked as sharded once everything has moved (below),
+    # so if this is interrupted, readers still check manifests against the
+    # bundle files, and look for everything in both layouts.
+    moved = 0
+    for xpath in self._layout.experiment_paths():
+      xid = os.path.basename(xpath)
+      # Sharded manifests aren't checked against the bundle files, so they'd
+      # better be complete.
+      bundle_manifest(xpath, self._layout).complete()
+      for bid in self._layout.bundle_ids(xpath):
+        if os.path.isfile(os.path.join(xpath,bid)):
+          move(os.path.join(xpath,bid), os.path.join(xpath,shard(bid),bid))
+      dst = os.path.join(self._project_path, shard(xid), xid)
+      if xpath!=dst:
+        move(xpath, dst)
+        moved += 1
+    self._layout.set_sharded()
+    # The experiment index notices everything moved, and rebuilds itself.
+    return moved
@@ -0,0 +1,375 @@
+from __future__ import absolute_import
+import os
+import os.path
+import logging
+import json
+import fcntl
+import bisect
+import tempfile
+
+from .adapters import _json_subset
+from .serialization import decode
+from .disk_layout import project_layout
+
+# Finding experiments on disk means reading the metadata file of every
+# experiment in the project, which takes a long time once there are a lot of
+# them (especially over NFS). So the Disk adapter keeps an index of every
+# experiment's metadata in the project directory, under .index/:
+#   experiments : a snapshot of the index
+#   journal : changes since the snapshot, one JSON record per line
+# Writing metadata appends to the journal, and the journal is folded into the
+# snapshot once it gets long. Everything is done while holding a lock on the
+# index, so several protos processes can share a data directory. Searches only
+# need a shared lock, unless they find the snapshot needs rewriting.
+#
+# Changes made by anything other than protos (deleting an experiment directory
+# by hand, an older version of protos) aren't journaled. To notice them, the
+# index keeps track of the modification times of the directories experiment
+# directories are in (the project directory, and its shards; see
+# disk_layout.py), which change whenever an experiment directory is created or
+# removed. Protos journals the times just before and after its own changes; if
+# those don't line up with what the index expected, something else happened in
+# between, and the index is rebuilt from the metadata files. (Editing a
+# metadata file in place by hand doesn't change any directories, so it isn't
+# noticed.)
+INDEX_DIR = '.index'
+INDEX_VERSION = 2
+COMPACT_AFTER = 4*1024*1024 # bytes of journal before it's folded into the snapshot
+
+class _index_lock:
+  # Python context which holds an exclusive (or shared) lock on an index, given
+  # its lock file. Evaluates to False if the index can't be written (e.g.- a
+  # read-only data directory).
+  def __init__(self, lock_path, shared=False):
+    self.lock_path = lock_path
+    self.shared = shared
+    self._f = None
+  def __enter__(self):
+    try:
+      if not os.path.isdir(os.path.dirname(self.lock_path)):
+        os.makedirs(os.path.dirname(self.lock_path))
+      self._f = open(self.lock_path,'a+') # shared locks need read access
+    except (IOError, OSError):
+      return False
+    fcntl.lockf(self._f, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX) # works on NFS, unlike flock
+    return True
+  def __exit__(self, type, value, traceback):
+    if self._f is not None:
+      self._f.close() # also releases the lock
+    return False
+
+class Experiment_Index:
+  def __init__(self, project_path):
+    self.project_path = project_path
+    self._dir = os.path.join(project_path, INDEX_DIR)
+    self._snapshot_path = os.path.join(self._dir, 'experiments')
+    self._journal_path = os.path.join(self._dir, 'journal')
+    self._lock_path = os.path.join(self._dir, 'lock')
+    self._snapshot = None # identity of the snapshot file we've read
+    self._offset = 0 # bytes of the journal we've read
+    self._stamps = {} # directory (relative to the project) -> modification time, as far as we know
+    self._stale = True
+    self._experiments = {} # xid -> metadata
+    self._by_name = {} # experiment name -> xids
+    self._by_tag = {} # tag -> xids
+    self._by_time = None # sorted (time, xid) pairs, built when needed
+
+  def find(self, pattern, since=None, until=None):
+    ''' Returns the ids of experiments whose metadata matches pattern and whose time is within [since, until]. '''
+    with _index_lock(self._lock_path, shared=True) as writable:
+      rewrite = self._refresh(writable, exclusive=False)
+    if rewrite:
+      # Someone else may get there first, so start over once we have it to ourselves.
+      with _index_lock(self._lock_path) as writable:
+        self._refresh(writable)
+    md = pattern.get('metadata',{}) if isinstance(pattern,dict) else {}
+    candidates = None
+    if not isinstance(md,dict):
+      candidates = [] # nothing matches a malformed pattern
+    else:
+      if 'id' in md:
+        candidates = [md['id']] if md['id'] in self._experiments else []
+      if 'name' in md:
+        candidates = self._narrow(candidates, self._by_name.get(md['name'],[]))
+      if isinstance(md.get('tags'),list):
+        for tag in md['tags']:
+          candidates = self._narrow(candidates, self._by_tag.get(tag,[]))
+    if since is not None or until is not None:
+      candidates = self._narrow(candidates, self._between(since, until))
+    if candidates is None:
+      candidates = self._experiments.keys()
+    return [xid for xid in candidates if _json_subset(pattern, {'metadata':self._experiments[xid]})]
+
+  def recent(self, pattern, count):
+    ''' Returns the ids of the count most recent experiments whose metadata matches pattern, newest first. '''
+    found = [(self._experiments[xid].get('time',''),xid) for xid in self.find(pattern)]
+    return [xid for (t,xid) in sorted(found, reverse=True)[0:count]]
+
+  def _narrow(self, candidates, xids):
+    if candidates is None:
+      return list(xids)
+    xids = set(xids)
+    return [xid for xid in candidates if xid in xids]
+
+  def _between(self, since, until):
+    if self._by_time is None:
+      self._by_time = sorted([(md['time'],xid) for (xid,md) in self._experiments.items() if 'time' in md])
+    lo = 0
+    hi = len(self._by_time)
+    if since is not None:
+      lo = bisect.bisect_left(self._by_time, (since,))
+    if until is not None:
+      hi = bisect.bisect_left(self._by_time, (unicode(until)+u'\uffff',)) # anything starting with until
+    return [xid for (t,xid) in self._by_time[lo:hi]]
+
+  def stamp(self, d):
+    try:
+      return os.stat(os.path.join(self.project_path,d)).st_mtime
+    except OSError:
+      return None
+
+  def record(self, xid, metadata, change=None, dirs=('',)):
+    ''' Journals new metadata for an experiment (None if it has none, or was deleted). If creating or removing the experiment's directory, pass a function which does that as change, so it's done while the index is locked, along with the directories (relative to the project) it changes. '''
+    entry = {'id':xid, 'metadata':metadata}
+    with _index_lock(self._lock_path) as writable:
+      if change is not None:
+        before = [self.stamp(d) for d in dirs]
+        change()
+        entry['stamps'] = dict([(d,[b,self.stamp(d)]) for (d,b) in zip(dirs,before)])
+      if not writable or not os.path.isfile(self._snapshot_path):
+        return False # The next search builds it from scratch anyway.
+      with open(self._journal_path,'a') as f:
+        f.write(json.dumps(entry)+'\n')
+    return True
+
+  def _refresh(self, writable, exclusive=True):
+    # Catches up with changes made since we last looked. Must hold the lock.
+    # With only a shared lock, stops short of rewriting the snapshot, and
+    # returns True if it needs to be.
+    try:
+      st = os.stat(self._snapshot_path)
+      snapshot = (st.st_ino, st.st_mtime, st.st_size)
+    except OSError:
+      snapshot = None
+    if snapshot is None or snapshot!=self._snapshot or self._journal_size()<self._offset:
+      self._load_snapshot(snapshot)
+    if not self._stale:
+      self._read_journal()
+    if not self._stale and any([self.stamp(d)!=t for (d,t) in self._stamps.items()]):
+      logging.info('Experiment index for '+self.project_path+' is out of date')
+      self._stale = True
+    if self._stale:
+      if writable and not exclusive:
+        return True
+      self._rebuild(writable)
+    elif writable and self._offset>COMPACT_AFTER:
+      if not exclusive:
+        return True
+      self._write_snapshot()
+    return False
+
+  def _journal_size(self):
+    try:
+      return os.stat(self._journal_path).st_size
+    except OSError:
+      return 0
+
+  def _load_snapshot(self, snapshot):
+    self._reset()
+    self._snapshot = snapshot
+    self._stale = True
+    if snapshot is None:
+      return
+    try:
+      with open(self._snapshot_path) as f:
+        contents = json.load(f)
+    except (IOError, ValueError):
+      return
+    if contents.get('version')!=INDEX_VERSION:
+      return
+    for (xid,md) in contents['experiments'].items():
+      self._apply(xid, md)
+    self._stamps = contents['stamps']
+    self._stale = False
+
+  def _read_journal(self):
+    try:
+      with open(self._journal_path) as f:
+        f.seek(self._offset)
+        lines = f.read()
+    except IOError:
+      return
+    for line in lines.splitlines(True):
+      if not line.endswith('\n'):
+        break # Half-written (someone crashed). Caught by the stamp check if it matters.
+      self._offset += len(line)
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        self._stale = True
+        return
+      for (d,(before,after)) in entry.get('stamps',{}).items():
+        if before!=self._stamps.get(d):
+          self._stale = True # Something changed the project behind our backs
+        self._stamps[d] = after
+      self._apply(entry['id'], entry['metadata'])
+
+  def _reset(self):
+    self._offset = 0
+    self._stamps = {}
+    self._experiments = {}
+    self._by_name = {}
+    self._by_tag = {}
+    self._by_time = None
+
+  def _apply(self, xid, metadata):
+    old = self._experiments.pop(xid, None)
+    if old is not None:
+      self._by_name.get(old.get('name'),set([])).discard(xid)
+      for tag in old.get('tags',[]):
+        self._by_tag.get(tag,set([])).discard(xid)
+    if metadata is not None:
+      self._experiments[xid] = metadata
+      self._by_name.setdefault(metadata.get('name'),set([])).add(xid)
+      for tag in metadata.get('tags',[]):
+        self._by_tag.setdefault(tag,set([])).add(xid)
+    self._by_time = None
+
+  def _rebuild(self, writable):
+    # Reads every experiment's metadata file, the slow way.
+    logging.info('Rebuilding experiment index for '+self.project_path)
+    self._reset()
+    layout = project_layout(self.project_path)
+    # Before we look, so anything after is noticed
+    self._stamps = dict([(d,self.stamp(d)) for d in layout.experiment_dirs()])
+    for xpath in layout.experiment_paths():
+      with open(os.path.join(xpath,'metadata'),'rb') as f:
+        metadata = decode(f.read())
+      assert 'id' in metadata, 'Corrupted experiment metadata file'
+      self._apply(metadata['id'], metadata)
+    if writable:
+      self._write_snapshot()
+    # Otherwise, we'll just have to do this again next time.
+
+  def _write_snapshot(self):
+    # Must hold the lock.
+    contents = json.dumps({'version':INDEX_VERSION, 'stamps':self._stamps, 'experiments':self._experiments})
+    try:
+      (fd,tmp) = tempfile.mkstemp(prefix='.incoming_', dir=self._dir)
+      with os.fdopen(fd,'w') as f:
+        f.write(contents)
+      os.rename(tmp, self._snapshot_path)
+      open(self._journal_path,'w').close() # folded into the snapshot
+    except (IOError, OSError) as e:
+      logging.warning('Could not write experiment index: '+str(e))
+      self._stale = True
+      return
+    st = os.stat(self._snapshot_path)
+    self._snapshot = (st.st_ino, st.st_mtime, st.st_size)
+    self._offset = 0
+    self._stale = False
+
+# Finding bundles has the same problem within an experiment, so each experiment
+# directory has a manifest of its bundles' metadata (.manifest), one JSON record
+# per line, appended to whenever a bundle is written. In flat projects, bundles
+# that are missing from it (written by an older version of protos, say) are
+# added the first time anyone searches the experiment, and bundles whose files
+# are gone are ignored. Checking that means listing every shard in sharded
+# projects, though, and only protos writes to those, so there the manifest is
+# taken at its word, unless it turns out to list a bundle that isn't there.
+# (Migrating a project completes its manifests first, and only marks the
+# project as sharded once every experiment has moved.)
+MANIFEST = '.manifest'
+
+class Bundle_Manifest:
+  def __init__(self, xpath, layout):
+    self.xpath = xpath
+    self.layout = layout
+    self._path = os.path.join(xpath, MANIFEST)
+    self._lock_path = os.path.join(xpath, MANIFEST+'.lock')
+    self._file = None # identity of the manifest file we've read
+    self._offset = 0 # bytes of it we've read
+    self._bundles = {} # bundle id -> metadata
+    self._distrusted = False
+
+  def trusted(self):
+    ''' True if searches take the manifest at its word, rather than checking it against the bundle files. '''
+    return self.layout.sharded and not self._distrusted
+
+  def distrust(self):
+    ''' Checks the manifest against the bundle files from now on. '''
+    self._distrusted = True
+
+  def find(self, pattern):
+    ''' Returns the metadata of every bundle whose metadata matches pattern. Only the metadata part of the pattern is checked. '''
+    self._refresh()
+    md_pattern = {'metadata':pattern.get('metadata',{})}
+    if self.trusted() and self._file is not None:
+      return [md for md in self._bundles.values() if _json_subset(md_pattern, {'metadata':md})]
+    self.complete()
+    return [md for (bid,md) in self._bundles.items() if bid in self._stored and _json_subset(md_pattern, {'metadata':md})]
+
+  def complete(self):
+    ''' Adds any bundles missing from the manifest. '''
+    self._refresh()
+    self._stored = set(self.layout.bundle_ids(self.xpath))
+    missing = [bid for bid in self._stored if bid not in self._bundles]
+    if len(missing)>0:
+      logging.debug('Adding '+str(len(missing))+' bundles to the manifest of '+self.xpath)
+      entries = []
+      for bid in missing:
+        with open(self.layout.bundle_path(self.xpath,bid),'rb') as f:
+          md = decode(f.read())['metadata']
+        self._bundles[bid] = md
+        entries.append({'id':bid, 'metadata':md})
+      self._append(entries)
+
+  def record(self, bid, metadata):
+    ''' Adds a newly written bundle to the manifest. '''
+    self._append([{'id':bid, 'metadata':metadata}])
+
+  def _append(self, entries):
+    with _index_lock(self._lock_path) as writable:
+      if not writable:
+        return False # Fine, we'll just have to read those bundles again.
+      try:
+        with open(self._path,'a') as f:
+          f.write(''.join([json.dumps(entry)+'\n' for entry in entries]))
+      except IOError:
+        return False
+    return True
+
+  def _refresh(self):
+    # Reads whatever's been added since we last looked.
+    try:
+      st = os.stat(self._path)
+    except OSError:
+      (self._file, self._offset, self._bundles) = (None, 0, {})
+      return
+    if (st.st_ino, st.st_dev)!=self._file or st.st_size<self._offset:
+      self._file = (st.st_ino, st.st_dev)
+      self._offset = 0
+      self._bundles = {}
+    with open(self._path) as f:
+      f.seek(self._offset)
+      lines = f.read()
+    for line in lines.splitlines(True):
+      if not line.endswith('\n'):
+        break # Still being written
+      self._offset += len(line)
+      entry = json.loads(line)
+      self._bundles[entry['id']] = entry['metadata']
+
+# Adapters are created all the time, so they share indexes and manifests.
+_indexes = {}
+_manifests = {}
+
+def experiment_index(project_path):
+  if project_path not in _indexes:
+    _indexes[project_path] = Experiment_Index(project_path)
+  return _indexes[project_path]
+
+def bundle_manifest(xpath, layout):
+  if xpath not in _manifests:
+    _manifests[xpath] = Bundle_Manifest(xpath, layout)
+  return _manifests[xpath]
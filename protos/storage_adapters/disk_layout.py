@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+import os
+import os.path
+import logging
+import json
+import hashlib
+
+# Where the Disk adapter keeps things.
+# Originally, every experiment directory went straight into the project
+# directory, and every bundle file straight into its experiment's directory.
+# Directories with tens of thousands of entries are slow to search, especially
+# on network filesystems, so projects are now sharded instead:
+#   project/<shard>/<experiment id>/<shard>/<bundle id>
+# where a shard is the first two hex digits of a hash of the name, so there are
+# at most 256 shards per directory. A project's layout is recorded in its
+# .layout file; projects without one are flat. Migrating a project (see
+# Disk.migrate_layout) only writes it once every experiment has moved, so an
+# interrupted migration leaves the project flat. Since a project can be in the
+# middle of being migrated, anything that isn't where the layout says it should
+# be is looked for in the other layout, too.
+LAYOUT_FILE = '.layout'
+SHARD_CHARS = 2
+
+def shard(name):
+  return hashlib.sha1(str(name)).hexdigest()[0:SHARD_CHARS]
+
+def _is_shard(path):
+  name = os.path.basename(path)
+  return len(name)==SHARD_CHARS and all([c in '0123456789abcdef' for c in name]) and os.path.isdir(path)
+
+class Project_Layout:
+  def __init__(self, project_path):
+    self.project_path = project_path
+    self.sharded = False
+    marker = os.path.join(project_path, LAYOUT_FILE)
+    if os.path.isfile(marker):
+      with open(marker) as f:
+        self.sharded = json.load(f).get('layout')=='sharded'
+    elif len([f for f in os.listdir(project_path) if not f.startswith('.')])==0:
+      # New projects start out sharded.
+      self.set_sharded()
+
+  def set_sharded(self):
+    with open(os.path.join(self.project_path, LAYOUT_FILE),'w') as f:
+      json.dump({'layout':'sharded', 'shard_chars':SHARD_CHARS}, f)
+    self.sharded = True
+
+  def experiment_path(self, xid):
+    flat = os.path.join(self.project_path, str(xid))
+    sharded = os.path.join(self.project_path, shard(xid), str(xid))
+    (first,second) = (sharded,flat) if self.sharded else (flat,sharded)
+    if not os.path.isdir(first) and os.path.isdir(second):
+      return second
+    return first
+
+  def experiment_dirs(self):
+    ''' Directories containing experiment directories, relative to the project. '''
+    dirs = ['']
+    for name in os.listdir(self.project_path):
+      if _is_shard(os.path.join(self.project_path,name)):
+        dirs.append(name)
+    return dirs
+
+  def experiment_paths(self):
+    ''' Every experiment directory in the project. '''
+    paths = []
+    for d in self.experiment_dirs():
+      parent = os.path.join(self.project_path, d)
+      for name in os.listdir(parent):
+        if os.path.isfile(os.path.join(parent, name, 'metadata')):
+          paths.append(os.path.join(parent, name))
+    return paths
+
+  def bundle_path(self, xpath, bid):
+    flat = os.path.join(xpath, str(bid))
+    sharded = os.path.join(xpath, shard(bid), str(bid))
+    (first,second) = (sharded,flat) if self.sharded else (flat,sharded)
+    if not os.path.isfile(first) and os.path.isfile(second):
+      return second
+    return first
+
+  def bundle_ids(self, xpath):
+    ''' The ids of every bundle stored in an experiment directory. '''
+    ids = []
+    for name in os.listdir(xpath):
+      if name=='metadata' or name.startswith('.'):
+        continue
+      path = os.path.join(xpath, name)
+      if _is_shard(path):
+        ids.extend([bid for bid in os.listdir(path) if not bid.startswith('.')])
+      else:
+        ids.append(name)
+    return ids
+
+# Layouts are shared by every adapter for the same project.
+_layouts = {}
+
+def project_layout(project_path):
+  if project_path not in _layouts:
+    _layouts[project_path] = Project_Layout(project_path)
+  return _layouts[project_path]
+
+def move(src, dst):
+  if not os.path.isdir(os.path.dirname(dst)):
+    os.makedirs(os.path.dirname(dst))
+  os.rename(src, dst)
@@ -4,6 +4,7 @@ import json
 from ..config import config
 from ..time import timestamp
 from .adapters import Datastore
+from .serialization import debugging
 
 class Fake(Datastore):
   def __init__(self):
@@ -18,14 +19,19 @@ class Fake(Datastore):
     logging.debug('READ EXP-METADATA: '+str(xid))
     return {}
   def write_experiment_metadata(self, metadata, xid):
-    logging.debug('WRITE EXP-METADATA: '+json.dumps(metadata))
+    if debugging():
+      logging.debug('WRITE EXP-METADATA: '+json.dumps(metadata))
+  def update_experiment_metadata(self, fields, xid):
+    if debugging():
+      logging.debug('UPDATE EXP-METADATA: '+json.dumps(fields))
   def find_bundles(self, pattern, xid):
     logging.debug('FIND BUNDLES: '+str(pattern))
     return []
   def write_bundle(self, bundle, xid):
-    logging.debug('BUNDLE:')
-    logging.debug('DATA: '+json.dumps(bundle['data']))
-    logging.debug('METADATA: '+json.dumps(bundle['metadata']))
-    logging.debug('FILES: '+json.dumps(bundle['files']))
+    if debugging():
+      logging.debug('BUNDLE:')
+      logging.debug('DATA: '+json.dumps(bundle['data']))
+      logging.debug('METADATA: '+json.dumps(bundle['metadata']))
+      logging.debug('FILES: '+json.dumps(bundle['files']))
   def delete_experiment(self, xid):
     logging.debug('DELETE EXP: '+str(xid))
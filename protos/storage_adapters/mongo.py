@@ -96,6 +96,11 @@ class Mongo(Datastore):
     results = self._proj.find(query,projection) # returns Cursor object
     return [str(result['_id']) for result in results]
 
+  def find_recent_experiments(self, pattern, count):
+    query = self._pattern_to_query(pattern)
+    results = self._proj.find(query,{}).sort('metadata.time',pymongo.DESCENDING).limit(count)
+    return [str(result['_id']) for result in results]
+
   def read_experiment_metadata(self, xid):
     query = {'_id': bson.objectid.ObjectId(xid)}
     projection = {'_id': 0, 'metadata': 1}
@@ -111,6 +116,12 @@ class Mongo(Datastore):
     logging.debug('Wrote new experiment metadata:\n'+str(new_md))
     return True
 
+  def update_experiment_metadata(self, fields, xid):
+    changes = dict([('metadata.'+k,v) for (k,v) in fields.items()])
+    new_md = self._proj.update( {'_id':bson.objectid.ObjectId(xid)}, {'$set': changes} )
+    logging.debug('Updated experiment metadata:\n'+str(new_md))
+    return True
+
   def find_bundles(self, pattern, xid):
     # I can't find a good native way to do this in MongoDB, given that bundles
     # are implemented as subdocuments.
@@ -127,7 +138,33 @@ class Mongo(Datastore):
     # Filter and return
     return [b for b in bundles if _json_subset(pattern,b)]
  
+  def find_bundle_metadata(self, pattern, xid):
+    if 'data' in pattern or 'files' in pattern:
+      return self.find_bundles(pattern, xid)
+    # Leave the data and files on the server.
+    agg_results = self._proj.aggregate([
+        {'$match': { '_id': bson.objectid.ObjectId(xid) }},
+        {'$unwind': '$bundles'},
+        {'$project': {'bundles.metadata': 1}}],
+      cursor={})
+    bundles = [r['bundles'] for r in agg_results]
+    return [b for b in bundles if _json_subset(pattern,b)]
+
+  def read_bundles(self, bids, xid):
+    agg_results = self._proj.aggregate([
+        {'$match': { '_id': bson.objectid.ObjectId(xid) }},
+        {'$unwind': '$bundles'},
+        {'$match': { 'bundles.metadata.id': {'$in': [str(bid) for bid in bids]} }},
+        {'$project': {'bundles': 1}}],
+      cursor={})
+    return [r['bundles'] for r in agg_results]
+
   def write_bundle(self, bundle, xid):
     self._reconnect()
     bundle_id = self._proj.update( {'_id':bson.objectid.ObjectId(xid)}, {'$push': {'bundles': bundle}} )
     return True
+
+  def write_bundles(self, bundles, xid):
+    self._reconnect()
+    self._proj.update( {'_id':bson.objectid.ObjectId(xid)}, {'$push': {'bundles': {'$each': bundles}}} )
+    return True
@@ -6,6 +6,8 @@ import pwd
 import re
 import logging
 import json
+import time
+import threading
 import psycopg2 as pg
 import psycopg2.extras as extras
 from datetime import datetime
@@ -13,6 +15,7 @@ from datetime import datetime
 from ..config import config
 from ..time import timestamp
 from .adapters import Datastore, _json_subset
+from .serialization import encode_text, decode_text
 
 # Currently, everything is a strong.
 # This is an odd choice, but not every storage adapter has the right types,
@@ -26,13 +29,55 @@ EXP_METADATA_FIELDS=[
   ('time','varchar(256)'),
   ('tags','varchar(1024)'),
   ('progress','varchar(10)'),
-  ('last_error','varchar(256)')
+  ('eta','varchar(256)'),
+  ('last_error','varchar(256)'),
+  ('resources','text'),
+  ('sweep','text'),
 ]
 BDL_METADATA_FIELDS=[
   ('id','varchar(256)'),
   ('bundle_type','varchar(256)'),
   ('time','varchar(256)'),
+  ('cache_key','varchar(64)'),
+  ('cost_key','varchar(64)'),
+  ('resources','text'),
 ]
+# Structured metadata values are stored as JSON strings.
+JSON_METADATA_FIELDS=['resources','sweep']
+
+# Every operation is one round trip to the server, which matters a lot more
+# than anything else when the server is far away. Sessions are in autocommit
+# mode, so each statement is its own transaction (and committing is free);
+# operations which change several rows or tables do it in a single statement.
+# A session's role is chosen once, when it connects: rw_group if the user is
+# allowed, ro_group otherwise. Sessions count their round trips, and adapters
+# keep the count for the last call of each operation, so tests can catch
+# regressions.
+class Counting_Cursor(extras.DictCursor):
+  def execute(self, sql, args=None):
+    self.connection.round_trips += 1
+    return extras.DictCursor.execute(self, sql, args)
+
+class Session(pg.extensions.connection):
+  def __init__(self, *args, **kwargs):
+    pg.extensions.connection.__init__(self, *args, **kwargs)
+    self.round_trips = 0
+    self.role = None
+    # (The autocommit attribute is newer than some distro packages of psycopg2.)
+    self.set_isolation_level(pg.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+  def choose_role(self):
+    for role in ['rw_group','ro_group']:
+      try:
+        with Transaction(self) as x:
+          sql = 'SET ROLE '+role
+          logging.debug('PostgreSQL: '+str(sql))
+          x.execute(sql)
+        self.role = role
+        return role
+      except pg.ProgrammingError as e:
+        logging.debug('PostgreSQL: cannot use role '+role+': '+str(e))
+    raise pg.ProgrammingError('User cannot use either the rw_group or ro_group role')
 
 # Psycopg 2.5 has something similar built-in, but several distro packages only
 # have version 2.4. So we write our own.
@@ -41,7 +86,7 @@ class Transaction():
     self._conn = connection
     self._cur = None
   def __enter__(self):
-    self._cur = self._conn.cursor(cursor_factory=extras.DictCursor)
+    self._cur = self._conn.cursor(cursor_factory=Counting_Cursor)
     return self._cur # to the bound variable in the with block
   def __exit__(self, exc_type, exc_value, trace):
     if exc_type is None: # No error
@@ -56,87 +101,175 @@ def _sanitize(s):
   # (*only* variable-name-like characters are allowed)
   return re.sub(r'\W','',s)
 
-class Postgres(Datastore):
-  def __init__(self, init=True):
-    self._conn = None
-    self._connect()
-    if init:
-      self._init_project_idempotently(config.project_name)
-    pass
-
-  def _disconnect(self):
-    if self._conn is not None:
-      self._conn.close()
+def _experiment_columns(metadata):
+  # Returns the experiment table columns and values to store for some metadata.
+  colnames = [col for (col,typ) in EXP_METADATA_FIELDS]
+  mdnames = metadata.keys()
+  # Only write valid MD values
+  names = list(set(colnames)&set(mdnames))
+  # If we try to write an MD field we don't know about, alert us to the problem
+  if( len(names)<len(mdnames) ):
+    logging.warning('Unknown metadata fields "'+str( set(mdnames)-set(colnames) )+'"')
+  mdvalues = dict(metadata) # copy
+  # FIXME: patch tags (this is a hack)
+  if 'tags' in mdvalues:
+    mdvalues['tags'] = json.dumps(mdvalues['tags'])
+  for k in JSON_METADATA_FIELDS:
+    if k in mdvalues:
+      mdvalues[k] = json.dumps(mdvalues[k])
+  values = [str(mdvalues[n]) for n in names]
+  return (names,values)
+
+def _bundle_metadata(row):
+  # Columns added after a bundle was written are NULL, and weren't part of it.
+  metadata = dict([(k,row[k]) for (k,t) in BDL_METADATA_FIELDS if row[k] is not None])
+  for k in JSON_METADATA_FIELDS:
+    if k in metadata:
+      metadata[k] = json.loads(metadata[k])
+  return metadata
+
+# Connections are pooled, and shared by every Postgres adapter in the process.
+# Adapters are created all over the place (by every query, and on every
+# dashboard request), and connecting and checking the project's tables used to
+# take longer than most of the operations they were created for. Instead, an
+# adapter borrows a connection for each operation and gives it back afterwards.
+# A connection which has sat idle for a while is checked before it's lent out
+# again, in case the server has dropped it.
+POOL_SIZE = 8 # idle connections kept per server
+HEALTH_CHECK_AFTER = 30.0 # seconds a connection can sit idle before it's checked
+
+def _healthy(conn):
+  try:
+    with Transaction(conn) as x:
+      x.execute('SELECT 1')
+    return True
+  except (pg.OperationalError, pg.InterfaceError) as e:
+    logging.debug('Dropping broken Postgres connection: '+str(e))
+    return False
+
+class Connection_Pool:
+  def __init__(self, connect):
+    self._connect = connect
+    self._idle = [] # (connection, when it was given back), most recent last
+    self._lock = threading.Lock()
+    self._pid = os.getpid()
+    self._inherited = []
+    self.initialized = set([]) # projects whose tables have been checked
+
+  def _check_fork(self):
+    # A forked process (e.g.- a parallel worker) shares its parent's sockets.
+    # Closing the parent's connections, or letting them be garbage collected,
+    # would close them for the parent too, so they're just set aside.
+    if self._pid!=os.getpid():
+      self._inherited.extend([conn for (conn,since) in self._idle])
+      self._idle = []
+      self._pid = os.getpid()
+
+  def borrow(self):
+    with self._lock:
+      self._check_fork()
+      while len(self._idle)>0:
+        (conn,since) = self._idle.pop()
+        if conn.closed==0 and (time.time()-since<HEALTH_CHECK_AFTER or _healthy(conn)):
+          return conn
+        conn.close()
+    conn = self._connect()
+    assert conn.closed==0, 'Could not connect to server'
+    return conn
+
+  def give_back(self, conn):
+    with self._lock:
+      if self._pid!=os.getpid() or conn.closed!=0:
+        return
+      if len(self._idle)<POOL_SIZE:
+        self._idle.append( (conn,time.time()) )
+        return
+    conn.close()
+
+# Pools are shared by every adapter for the same server, database and user.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def connection_pool(server, database, user):
+  key = (server,database,user)
+  with _pools_lock:
+    if key not in _pools:
+      def connect():
+        logging.debug('Connecting to Postgres server on '+server)
+        conn = pg.connect(host=server, database=database, user=user, connection_factory=Session)
+        conn.choose_role()
+        return conn
+      _pools[key] = Connection_Pool(connect)
+    return _pools[key]
+
+class Borrowed():
+  ''' A connection borrowed from a pool for the length of a with block. If counts is given, the number of round trips made during the block is stored in it under the operation's name. '''
+  def __init__(self, pool, counts=None, operation=None):
+    self._pool = pool
     self._conn = None
+    self._counts = counts
+    self._operation = operation
+    self._start = 0
+  def __enter__(self):
+    self._conn = self._pool.borrow()
+    self._start = getattr(self._conn, 'round_trips', 0)
+    return self._conn
+  def __exit__(self, exc_type, exc_value, trace):
+    if self._counts is not None:
+      self._counts[self._operation] = getattr(self._conn, 'round_trips', 0)-self._start
+    self._pool.give_back(self._conn)
+    return False # raise any exception
 
-  def _connect(self):
-    # Disconnect if necessary
-    if self._conn is not None and self._conn.closed==0:
-      self._conn.close()
-      self._conn = None
-    # Connect 
+class Postgres(Datastore):
+  def __init__(self, init=True):
     username = pwd.getpwuid(os.getuid())[0]
     username = os.getenv('POSTGRES_USERNAME', username) # Allow the user to overrride the username used to connect to postgres
-
-    logging.debug('Connecting to Postgres server on '+config.storage_server)
-    self._conn = pg.connect(host=config.storage_server, database='protos', user=username)
-    assert self._conn.closed==0, 'Could not connect to server'
-
-  def _ensure_connected(self):
-    if self._conn is None or self._conn.closed!=0:
-      self._connect()
-
-  def _set_role_rw(self):
-    self._ensure_connected()
-    with Transaction(self._conn) as x:
-      sql = 'SET ROLE rw_group'
-      logging.debug('PostgreSQL: '+str(sql))
-      x.execute(sql)
-  def _set_role_ro(self):
-    self._ensure_connected()
-    with Transaction(self._conn) as x:
-      sql = 'SET ROLE ro_group'
-      logging.debug('PostgreSQL: '+str(sql))
-      x.execute(sql)
-
-  def _init_project_idempotently(self, project_name):
-    self._ensure_connected()
-    self._set_role_ro()
+    self._pool = connection_pool(config.storage_server, 'protos', username)
+    self.round_trips = {} # operation -> round trips made by its last call
+    with self._connection() as conn:
+      # Tables only need to be checked once per process.
+      if init and config.project_name not in self._pool.initialized:
+        self._init_project_idempotently(conn, config.project_name)
+        self._pool.initialized.add(config.project_name)
+
+  def _connection(self, operation=None):
+    if operation is None:
+      return Borrowed(self._pool)
+    return Borrowed(self._pool, self.round_trips, operation)
+
+  def _init_project_idempotently(self, conn, project_name):
     xquery = "SELECT '{0}'::regclass".format(_sanitize(project_name))
     bquery = "SELECT '{0}_bundles'::regclass".format(_sanitize(project_name))
     need_new_xtable = False
     need_new_btable = False
-    with Transaction(self._conn) as x:
+    with Transaction(conn) as x:
       try:
         logging.debug('PostgreSQL: '+str(xquery))
         x.execute(xquery)
       except pg.ProgrammingError as e:
         need_new_xtable = True
-    with Transaction(self._conn) as x:
+    with Transaction(conn) as x:
       try:
         logging.debug('PostgreSQL: '+str(bquery))
         x.execute(bquery)
       except pg.ProgrammingError as e:
         need_new_btable = True
 
-    try:
-      self._set_role_rw()
-    except pg.ProgrammingError as e:
+    if conn.role!='rw_group':
       # Read-only user
       return
 
     # EXP TABLE
-    self._set_role_rw()
     if need_new_xtable:
       columns = ', '.join(['"{0}" {1}'.format(col,typ) for (col,typ) in EXP_METADATA_FIELDS])
       xsql = 'CREATE TABLE "{0}" ("xid" bigserial, PRIMARY KEY ("xid"), {1})'.format(_sanitize(project_name), columns)
-      with Transaction(self._conn) as x:
+      with Transaction(conn) as x:
         logging.debug('PostgreSQL: '+str(xsql))
         x.execute(xsql)
     else: # Make sure all the columns are there.
       for (col,typ) in EXP_METADATA_FIELDS:
         xsql = 'ALTER TABLE "{0}" ADD COLUMN "{1}" {2}'.format(_sanitize(project_name), col, typ)
-        with Transaction(self._conn) as x:
+        with Transaction(conn) as x:
           logging.debug('PostgreSQL: '+str(xsql))
           try:
             x.execute(xsql)
@@ -147,13 +280,13 @@ class Postgres(Datastore):
     if need_new_btable:
       columns = ', '.join(['"{0}" {1}'.format(col,typ) for (col,typ) in BDL_METADATA_FIELDS])
       bsql = 'CREATE TABLE "{0}_bundles" ("bid" bigserial, PRIMARY KEY ("bid"), "xid" bigint REFERENCES "{0}", {1}, "data" text, "files" text)'.format(_sanitize(project_name),  columns)
-      with Transaction(self._conn) as x:
+      with Transaction(conn) as x:
         logging.debug('PostgreSQL: '+str(bsql))
         x.execute(bsql)
     else: # Make sure all the columns are there.
       for (col,typ) in BDL_METADATA_FIELDS:
         xsql = 'ALTER TABLE "{0}_bundles" ADD COLUMN "{1}" {2}'.format(_sanitize(project_name), col, typ)
-        with Transaction(self._conn) as x:
+        with Transaction(conn) as x:
           logging.debug('PostgreSQL: '+str(xsql))
           try:
             x.execute(xsql)
@@ -161,186 +294,219 @@ class Postgres(Datastore):
             pass
   
   def create_experiment_id(self, experiment_name):
-    self._ensure_connected()
-    self._set_role_rw()
-    sql1 = 'INSERT INTO "{0}" ("name") VALUES (%s) RETURNING "xid"'.format(_sanitize(config.project_name))
-    args1 = [experiment_name]
-    with Transaction(self._conn) as x:
-      logging.debug('PostgreSQL: '+str(sql1)+','+str(args1))
-      x.execute(sql1,args1)
-      xid = x.fetchone()['xid']
-      # Need to do this atomically
-      sql2 = 'UPDATE "{0}" SET "id"=%s WHERE "xid"=%s'.format(_sanitize(config.project_name))
-      args2 = [xid,xid]
-      logging.debug('PostgreSQL: '+str(sql2)+','+str(args2))
-      x.execute(sql2,args2)
-      return str(xid)
+    # The string id is the xid, which is generated in the same statement.
+    sql = 'INSERT INTO "{0}" ("xid","id","name") SELECT "v","v"::text,%s FROM (SELECT nextval(pg_get_serial_sequence(\'"{0}"\',\'xid\')) AS "v") AS "s" RETURNING "xid"'.format(_sanitize(config.project_name))
+    args = [experiment_name]
+    with self._connection('create_experiment_id') as conn, Transaction(conn) as x:
+      logging.debug('PostgreSQL: '+str(sql)+','+str(args))
+      x.execute(sql,args)
+      return str(x.fetchone()['xid'])
 
   # FIXME: tag filters currently don't (really) work
   #   solution: allow non-equality filters (more than just "x=y")
   def find_experiments(self, pattern):
-    self._ensure_connected()
-    self._set_role_ro()
-    # Check pattern is sane.
-    if type(pattern)!=dict:
-      logging.error('Malformed pattern specified while finding experiments')
-      return []
-    if pattern!={} and ( len(pattern)!=1 and 'metadata' not in pattern ):
-      # FIXME: If we allow other criteria than metadata, update this test.
-      logging.error('Invalid pattern: extraneous search fields')
-      return []
-    if pattern=={} or pattern['metadata']=={}:
-      sql = 'SELECT "id" FROM "{0}"'.format(_sanitize(config.project_name))
-      args = []
-    else:
-      if any([type(v)==dict or type(v)==list for (k,v) in pattern['metadata'].items()]):
-        # Check for compound queries (disallowed)
-        logging.error('Experiment queries are not allowed to have deeply-nested values')
-        return []
-      columns = ['"'+str(_sanitize(k))+'"' for k in pattern['metadata'].keys()]
-      arg_str = ' AND '.join([c+'=%s' for c in columns])
-      sql = 'SELECT "id" FROM "{0}" WHERE {1}'.format(_sanitize(config.project_name), arg_str)
-      args = pattern['metadata'].values()
+    return self._select_experiments('find_experiments', pattern)
 
-    with Transaction(self._conn) as x:
-      logging.debug('PostgreSQL: '+x.mogrify(sql,args))
-      x.execute(sql,args)
-      rs = x.fetchall()
-      return [r['id'] for r in rs]
-    logging.error('Experiment query failed')
-    return []
+  def find_recent_experiments(self, pattern, count):
+    return self._select_experiments('find_recent_experiments', pattern, ' ORDER BY "time" DESC NULLS LAST,"xid" DESC LIMIT %s', [count])
 
-  def read_experiment_metadata(self, xid):
-    self._ensure_connected()
-    self._set_role_ro()
-    columns = ','.join(['"{0}"'.format(col) for (col,typ) in EXP_METADATA_FIELDS])
-    sql = 'SELECT {0} FROM "{1}" WHERE "xid"=%s'.format(columns,_sanitize(config.project_name))
-    args = [xid]
-    with Transaction(self._conn) as x:
-      logging.debug('PostgreSQL: '+str(sql)+','+str(args))
-      x.execute(sql,args)
-      r=x.fetchone() # xids are unique
-      retval = dict(r)
-      # FIXME: patch tags (this is a hack)
-      logging.debug('RETVAL[tags]: '+str(type(retval['tags']))+','+str(retval['tags']))
-      if retval['tags'] is not None and retval['tags']!='':
-        retval['tags'] = json.loads(retval['tags'])
+  def _select_experiments(self, operation, pattern, order='', order_args=[]):
+    with self._connection(operation) as conn:
+      # Check pattern is sane.
+      if type(pattern)!=dict:
+        logging.error('Malformed pattern specified while finding experiments')
+        return []
+      if pattern!={} and ( len(pattern)!=1 and 'metadata' not in pattern ):
+        # FIXME: If we allow other criteria than metadata, update this test.
+        logging.error('Invalid pattern: extraneous search fields')
+        return []
+      if pattern=={} or pattern['metadata']=={}:
+        sql = 'SELECT "id" FROM "{0}"'.format(_sanitize(config.project_name))
+        args = []
       else:
-        retval['tags'] = []
-      return retval
-    logging.error('Couldnt read experiment metadata')
-    return {}
+        if any([type(v)==dict or type(v)==list for (k,v) in pattern['metadata'].items()]):
+          # Check for compound queries (disallowed)
+          logging.error('Experiment queries are not allowed to have deeply-nested values')
+          return []
+        columns = ['"'+str(_sanitize(k))+'"' for k in pattern['metadata'].keys()]
+        arg_str = ' AND '.join([c+'=%s' for c in columns])
+        sql = 'SELECT "id" FROM "{0}" WHERE {1}'.format(_sanitize(config.project_name), arg_str)
+        args = pattern['metadata'].values()
+      sql += order
+      args = list(args)+order_args
+
+      with Transaction(conn) as x:
+        logging.debug('PostgreSQL: '+x.mogrify(sql,args))
+        x.execute(sql,args)
+        rs = x.fetchall()
+        return [r['id'] for r in rs]
+      logging.error('Experiment query failed')
+      return []
+
+  def read_experiment_metadata(self, xid):
+    with self._connection('read_experiment_metadata') as conn:
+      columns = ','.join(['"{0}"'.format(col) for (col,typ) in EXP_METADATA_FIELDS])
+      sql = 'SELECT {0} FROM "{1}" WHERE "xid"=%s'.format(columns,_sanitize(config.project_name))
+      args = [xid]
+      with Transaction(conn) as x:
+        logging.debug('PostgreSQL: '+str(sql)+','+str(args))
+        x.execute(sql,args)
+        r=x.fetchone() # xids are unique
+        retval = dict(r)
+        # FIXME: patch tags (this is a hack)
+        logging.debug('RETVAL[tags]: '+str(type(retval['tags']))+','+str(retval['tags']))
+        if retval['tags'] is not None and retval['tags']!='':
+          retval['tags'] = json.loads(retval['tags'])
+        else:
+          retval['tags'] = []
+        for k in JSON_METADATA_FIELDS:
+          if retval[k] is not None:
+            retval[k] = json.loads(retval[k])
+        return retval
+      logging.error('Couldnt read experiment metadata')
+      return {}
 
   def write_experiment_metadata(self, metadata, xid):
-    self._ensure_connected()
-    self._set_role_rw()
-    colnames = [col for (col,typ) in EXP_METADATA_FIELDS]
-    mdnames = metadata.keys()
-    # Only write valid MD values
-    names = list(set(colnames)&set(mdnames))
-    # If we try to write an MD field we don't know about, alert us to the problem
-    if( len(names)<len(mdnames) ):
-      logging.warning('Unknown metadata fields "'+str( set(mdnames)-set(colnames) )+'"')
-    colsql = ','.join(['"{0}"'.format(n) for n in names])
-    valsql = ','.join(['%s' for n in names])
-    mdvalues = dict(metadata) # copy
-    # FIXME: patch tags (this is a hack)
-    if 'tags' in mdvalues:
-      mdvalues['tags'] = json.dumps(mdvalues['tags'])
-    values = [str(mdvalues[n]) for n in names]
-
-    deconflict_sql = 'SELECT "xid" FROM "{0}" WHERE "xid"=%s'.format(_sanitize(config.project_name))
-    deconflict_args = [xid]
-    insert_sql = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(_sanitize(config.project_name), colsql, valsql)
-    insert_args= values
-    update_sql = 'UPDATE "{0}" SET ({1}) = ({2}) WHERE "xid"=%s'.format(_sanitize(config.project_name), colsql, valsql)
-    update_args=values+[xid]
-
-    with Transaction(self._conn) as x:
-      logging.debug('PostgreSQL: '+x.mogrify(deconflict_sql,deconflict_args))
-      x.execute(deconflict_sql, deconflict_args)
-      r=x.fetchall()
-      if len(r)==0:
-        logging.debug('PostgreSQL: '+x.mogrify(insert_sql,insert_args))
-        x.execute(insert_sql,insert_args)
+    with self._connection('write_experiment_metadata') as conn:
+      (names,values) = _experiment_columns(metadata)
+      # An upsert in one statement. (ON CONFLICT would need Postgres 9.5.)
+      table = _sanitize(config.project_name)
+      colsql = ''.join([',"{0}"'.format(n) for n in names])
+      valsql = ''.join([',%s' for n in names])
+      if len(names)>0:
+        setsql = ','.join(['"{0}"=%s'.format(n) for n in names])
+        upsert_sql = 'WITH "u" AS (UPDATE "{0}" SET {1} WHERE "xid"=%s::bigint RETURNING "xid") INSERT INTO "{0}" ("xid"{2}) SELECT %s::bigint{3} WHERE NOT EXISTS (SELECT 1 FROM "u")'.format(table, setsql, colsql, valsql)
+        upsert_args = values+[xid,xid]+values
       else:
+        upsert_sql = 'INSERT INTO "{0}" ("xid") SELECT %s::bigint WHERE NOT EXISTS (SELECT 1 FROM "{0}" WHERE "xid"=%s::bigint)'.format(table)
+        upsert_args = [xid,xid]
+
+      with Transaction(conn) as x:
+        logging.debug('PostgreSQL: '+x.mogrify(upsert_sql,upsert_args))
+        x.execute(upsert_sql,upsert_args)
+      return True
+
+  def update_experiment_metadata(self, fields, xid):
+    with self._connection('update_experiment_metadata') as conn:
+      (names,values) = _experiment_columns(fields)
+      if len(names)==0:
+        return True
+      setsql = ','.join(['"{0}"=%s'.format(n) for n in names])
+      update_sql = 'UPDATE "{0}" SET {1} WHERE "xid"=%s'.format(_sanitize(config.project_name), setsql)
+      update_args = values+[xid]
+
+      with Transaction(conn) as x:
         logging.debug('PostgreSQL: '+x.mogrify(update_sql,update_args))
         x.execute(update_sql,update_args)
-    return True
+      return True
 
   def find_bundles(self, pattern, xid):
-    self._ensure_connected()
-    self._set_role_ro()
-
-    md = {}
-    if 'metadata' in pattern:
-      md = pattern['metadata']
-    dat = {}
-    if 'data' in pattern:
-      dat = pattern['data']
-    # FIXME: ignores files
-
-    colnames = [col for (col,typ) in BDL_METADATA_FIELDS]
-    mdnames = md.keys()
-    # Only match valid MD values
-    names = list(set(colnames)&set(mdnames))
-    # If we try to match an MD field we don't know about, alert us to the problem
-    if( len(names)<len(mdnames) ):
-      logging.warning('Unknown metadata fields "'+str( set(mdnames)-set(colnames) )+'"')
-    constraints = '"xid"=%s'
-    constraints += ''.join([' AND "{0}"=%s'.format(n) for n in names])
-    values = [xid]
-    values += [md[n] for n in names]
-
-    with Transaction(self._conn) as x:
-      qsql = 'SELECT * FROM "{0}_bundles" WHERE {1}'.format(_sanitize(config.project_name), constraints)
-      qsql_args = values
-      logging.debug('PostgreSQL: '+x.mogrify(qsql,qsql_args))
-      x.execute(qsql, qsql_args)
-      bs = x.fetchall()
-      bundles = [{'metadata': {k:j[k] for (k,t) in BDL_METADATA_FIELDS}, 'data':json.loads(j['data']), 'files':json.loads(j['files'])} for j in bs]
-      return [b for b in bundles if _json_subset(dat,b)]
-    logging.error('Failed to find bundles')
-    return []
+    return self._select_bundles(pattern, xid, True, 'find_bundles')
+
+  def find_bundle_metadata(self, pattern, xid):
+    # Data patterns are matched here, not in the database, so they need the data.
+    return self._select_bundles(pattern, xid, 'data' in pattern, 'find_bundle_metadata')
+
+  def _select_bundles(self, pattern, xid, contents, operation):
+    # Finds bundles matching a pattern. Their data and files are only read
+    # (and decoded) if contents is set.
+    with self._connection(operation) as conn:
+      md = {}
+      if 'metadata' in pattern:
+        md = pattern['metadata']
+      dat = {}
+      if 'data' in pattern:
+        dat = pattern['data']
+      # FIXME: ignores files
+
+      colnames = [col for (col,typ) in BDL_METADATA_FIELDS]
+      mdnames = md.keys()
+      # Only match valid MD values
+      names = list(set(colnames)&set(mdnames))
+      # If we try to match an MD field we don't know about, alert us to the problem
+      if( len(names)<len(mdnames) ):
+        logging.warning('Unknown metadata fields "'+str( set(mdnames)-set(colnames) )+'"')
+      constraints = '"xid"=%s'
+      constraints += ''.join([' AND "{0}"=%s'.format(n) for n in names])
+      values = [xid]
+      values += [md[n] for n in names]
+
+      columns = ','.join(['"{0}"'.format(col) for (col,typ) in BDL_METADATA_FIELDS])
+      if contents:
+        columns += ',"data","files"'
+      with Transaction(conn) as x:
+        qsql = 'SELECT {0} FROM "{1}_bundles" WHERE {2}'.format(columns, _sanitize(config.project_name), constraints)
+        qsql_args = values
+        logging.debug('PostgreSQL: '+x.mogrify(qsql,qsql_args))
+        x.execute(qsql, qsql_args)
+        bs = x.fetchall()
+        bundles = [{'metadata': _bundle_metadata(j)} for j in bs]
+        if contents:
+          for (b,j) in zip(bundles,bs):
+            b['data'] = decode_text(j['data'])
+            b['files'] = decode_text(j['files'])
+        return [b for b in bundles if _json_subset(dat,b)]
+      logging.error('Failed to find bundles')
+      return []
+
+  def read_bundles(self, bids, xid):
+    if len(bids)==0:
+      return []
+    with self._connection('read_bundles') as conn:
+      with Transaction(conn) as x:
+        qsql = 'SELECT * FROM "{0}_bundles" WHERE "xid"=%s AND "id" IN %s'.format(_sanitize(config.project_name))
+        qsql_args = [xid, tuple([str(bid) for bid in bids])]
+        logging.debug('PostgreSQL: '+x.mogrify(qsql,qsql_args))
+        x.execute(qsql, qsql_args)
+        return [{'metadata': _bundle_metadata(j), 'data':decode_text(j['data']), 'files':decode_text(j['files'])} for j in x.fetchall()]
+      logging.error('Failed to read bundles')
+      return []
 
  
+  def _insert_bundles(self, x, bundles, xid):
+    # Adds bundles to the bundle table in a single statement. Each bundle's id
+    # is its bid, which is generated as it's inserted. Nothing says nextval()
+    # is called in the order the rows are listed, so each row carries its
+    # position in the batch, and the bids are returned in that order.
+    columns = [col for (col,typ) in BDL_METADATA_FIELDS if col!='id']
+    colsql = ','.join(['"{0}"'.format(c) for c in columns])
+    rows = []
+    args = []
+    for (n,bundle) in enumerate(bundles):
+      values = [bundle['metadata'].get(c) for c in columns]
+      values = [json.dumps(v) if (c in JSON_METADATA_FIELDS and v is not None) else v for (c,v) in zip(columns,values)]
+      rows.append('(%s,'+','.join(['%s' for c in columns])+',%s,%s)')
+      args.extend([n]+values+[encode_text(bundle['data']),encode_text(bundle['files'])])
+    args.append(xid)
+    seqsql = "nextval(pg_get_serial_sequence('\"{0}_bundles\"','bid'))".format(_sanitize(config.project_name))
+    qsql = 'WITH "s" AS (SELECT {2} AS "v",* FROM (VALUES {3}) AS "b" ("n",{1},"data","files")), "i" AS (INSERT INTO "{0}_bundles" ("bid","id","xid",{1},"data","files") SELECT "v","v"::text,%s::bigint,{1},"data","files" FROM "s" RETURNING "bid") SELECT "s"."v" AS "bid" FROM "s" JOIN "i" ON "i"."bid"="s"."v" ORDER BY "s"."n"'.format(_sanitize(config.project_name), colsql, seqsql, ','.join(rows))
+
+    logging.debug('PostgreSQL: '+str(qsql))
+    x.execute(qsql,args)
+    return [r['bid'] for r in x.fetchall()]
+
   def write_bundle(self, bundle, xid):
     # FIXME: handle unexpected metadata columns
-    self._ensure_connected()
-    self._set_role_rw()
+    with self._connection('write_bundle') as conn:
+      with Transaction(conn) as x:
+        return self._insert_bundles(x, [bundle], xid)[0]
 
-    bundle['metadata']['id'] = 0 # placeholder, will get replaced with bid (we just don't expect the user to remember to specify a dummy value
-    columns = [col for (col,typ) in BDL_METADATA_FIELDS]
-    colsql = ','.join(['"{0}"'.format(c) for c in columns])
-    values = [bundle['metadata'][c] for c in columns]
-    valsql = ','.join(['%s' for c in columns])
-    qsql = 'INSERT INTO "{0}_bundles" ("xid", {1}, "data", "files") VALUES (%s,{2},%s,%s) RETURNING "bid"'.format(_sanitize(config.project_name), colsql, valsql)
-    qsql_args = [xid]+values+[json.dumps(bundle['data'])]+[json.dumps(bundle['files'])]
-    bsql = 'UPDATE "{0}_bundles" SET "id"=%s WHERE "bid"=%s'.format(_sanitize(config.project_name))
-
-    with Transaction(self._conn) as x:
-      logging.debug('PostgreSQL: '+str(qsql))
-      x.execute(qsql,qsql_args)
-      bid = x.fetchone()['bid']
-      bsql_args = [bid,bid]
-      logging.debug('PostgreSQL: '+str(bsql))
-      x.execute(bsql,bsql_args)
-
-    return bid
+  def write_bundles(self, bundles, xid):
+    if len(bundles)==0:
+      return []
+    # One statement for the whole batch.
+    with self._connection('write_bundles') as conn:
+      with Transaction(conn) as x:
+        return self._insert_bundles(x, bundles, xid)
 
   def delete_experiment(self, xid):
-    self._ensure_connected()
-    self._set_role_rw()
-
-    bsql = 'DELETE FROM "{0}_bundles" WHERE "xid"=%s'.format(_sanitize(config.project_name))
-    bsql_args = [str(xid)]
-    xsql = 'DELETE FROM "{0}" WHERE "xid"=%s'.format(_sanitize(config.project_name))
-    xsql_args = [str(xid)]
+    with self._connection('delete_experiment') as conn:
+      # Sent together, so they're run as one transaction.
+      sql = 'DELETE FROM "{0}_bundles" WHERE "xid"=%s; DELETE FROM "{0}" WHERE "xid"=%s'.format(_sanitize(config.project_name))
+      args = [str(xid),str(xid)]
 
-    with Transaction(self._conn) as x:
-      logging.debug('PostgreSQL: '+x.mogrify(bsql,bsql_args))
-      x.execute(bsql, bsql_args)
-      logging.debug('PostgreSQL: '+x.mogrify(xsql,xsql_args))
-      x.execute(xsql, xsql_args)
+      with Transaction(conn) as x:
+        logging.debug('PostgreSQL: '+x.mogrify(sql,args))
+        x.execute(sql, args)
 
-    return True
+      return True
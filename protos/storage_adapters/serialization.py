@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+import logging
+import json
+import marshal
+import zlib
+import base64
+
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma # Python 2 needs the backport
+  except ImportError:
+    lzma = None
+
+from ..config import config
+
+# How adapters turn bundles and metadata into bytes.
+# A codec (config.codec) encodes values, and can be followed by a compressor
+# (config.compression):
+#   json : compact JSON text
+#   marshal : Python's own binary format, much faster than JSON for large data,
+#             but only readable by Python (2.x, since that's what protos runs on)
+#   gzip, lzma : compression, which is well worth it for bundles with a lot of
+#                repetitive data. lzma compresses better but is slower, and on
+#                Python 2 needs the backports.lzma package.
+# Encoded values describe themselves: JSON is stored as-is, marshalled data
+# starts with a header, and compressed data starts with its format's usual
+# magic bytes (so gzipped bundles can be read with zcat). That way everything
+# ever stored can be read no matter what the configuration is now, including
+# files written before codecs existed.
+CODECS = ['json', 'marshal']
+COMPRESSION = ['', 'gzip', 'lzma']
+
+MARSHAL_HEADER = '\x00PRM'
+GZIP_MAGIC = '\x1f\x8b'
+XZ_MAGIC = '\xfd7zXZ\x00'
+TEXT_PREFIX = '=' # for binary data in text fields; JSON never starts with this
+
+def encode(value, codec=None, compression=None):
+  ''' Encodes a JSON-like value as a byte string. '''
+  if codec is None:
+    codec = config.codec
+  if compression is None:
+    compression = config.compression
+  assert codec in CODECS, 'Unknown codec "'+str(codec)+'", use one of '+', '.join(CODECS)
+  assert compression in COMPRESSION, 'Unknown compression "'+str(compression)+'", use one of '+', '.join([c for c in COMPRESSION if c!=''])
+  if codec=='marshal':
+    try:
+      s = MARSHAL_HEADER+marshal.dumps(value)
+    except ValueError:
+      raise TypeError('Value cannot be marshalled (only plain data can be stored)')
+  else:
+    s = json.dumps(value, separators=(',',':'))
+  if compression=='gzip':
+    z = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS) # gzip format
+    s = z.compress(s)+z.flush()
+  elif compression=='lzma':
+    assert lzma is not None, 'lzma compression needs the backports.lzma package on Python 2'
+    s = lzma.compress(s)
+  return s
+
+def decode(s):
+  ''' Decodes a byte string produced by encode (or any JSON text). '''
+  if s.startswith(GZIP_MAGIC):
+    return decode(zlib.decompress(s, 16+zlib.MAX_WBITS))
+  if s.startswith(XZ_MAGIC):
+    assert lzma is not None, 'Reading lzma-compressed data needs the backports.lzma package on Python 2'
+    return decode(lzma.decompress(s))
+  if s.startswith(MARSHAL_HEADER):
+    return marshal.loads(s[len(MARSHAL_HEADER):])
+  return json.loads(s)
+
+def encode_text(value):
+  ''' Like encode, but produces something which can be stored in a text field. '''
+  s = encode(value)
+  if config.codec=='json' and config.compression=='':
+    return s # already text
+  return TEXT_PREFIX+base64.b64encode(s)
+
+def decode_text(s):
+  if s.startswith(TEXT_PREFIX):
+    return decode(base64.b64decode(s[len(TEXT_PREFIX):]))
+  return json.loads(s)
+
+def debugging():
+  ''' Whether debug messages are being logged. Check this before building expensive ones. '''
+  return logging.getLogger().isEnabledFor(logging.DEBUG)
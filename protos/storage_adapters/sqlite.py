@@ -0,0 +1,289 @@
+from __future__ import absolute_import
+import os
+import os.path
+import logging
+import json
+import sqlite3
+
+from ..config import config
+from .adapters import Datastore, _json_subset
+from .serialization import encode, decode, debugging
+
+# A database file per project, for single machines that don't have (or want)
+# a database server. Everything lives in data_dir/<project>.sqlite.
+# The database is in write-ahead-log mode, so queries (say, from the dashboard)
+# can read while an experiment is being written.
+# Metadata is stored as JSON and searched with SQLite's JSON functions, but the
+# fields that are searched most often are copied into their own indexed
+# columns, too. Bundle data and files are encoded with the configured codec.
+# Patterns are narrowed down as much as possible in SQL, then checked exactly
+# in Python, so searches find the same things they would with any other adapter.
+SCHEMA = [
+  '''CREATE TABLE IF NOT EXISTS "experiments" (
+    "xid" INTEGER PRIMARY KEY AUTOINCREMENT,
+    "name" TEXT,
+    "time" TEXT,
+    "metadata" TEXT NOT NULL DEFAULT '{}')''',
+  'CREATE INDEX IF NOT EXISTS "experiments_name" ON "experiments" ("name")',
+  'CREATE INDEX IF NOT EXISTS "experiments_time" ON "experiments" ("time")',
+  '''CREATE TABLE IF NOT EXISTS "bundles" (
+    "xid" INTEGER NOT NULL REFERENCES "experiments" ("xid"),
+    "id" TEXT NOT NULL,
+    "bundle_type" TEXT,
+    "cache_key" TEXT,
+    "cost_key" TEXT,
+    "metadata" TEXT NOT NULL,
+    "data" BLOB,
+    "files" BLOB,
+    PRIMARY KEY ("xid","id"))''',
+  'CREATE INDEX IF NOT EXISTS "bundles_type" ON "bundles" ("xid","bundle_type")',
+  'CREATE INDEX IF NOT EXISTS "bundles_cache_key" ON "bundles" ("xid","cache_key")',
+]
+# Metadata fields with their own columns.
+EXP_COLUMNS = ['name','time']
+BDL_COLUMNS = ['bundle_type','cache_key','cost_key']
+BUSY_TIMEOUT = 30.0 # seconds to wait for another process's write to finish
+MAX_VARIABLES = 500 # per statement (older SQLite builds allow 999)
+
+def database_path():
+  return os.path.join(config.data_dir, config.project_name+'.sqlite')
+
+class Transaction():
+  ''' Runs a block of statements as one write transaction. '''
+  def __init__(self, connection):
+    self._conn = connection
+  def __enter__(self):
+    # Take the write lock up front, so two writers can't deadlock upgrading.
+    self._conn.execute('BEGIN IMMEDIATE')
+    return self._conn
+  def __exit__(self, exc_type, exc_value, trace):
+    if exc_type is None:
+      self._conn.execute('COMMIT')
+    else:
+      self._conn.execute('ROLLBACK')
+    return False # raise any exception
+
+def _json_path(key):
+  return '$."'+key+'"'
+
+def _is_scalar(v):
+  return type(v) in [str,unicode,int,long,float,bool]
+
+def _metadata_filter(md, columns, tags=False):
+  # Translates the parts of a metadata pattern which SQL can check into
+  # constraints. Anything else is left for _json_subset.
+  constraints = []
+  args = []
+  for (k,v) in md.items():
+    if '"' in k:
+      continue
+    if k in columns and _is_scalar(v):
+      constraints.append('"'+k+'"=?')
+      args.append(v)
+    elif _is_scalar(v):
+      constraints.append('json_extract("metadata",?)=?')
+      args.extend([_json_path(k),v])
+    elif tags and type(v) is list:
+      # Each listed value has to be somewhere in the stored list.
+      for item in [item for item in v if _is_scalar(item)]:
+        constraints.append('EXISTS (SELECT 1 FROM json_each("metadata",?) WHERE "value"=?)')
+        args.extend([_json_path(k),item])
+  return (constraints,args)
+
+def _where(constraints):
+  if len(constraints)==0:
+    return ''
+  return ' WHERE '+' AND '.join(constraints)
+
+def _blob(value):
+  return buffer(encode(value))
+
+def _bundle(row, contents):
+  bundle = {'metadata': json.loads(row['metadata'])}
+  if contents:
+    bundle['data'] = decode(str(row['data']))
+    bundle['files'] = decode(str(row['files']))
+  return bundle
+
+# Schemas already checked by this process.
+_initialized = set([])
+
+class Sqlite(Datastore):
+  def __init__(self):
+    self._conn = None
+    self._pid = None
+    self._path = database_path()
+    # Check/create the data directory if necessary
+    if not os.path.isdir(config.data_dir):
+      assert config.data_dir!='', 'Config parameter "data_dir" cannot be empty if using the "sqlite" storage adapter'
+      logging.warning('Data directory not found. Creating a new, empty one at "'+config.data_dir+'"')
+      os.mkdir(config.data_dir)
+    self._connect()
+
+  def _connect(self):
+    logging.debug('Opening SQLite database '+self._path)
+    # Transactions are started explicitly (see Transaction). The progress
+    # reporter and bundle writer use their adapters from their own threads.
+    self._conn = sqlite3.connect(self._path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    self._conn.row_factory = sqlite3.Row
+    self._pid = os.getpid()
+    self._conn.execute('PRAGMA foreign_keys=ON')
+    if self._path not in _initialized:
+      if self._conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]!='wal':
+        logging.warning('SQLite database '+self._path+' is not in WAL mode, readers will wait for writers')
+      with Transaction(self._conn) as x:
+        for sql in SCHEMA:
+          x.execute(sql)
+      _initialized.add(self._path)
+    # With a write-ahead log, it's safe not to sync on every commit.
+    self._conn.execute('PRAGMA synchronous=NORMAL')
+
+  def _ensure_connected(self):
+    # Connections can't be shared with forked processes (e.g.- parallel workers).
+    if self._conn is None or self._pid!=os.getpid():
+      self._connect()
+    return self._conn
+
+  def _execute(self, sql, args=[]):
+    if debugging():
+      logging.debug('SQLite: '+str(sql)+','+str(args))
+    return self._ensure_connected().execute(sql, args)
+
+  def create_experiment_id(self, experiment_name):
+    with Transaction(self._ensure_connected()) as x:
+      xid = x.execute('INSERT INTO "experiments" ("name") VALUES (?)', [experiment_name]).lastrowid
+      x.execute('UPDATE "experiments" SET "metadata"=json_object(\'id\',?,\'name\',?) WHERE "xid"=?', [str(xid),experiment_name,xid])
+    return str(xid)
+
+  def find_experiments(self, pattern):
+    return self._select_experiments(pattern, [], [])
+
+  def find_experiments_between(self, pattern, since=None, until=None):
+    constraints = []
+    args = []
+    if since is not None:
+      constraints.append('"time">=?')
+      args.append(since)
+    if until is not None:
+      # Timestamps can be shortened, so compare against the longest time starting with until.
+      constraints.append('"time"<=?')
+      args.append(unicode(until)+u'\uffff')
+    return self._select_experiments(pattern, constraints, args)
+
+  def find_recent_experiments(self, pattern, count):
+    return self._select_experiments(pattern, [], [], order='"time" DESC,"xid" DESC', count=count)
+
+  def _select_experiments(self, pattern, constraints, args, order='"xid"', count=None):
+    if type(pattern)!=dict:
+      logging.error('Malformed pattern specified while finding experiments')
+      return []
+    if len(set(pattern.keys())-set(['metadata']))>0:
+      logging.error('Invalid pattern: extraneous search fields')
+      return []
+    md = pattern.get('metadata',{})
+    if 'id' in md:
+      try:
+        constraints = constraints+['"xid"=?']
+        args = args+[int(md['id'])]
+      except (ValueError,TypeError):
+        return [] # not one of ours
+    (mdc,mda) = _metadata_filter(dict([(k,v) for (k,v) in md.items() if k!='id']), EXP_COLUMNS, tags=True)
+    sql = 'SELECT "xid","metadata" FROM "experiments"'+_where(constraints+mdc)+' ORDER BY '+order
+    found = []
+    # Some of the pattern can only be checked here, so stop reading once we have enough.
+    for r in self._execute(sql, args+mda):
+      if count is not None and len(found)>=count:
+        break
+      if _json_subset(md, json.loads(r['metadata'])) is not None:
+        found.append(str(r['xid']))
+    return found
+
+  def read_experiment_metadata(self, xid):
+    r = self._execute('SELECT "metadata" FROM "experiments" WHERE "xid"=?', [int(xid)]).fetchone()
+    assert r is not None, 'Bad experiment id: '+str(xid)
+    return json.loads(r['metadata'])
+
+  def write_experiment_metadata(self, metadata, xid):
+    # FYI: Blows away previous metadata, even if it had more information.
+    # (REPLACE would delete the row first, which the bundles refer to.)
+    values = [json.dumps(metadata)]+[metadata.get(c) for c in EXP_COLUMNS]
+    update_sql = 'UPDATE "experiments" SET "metadata"=?'+''.join([',"'+c+'"=?' for c in EXP_COLUMNS])+' WHERE "xid"=?'
+    insert_sql = 'INSERT INTO "experiments" ("metadata",'+','.join(['"'+c+'"' for c in EXP_COLUMNS])+',"xid") VALUES (?,'+','.join(['?' for c in EXP_COLUMNS])+',?)'
+    with Transaction(self._ensure_connected()) as x:
+      if x.execute(update_sql, values+[int(xid)]).rowcount==0:
+        x.execute(insert_sql, values+[int(xid)])
+    return True
+
+  def update_experiment_metadata(self, fields, xid):
+    if len(fields)==0:
+      return True
+    assert not any(['"' in k for k in fields]), 'Metadata field names cannot contain quotes'
+    # json() marks the values as JSON, rather than strings containing JSON.
+    paths = ','.join(['?,json(?)' for k in fields])
+    args = []
+    for (k,v) in fields.items():
+      args.extend([_json_path(k),json.dumps(v)])
+    columns = ''.join([',"'+c+'"=?' for c in EXP_COLUMNS if c in fields])
+    args.extend([fields[c] for c in EXP_COLUMNS if c in fields])
+    sql = 'UPDATE "experiments" SET "metadata"=json_set("metadata",'+paths+')'+columns+' WHERE "xid"=?'
+    with Transaction(self._ensure_connected()) as x:
+      x.execute(sql, args+[int(xid)])
+    return True
+
+  def find_bundles(self, pattern, xid):
+    return self._select_bundles(pattern, xid, True)
+
+  def find_bundle_metadata(self, pattern, xid):
+    # Data and file patterns are matched here, not in the database, so they need the contents.
+    return self._select_bundles(pattern, xid, len(set(pattern.keys())-set(['metadata']))>0)
+
+  def _select_bundles(self, pattern, xid, contents):
+    md = pattern.get('metadata',{})
+    constraints = ['"xid"=?']
+    args = [int(xid)]
+    if 'id' in md and _is_scalar(md['id']):
+      constraints.append('"id"=?')
+      args.append(str(md['id']))
+    (mdc,mda) = _metadata_filter(dict([(k,v) for (k,v) in md.items() if k!='id']), BDL_COLUMNS)
+    columns = '"metadata","data","files"' if contents else '"metadata"'
+    sql = 'SELECT '+columns+' FROM "bundles"'+_where(constraints+mdc)
+    bundles = [_bundle(r, contents) for r in self._execute(sql, args+mda).fetchall()]
+    return [b for b in bundles if _json_subset(pattern, b) is not None]
+
+  def read_bundles(self, bids, xid):
+    bids = [str(bid) for bid in bids]
+    bundles = []
+    for i in xrange(0, len(bids), MAX_VARIABLES):
+      chunk = bids[i:i+MAX_VARIABLES]
+      sql = 'SELECT "metadata","data","files" FROM "bundles" WHERE "xid"=? AND "id" IN ('+','.join(['?' for bid in chunk])+')'
+      bundles.extend([_bundle(r, True) for r in self._execute(sql, [int(xid)]+chunk).fetchall()])
+    return bundles
+
+  def _bundle_row(self, bundle, xid):
+    assert 'metadata' in bundle, 'Data bundle corrupted? No metadata found.'
+    assert 'id' in bundle['metadata'], 'Data bundle corrupted? No ID in metadata.'
+    md = bundle['metadata']
+    if debugging():
+      logging.debug('Writing data bundle to SQLite:\n'+json.dumps(bundle,indent=2))
+    return [int(xid), str(md['id'])]+[md.get(c) for c in BDL_COLUMNS]+[json.dumps(md), _blob(bundle['data']), _blob(bundle['files'])]
+
+  def write_bundle(self, bundle, xid):
+    return self.write_bundles([bundle], xid)[0]
+
+  def write_bundles(self, bundles, xid):
+    # The whole batch is written in one transaction.
+    rows = [self._bundle_row(bundle, xid) for bundle in bundles]
+    columns = ['xid','id']+BDL_COLUMNS+['metadata','data','files']
+    sql = 'INSERT OR REPLACE INTO "bundles" ('+','.join(['"'+c+'"' for c in columns])+') VALUES ('+','.join(['?' for c in columns])+')'
+    with Transaction(self._ensure_connected()) as x:
+      x.executemany(sql, rows)
+    return [row[1] for row in rows]
+
+  def delete_experiment(self, xid):
+    with Transaction(self._ensure_connected()) as x:
+      x.execute('DELETE FROM "bundles" WHERE "xid"=?', [int(xid)])
+      deleted = x.execute('DELETE FROM "experiments" WHERE "xid"=?', [int(xid)]).rowcount
+    if deleted==0:
+      logging.error('Failed to delete experiment '+str(xid)+' (not found)')
+      return False
+    return True
@@ -0,0 +1,219 @@
+from __future__ import absolute_import
+import os
+import os.path
+import sys
+import json
+import time
+import uuid
+import shutil
+import logging
+
+from .config import config
+from .data_bundles import Data_Bundle
+
+# Streaming protocols are generators. Everything they yield is a chunk (a
+# record, a file name, part of a data dictionary: anything that can be
+# represented in JSON) which is passed on to the protocols that use it as soon
+# as it's produced. The exception is their bundle, which they yield last, and
+# which is stored like any other protocol's. For example:
+#
+# @protos.protocol
+# def parse(experiment, filename):
+#   b = protos.Bundle(experiment, name='records')
+#   for line in open(filename):
+#     yield line.split()
+#   yield b
+#
+# Protocols that use the result of a streaming protocol are passed a Stream
+# instead of a bundle. Iterating over it produces the chunks, and its bundle
+# attribute is the final bundle. Chunks are buffered in a file in the
+# experiment directory rather than in memory. When protocols run in parallel,
+# consumers run alongside their producers, reading chunks as they arrive. The
+# stream file is created before the producer starts, and ends with an error if
+# it fails. Consumers give up if a producer goes config.stream_timeout seconds
+# without writing anything, in case it died without saying so.
+# A producer can't get too far ahead of the consumers reading alongside it:
+# each consumer keeps a count of the chunks it has read in a file next to the
+# stream, and the producer waits whenever it is config.stream_buffer chunks
+# ahead of the slowest of them. Consumers which haven't started yet don't hold
+# the producer up (they may be waiting for it to finish, for a free job), and
+# neither do consumers which haven't moved for config.stream_timeout seconds.
+POLL_INTERVAL = 0.01 # seconds between checks for new chunks
+
+class Stream:
+  def __init__(self, path, xdata):
+    self._path = path
+    self._xdata = xdata
+    self._bundle = None
+
+  def __repr__(self):
+    return '<data stream>'
+
+  def __iter__(self):
+    reader = _Reader(self._path)
+    try:
+      for record in _follow(self._path, config.stream_timeout):
+        if 'chunk' in record:
+          yield record['chunk']
+          reader.advance()
+        elif 'error' in record:
+          raise RuntimeError('Streaming protocol failed: '+record['error'])
+        else:
+          self._bundle = Data_Bundle(self._xdata, _init=record['end'])
+    finally:
+      reader.close()
+
+  @property
+  def bundle(self):
+    ''' The streaming protocol's bundle. Waits for the protocol to finish, if it hasn't. '''
+    if self._bundle is None:
+      for chunk in self:
+        pass
+    return self._bundle
+
+class Stream_Writer:
+  def __init__(self, path):
+    if not os.path.isdir(os.path.dirname(path)):
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError: # Someone else just made it
+        pass
+    self._f = open(path,'w')
+    self._readers = path+'.readers'
+    self._count = 0 # chunks written
+    self._allowed = 0 # chunks that can be written before checking on the readers again
+
+  def put(self, chunk):
+    if config.stream_buffer>0:
+      while self._count>=self._allowed:
+        slowest = self._slowest()
+        if slowest is None: # Nobody reading, but someone might start
+          slowest = self._count
+        self._allowed = slowest+config.stream_buffer
+        if self._count>=self._allowed:
+          time.sleep(POLL_INTERVAL)
+    self._write({'chunk':chunk})
+    self._count += 1
+
+  def _slowest(self):
+    # The fewest chunks read by any consumer still reading, or None.
+    counts = []
+    try:
+      names = os.listdir(self._readers)
+    except OSError:
+      return None
+    for name in names:
+      if name.startswith('.'):
+        continue
+      path = os.path.join(self._readers, name)
+      try:
+        with open(path) as f:
+          count = int(f.read())
+        if config.stream_timeout>0 and time.time()-os.stat(path).st_mtime>config.stream_timeout:
+          logging.warning('A consumer of '+self._f.name+' stopped reading. No longer waiting for it.')
+          os.remove(path)
+          continue
+      except (OSError,IOError,ValueError): # It just finished
+        continue
+      counts.append(count)
+    if len(counts)==0:
+      return None
+    return min(counts)
+
+  def end(self, bundle):
+    self._write({'end':bundle._externalize()})
+    self._f.close()
+
+  def fail(self, error):
+    self._write({'error':error})
+    self._f.close()
+
+  def _write(self, record):
+    # One record per line, flushed right away so consumers can see it.
+    self._f.write(json.dumps(record)+'\n')
+    self._f.flush()
+
+# A consumer's place in a stream, for its producer to see.
+class _Reader:
+  def __init__(self, path):
+    self._dir = path+'.readers'
+    self._path = os.path.join(self._dir, uuid.uuid4().hex)
+    self._count = 0
+    self._every = max(1, config.stream_buffer//4) # chunks between updates
+    if config.stream_buffer>0:
+      try:
+        os.makedirs(self._dir)
+      except OSError: # Already there
+        pass
+      self._publish()
+
+  def advance(self):
+    self._count += 1
+    if config.stream_buffer>0 and self._count%self._every==0:
+      self._publish()
+
+  def _publish(self):
+    (head,tail) = os.path.split(self._path)
+    tmp = os.path.join(head, '.'+tail)
+    with open(tmp,'w') as f:
+      f.write(str(self._count))
+    os.rename(tmp, self._path)
+
+  def close(self):
+    try:
+      os.remove(self._path)
+    except OSError:
+      pass
+
+def remove(path):
+  ''' Deletes a stream file once nothing else needs it. '''
+  if os.path.isfile(path):
+    os.remove(path)
+  shutil.rmtree(path+'.readers', ignore_errors=True)
+
+def drain(results, writer):
+  ''' Runs a streaming protocol to completion, writing its chunks to a Stream_Writer, and returns its bundle. '''
+  bundle = None
+  try:
+    for item in results:
+      assert bundle is None, 'Streaming protocols must yield their bundle last'
+      if isinstance(item, Data_Bundle):
+        bundle = item
+      else:
+        writer.put(item)
+    assert bundle is not None, 'Streaming protocol finished without yielding a bundle'
+  except:
+    # Don't leave consumers waiting for chunks that will never come.
+    writer.fail(str(sys.exc_info()[1]))
+    raise
+  writer.end(bundle)
+  return bundle
+
+def _follow(path, timeout):
+  # Reads records from a stream file as they are written, until the last one.
+  since = time.time() # when the writer was last heard from
+  while not os.path.isfile(path):
+    _wait(since, timeout, 'Streaming protocol never started')
+  with open(path) as f:
+    line = ''
+    while True:
+      more = f.readline()
+      if more!='':
+        since = time.time()
+      line += more
+      if not line.endswith('\n'): # Caught up with the writer
+        if line=='':
+          _wait(since, timeout, 'Streaming protocol stopped producing chunks')
+        else:
+          _wait(since, timeout, 'Streaming protocol stopped in the middle of a chunk')
+        continue
+      record = json.loads(line)
+      line = ''
+      yield record
+      if 'chunk' not in record:
+        return
+
+def _wait(since, timeout, problem):
+  if timeout>0 and time.time()-since>timeout:
+    raise RuntimeError(problem+' (nothing written for '+str(timeout)+' seconds)')
+  time.sleep(POLL_INTERVAL)
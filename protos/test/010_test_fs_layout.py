@@ -0,0 +1,112 @@
+from utils import *
+import os
+import os.path
+
+def test_place_file():
+  with protos.fs_layout.scratch_directory() as d:
+    src = os.path.join(d,'src')
+    with open(src,'w') as f:
+      f.write('contents')
+    dst = os.path.join(d,'dst')
+    how = protos.fs_layout.place_file(src, dst)
+    assert how in ['link','reflink','copy'], 'Unexpected placement method "'+how+'"'
+    assert os.path.isfile(src), 'Source file was moved'
+    assert open(dst).read()=='contents', 'Placed file corrupted'
+    assert protos.fs_layout.place_file(src, dst)=='none', 'Replaced a file with itself'
+
+def test_scratch_reuse():
+  with protos.fs_layout.scratch_directory() as root:
+    with protos.fs_layout.scratch_directory(root=root, reuse=True) as d1:
+      open(os.path.join(d1,'junk'),'w').close()
+    with protos.fs_layout.scratch_directory(root=root, reuse=True) as d2:
+      assert d1==d2, 'Scratch directory not reused'
+      assert os.listdir(d2)==[], 'Reused scratch directory not emptied'
+  assert not os.path.exists(d1), 'Reused scratch directory not cleaned up'
+
+def test_file_store():
+  with protos.fs_layout.scratch_directory() as d:
+    store = protos.file_store.File_Store(os.path.join(d,'store'))
+    for name in ['a','b']:
+      with open(os.path.join(d,name),'w') as f:
+        f.write('same contents')
+    ref_a = store.put(os.path.join(d,'a'))
+    ref_b = store.put(os.path.join(d,'b'))
+    assert protos.file_store.is_reference(ref_a), 'Bad file reference "'+ref_a+'"'
+    assert store.path(ref_a)==store.path(ref_b), 'Identical files stored twice'
+    assert open(store.path(ref_a)).read()=='same contents', 'Stored file corrupted'
+
+def test_file_store_sweep():
+  with protos.fs_layout.scratch_directory() as d:
+    store = protos.file_store.File_Store(os.path.join(d,'store'))
+    refs = []
+    for name in ['kept','dropped']:
+      with open(os.path.join(d,name),'w') as f:
+        f.write(name)
+      refs.append(store.put(os.path.join(d,name)))
+    digests = set([protos.file_store._digest(refs[0])])
+    assert store.sweep(digests, grace=3600.)==(0,0), 'Recently stored file swept'
+    assert store.sweep(digests, grace=0.)==(1,len('dropped')), 'Wrong files swept'
+    assert [store.exists(r) for r in refs]==[True,False], 'Referenced file swept'
+
+def test_file_store_external_files():
+  # Files protos doesn't own are copied into the store, so changing them later
+  # changes neither the stored copy nor the file's permissions.
+  data_dir = protos.config.data_dir
+  with protos.fs_layout.scratch_directory() as d:
+    protos.config.data_dir = d
+    try:
+      xscratch = os.path.join(d,'xscratch')
+      os.mkdir(xscratch)
+      user_file = os.path.join(d,'user_input.txt')
+      with open(user_file,'w') as f:
+        f.write('hello\n')
+      mode = os.stat(user_file).st_mode
+      owned_file = os.path.join(xscratch,'output.txt')
+      with open(owned_file,'w') as f:
+        f.write('output\n')
+      bundle = protos.Bundle(protos.data_bundles.Experiment_Data(0, None, 'x', xscratch))
+      bundle.add_file(user_file)
+      bundle.add_file(user_file, copy=True) # linked into the experiment scratch directory
+      bundle.add_file(owned_file)
+      refs = bundle._file_references()
+      with open(user_file,'a') as f:
+        f.write('more\n')
+      assert [open(protos.file_store.resolve(r)).read() for r in refs]==['hello\n','hello\n','output\n'], 'Stored file changed with the original'
+      assert os.stat(user_file).st_mode==mode, 'User file permissions changed'
+      assert os.stat(protos.file_store.resolve(refs[0])).st_nlink==1, 'User file linked into the store'
+    finally:
+      protos.config.data_dir = data_dir
+
+def test_spill_area():
+  class Bundle:
+    def __init__(self, n):
+      self.data = {'payload':'x'*n}
+  with protos.fs_layout.scratch_directory() as d:
+    # Bundle 0 is used at entries 5 and 9, bundle 1 at entry 3.
+    spill = protos.spill.Spill_Area(os.path.join(d,'spill'), 1500, {0:[5,9], 1:[3]})
+    (b0,b1) = (Bundle(1000), Bundle(1000))
+    spill.add(0, b0, 0)
+    spill.add(1, b1, 1)
+    assert b0.data is None and b1.data is not None, 'Spilled the wrong bundle'
+    spill.fetch(0, 5)
+    assert b0.data=={'payload':'x'*1000}, 'Spilled bundle not restored'
+    assert b1.data is None, 'Budget not enforced on reload'
+    spill.discard(1)
+    assert os.listdir(os.path.join(d,'spill'))==[], 'Spill files left behind'
+
+def test_spill_out_of_order():
+  class Bundle:
+    def __init__(self, n):
+      self.data = {'payload':'x'*n}
+  with protos.fs_layout.scratch_directory() as d:
+    # Entry 4 runs before entry 2, which still needs bundle 0.
+    spill = protos.spill.Spill_Area(os.path.join(d,'spill'), 2500, {0:[2], 1:[100], 2:[6]})
+    (b0,b1,b2) = (Bundle(1000), Bundle(1000), Bundle(1000))
+    spill.add(0, b0, 0)
+    spill.add(1, b1, 1)
+    spill.done(4)
+    spill.add(2, b2, 4)
+    assert b0.data is not None and b1.data is None, 'Spilled a bundle needed sooner'
+    spill.done(2)
+    spill.fetch(1, 100)
+    assert b0.data is None and b1.data is not None, 'Bundle kept after its last use'
@@ -0,0 +1,30 @@
+from utils import *
+import os
+import protos.protocol_index
+
+PROTOCOL_FILE = '''
+import protos
+open(%r,'a').write('x')
+@protos.protocol
+def %s(experiment):
+  return protos.Bundle(experiment)
+'''
+
+def test_protocol_index():
+  with protos.fs_layout.scratch_directory() as d:
+    loads = os.path.join(d,'loads')
+    os.mkdir(os.path.join(d,'sub'))
+    for (filename,func) in [('a.py','first'), ('sub/b.py','second')]:
+      with open(os.path.join(d,filename),'w') as f:
+        f.write(PROTOCOL_FILE % (loads,func))
+    index = protos.protocol_index.Protocol_Index(d, ['a.py','sub/b.py'])
+    assert sorted(index.keys())==['a.first','sub.b.second'], 'Wrong protocol names'
+    assert open(loads).read()=='xx', 'New protocol files not loaded'
+    index = protos.protocol_index.Protocol_Index(d, ['a.py','sub/b.py'])
+    assert open(loads).read()=='xx', 'Protocol files loaded before use'
+    assert index['sub.b.second'].dotted_name=='sub.b.second', 'Protocol not loaded on use'
+    assert open(loads).read()=='xxx', 'Protocol file not loaded exactly once'
+    with open(os.path.join(d,'a.py'),'w') as f:
+      f.write(PROTOCOL_FILE % (loads,'renamed'))
+    index = protos.protocol_index.Protocol_Index(d, ['a.py','sub/b.py'])
+    assert sorted(index.keys())==['a.renamed','sub.b.second'], 'Changed protocol file not reloaded'
@@ -0,0 +1,38 @@
+from utils import *
+import os
+import time
+import subprocess
+import nose
+
+def test_resource_usage():
+  with protos.fs_layout.scratch_directory() as d:
+    with protos.accounting.resource_usage(d) as usage:
+      time.sleep(0.1)
+      sum(xrange(2000000))
+      subprocess.call(['sh','-c','i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done'])
+      with open(os.path.join(d,'output'),'w') as f:
+        f.write('x'*1000)
+  assert usage['wall_time']>=0.1, 'Wall time not measured'
+  assert usage['cpu_time']>0, 'CPU time not measured'
+  assert usage['child_cpu_time']>0, 'Subprocess CPU time not measured'
+  assert usage['scratch_bytes']==1000, 'Scratch directory not measured'
+
+def test_peak_rss():
+  if not protos.accounting.reset_peak_rss():
+    raise nose.SkipTest
+  with protos.accounting.resource_usage() as big:
+    x = 'x'*(100*1024*1024)
+    del x
+  with protos.accounting.resource_usage() as small:
+    pass
+  assert big['peak_rss']>=100*1024*1024, 'Peak memory not measured'
+  assert small['peak_rss']<big['peak_rss']-50*1024*1024, 'Peak memory not reset between protocols'
+
+def test_accumulate():
+  totals = {}
+  protos.accounting.accumulate(totals, {'wall_time':1., 'cpu_time':0.5, 'peak_rss':100}, 'p')
+  protos.accounting.accumulate(totals, {'wall_time':2., 'cpu_time':1., 'peak_rss':50}, 'q')
+  protos.accounting.accumulate(totals, {'wall_time':3., 'scratch_bytes':10}, 'p')
+  assert totals['wall_time']==6. and totals['cpu_time']==1.5 and totals['scratch_bytes']==10, 'Usage not summed'
+  assert totals['peak_rss']==100, 'Peak memory should be the largest, not the sum'
+  assert totals['protocols']=={'p':4., 'q':2.}, 'Per-protocol wall time wrong'
@@ -0,0 +1,21 @@
+from utils import *
+import os
+import time
+
+def test_call_many():
+  with protos.fs_layout.scratch_directory() as d:
+    lines = []
+    codes = protos.call_many(['echo '+str(i) for i in range(5)], jobs=2, stdout=lambda i,line: lines.append((i,line)))
+    assert codes==[0]*5, 'Commands failed'
+    assert sorted(lines)==[(i,str(i)+'\n') for i in range(5)], 'Output not passed to callback'
+    protos.call_many(['echo out'+str(i) for i in range(3)], stdout=os.path.join(d,'cmd{0}.out'))
+    assert [open(os.path.join(d,'cmd'+str(i)+'.out')).read() for i in range(3)]==['out0\n','out1\n','out2\n'], 'Output not written to files'
+
+def test_call_many_failures():
+  start = time.time()
+  try:
+    protos.call_many(['true', 'false', 'sleep 10'], timeout=0.5)
+    assert False, 'Failures not reported'
+  except AssertionError as e:
+    assert 'Failed to run 2 of 3' in str(e), 'Wrong failures reported: '+str(e)
+  assert time.time()-start<5, 'Timeout not enforced'
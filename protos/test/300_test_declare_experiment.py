@@ -12,3 +12,104 @@ def test_experiment_exists():
   assert isinstance(x._storage, protos.storage_adapters.adapters.Datastore), 'Storage mechanisms never initialized'
   
   pass
+
+@protos.protocol
+def example_protocol(experiment, *args, **kwargs):
+  pass
+
+@set_config(storage='fake')
+def test_dependencies():
+  x = protos.experiment_support.Experiment(example_experiment)
+  gen = protos.data_bundles.Token_Generator
+  (t0,t1,t2) = (gen.new(), gen.new(), gen.new())
+  x._add(example_protocol, t0, [], {})
+  x._add(example_protocol, t1, [], {})
+  x._add(example_protocol, t2, [t0], {'other':t1})
+  deps = x._dependencies()
+  assert deps==[set([]),set([]),set([0,1])], 'Incorrect dependency graph'
+
+@set_config(storage='fake')
+def test_cache_keys():
+  x = protos.experiment_support.Experiment(example_experiment)
+  gen = protos.data_bundles.Token_Generator
+  (t0,t1,t2,t3) = (gen.new(), gen.new(), gen.new(), gen.new())
+  x._add(example_protocol, t0, [1], {})
+  x._add(example_protocol, t1, [1], {})
+  x._add(example_protocol, t2, [2], {})
+  x._add(example_protocol, t3, [t0], {})
+  keys = x._cache_keys()
+  assert keys[0]==keys[1], 'Identical invocations have different keys'
+  assert keys[0]!=keys[2], 'Different arguments have the same key'
+  assert len(set(keys))==3, 'Bundle arguments not included in key'
+
+@set_config(storage='fake')
+def test_eliminate_duplicates():
+  x = protos.experiment_support.Experiment(example_experiment)
+  gen = protos.data_bundles.Token_Generator
+  (t0,t1,t2,t3) = (gen.new(), gen.new(), gen.new(), gen.new())
+  x._add(example_protocol, t0, [1], {})
+  x._add(example_protocol, t1, [1], {})
+  x._add(example_protocol, t2, [t1], {})
+  x._add(example_protocol, t3, [t0], {})
+  duplicates = x._eliminate_duplicates()
+  assert len(x._schedule)==2, 'Duplicate invocations not eliminated'
+  assert x._schedule[1][2][0] is t0, 'Uses of a duplicate bundle not rewritten'
+  assert sorted([len(runs) for runs in duplicates.values()])==[1,1], 'Eliminated duplicates not recorded'
+  assert x._killsets()==[set([]),set([t0.id,t2.id])], 'Shared bundle killed early'
+
+@protos.sweep(a=[1,2], b=['x','y','z'])
+@protos.experiment
+def example_sweep(protocols, a, b):
+  protocols.builtin.tag(str(a)+b)
+
+@set_config(storage='fake')
+def test_sweep():
+  points = example_sweep.points()
+  assert len(points)==6, 'Incorrect number of sweep points'
+  assert {'a':2,'b':'y'} in points, 'Missing sweep point'
+  x = protos.experiment_support.Experiment(example_sweep)._build(example_sweep)
+  assert len(x._runs)==6, 'Sweep points not given their own runs'
+  assert all([run.metadata['tags']==[str(run.metadata['sweep']['a'])+run.metadata['sweep']['b']] for run in x._runs]), 'Sweep points built with the wrong parameters'
+
+@set_config(storage='fake')
+def test_several_experiments():
+  x = protos.experiment_support.Experiment(example_experiment)
+  x._build(example_experiment)._build(example_sweep)
+  assert len(x._runs)==7, 'Experiments not given their own runs'
+  assert [run.metadata['name'] for run in x._runs]==['example_experiment']+['example_sweep']*6, 'Runs named after the wrong experiments'
+
+def test_critical_paths():
+  # a -> b -> d, a -> c -> d
+  costs = [1.0, 5.0, 2.0, 1.0]
+  deps = [set([]), set([0]), set([0]), set([1,2])]
+  paths = protos.cost_model.critical_paths(costs, deps)
+  assert paths==[7.0, 6.0, 3.0, 1.0], 'Wrong critical path lengths'
+  estimate = protos.cost_model.Schedule_Estimate(costs, paths, jobs=2)
+  assert estimate.remaining()==7.0, 'Remaining time ignores the critical path'
+  estimate.finish(0)
+  estimate.finish(1)
+  assert estimate.remaining()==3.0, 'Finished protocols still counted'
+
+def test_calibrated_estimate():
+  # Without a history, the guesses are scaled by how long things really take.
+  estimate = protos.cost_model.Schedule_Estimate([1.0, 1.0], [2.0, 1.0], calibrate=True)
+  assert estimate.remaining()==2.0, 'Nothing measured yet, so the guess should stand'
+  estimate.finish(0)
+  assert estimate.remaining()<0.5, 'Estimate not calibrated by the time actually taken'
+
+# Earlier runs, newest first, each with one bundle that took xid seconds.
+class History(protos.storage_adapters.adapters.Datastore):
+  def __init__(self, xids):
+    self.xids = xids
+    self.read = []
+  def find_recent_experiments(self, pattern, count):
+    return self.xids[0:count]
+  def find_bundle_metadata(self, pattern, xid):
+    self.read.append(xid)
+    return [{'metadata':{'cost_key':'k', 'resources':{'wall_time':float(xid)}}}]
+
+def test_cost_history():
+  storage = History(['4','3','2','1'])
+  model = protos.cost_model.Cost_Model(storage, ['x'], history=2, exclude=['4'])
+  assert storage.read==['3','2'], 'Wrong experiments read for the cost history: '+str(storage.read)
+  assert model.predict('k')==3.0, 'Wrong cost predicted'
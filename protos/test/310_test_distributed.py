@@ -0,0 +1,164 @@
+from utils import *
+import os
+import multiprocessing
+import time
+import protos.distributed
+
+@protos.protocol
+def number(experiment, n):
+  b = protos.Bundle(experiment, name='number')
+  b.data['n'] = n
+  return b
+number.dotted_name = 'test.number'
+
+@protos.protocol
+def total(experiment, *bundles):
+  b = protos.Bundle(experiment, name='total')
+  b.data['n'] = sum([x.data['n'] for x in bundles])
+  assert b.data['n']==3, 'Wrong inputs'
+  return b
+total.dotted_name = 'test.total'
+
+@protos.experiment
+def example_distributed(protocols):
+  pass
+
+@set_config(storage='fake')
+def test_spool_workers():
+  protocols = {'test.number':number, 'test.total':total}
+  cwd = os.getcwd()
+  with protos.fs_layout.scratch_directory() as d:
+    spool = protos.distributed.Spool(d)
+    workers = [multiprocessing.Process(target=protos.distributed.run_worker, args=(spool,protocols)) for i in range(2)]
+    for w in workers:
+      w.start()
+    try:
+      x = protos.experiment_support.Experiment(example_distributed)
+      toks = [protos.data_bundles.Token_Generator.new() for i in range(4)]
+      for i in range(3):
+        x._add(number, toks[i], [i], {})
+      x._add(total, toks[3], toks[0:3], {})
+      protos.config.spool_dir = d
+      x._run()
+    finally:
+      protos.config.spool_dir = ''
+      spool.stop()
+      for w in workers:
+        w.join()
+      os.chdir(cwd)
+    assert x._runs[0].count==4, 'Not every protocol was run'
+    assert os.listdir(os.path.join(d,'tasks'))==[], 'Tasks left unclaimed'
+    assert os.listdir(os.path.join(d,'results'))==[], 'Results left uncollected'
+
+def test_spool_lease():
+  with protos.fs_layout.scratch_directory() as d:
+    spool = protos.distributed.Spool(d)
+    spool.submit('t', {})
+    assert spool.claim('w1')[0]=='t', 'Task not claimed'
+    assert spool.requeue(['t'], 10.)==[], 'Task with a fresh claim taken away'
+    os.utime(os.path.join(d,'claimed','t@w1.json'), (0,0)) # w1 has stopped renewing it
+    assert spool.requeue(['t'], 10.)==['t'], 'Abandoned task not taken back'
+    assert not spool.renew('t', 'w1'), 'Lease renewed after the task was taken back'
+    assert spool.claim('w2')[0]=='t', 'Requeued task not claimed again'
+    assert spool.renew('t', 'w2'), 'New claim not renewable'
+
+def test_spool_seal():
+  with protos.fs_layout.scratch_directory() as d:
+    spool = protos.distributed.Spool(d)
+    spool.submit('t', {})
+    spool.claim('w1')
+    os.utime(os.path.join(d,'claimed','t@w1.json'), (0,0))
+    spool.requeue(['t'], 10.)
+    spool.claim('w2')
+    assert not spool.seal('t', 'w1'), 'Task sealed by a worker it was taken from'
+    assert spool.seal('t', 'w2'), 'Task not sealed by the worker holding it'
+    os.utime(os.path.join(d,'claimed','t@w2.sealed'), (0,0))
+    assert spool.requeue(['t'], 10.)==[], 'Sealed task taken away'
+    spool.finish('t', 'w2', {'bundle':None, 'error':None})
+    assert os.listdir(os.path.join(d,'claimed'))==[], 'Sealed claim left behind'
+    assert spool.results(['t'])=={'t':{'bundle':None, 'error':None}}, 'Result not delivered'
+
+def test_spool_config_changes():
+  saved = protos.config.project_name
+  try:
+    with protos.fs_layout.scratch_directory() as d:
+      spool = protos.distributed.Spool(d)
+      worker = protos.distributed.Spool(d)
+      protos.config.project_name = 'first'
+      spool.publish_config()
+      assert worker.config_changed(), 'First config not noticed'
+      worker.load_config()
+      assert not worker.config_changed(), 'Adopted config seen as a change'
+      protos.config.project_name = 'second'
+      spool.publish_config()
+      protos.config.project_name = 'first'
+      assert worker.config_changed(), 'New config not noticed'
+      worker.load_config()
+      assert protos.config.project_name=='second', 'New config not adopted'
+  finally:
+    protos.config.project_name = saved
+
+def dying_worker(spool):
+  # Claims a task, then dies without finishing it.
+  while spool.claim('dead') is None:
+    time.sleep(0.01)
+  os._exit(1)
+
+def late_worker(spool, protocols):
+  # Doesn't start until the dying worker has taken a task.
+  claimed = os.path.join(spool.root,'claimed')
+  while not any(['@dead' in name for name in os.listdir(claimed)]):
+    time.sleep(0.01)
+  protos.distributed.run_worker(spool, protocols)
+
+def run_spooled(d):
+  x = protos.experiment_support.Experiment(example_distributed)
+  toks = [protos.data_bundles.Token_Generator.new() for i in range(4)]
+  for i in range(3):
+    x._add(number, toks[i], [i], {})
+  x._add(total, toks[3], toks[0:3], {})
+  cwd = os.getcwd()
+  saved = protos.config.spool_dir
+  protos.config.spool_dir = d
+  try:
+    x._run()
+  finally:
+    protos.config.spool_dir = saved
+    os.chdir(cwd)
+  return x
+
+@set_config(storage='fake')
+def test_spool_dead_worker():
+  protocols = {'test.number':number, 'test.total':total}
+  saved = protos.config.spool_lease
+  protos.config.spool_lease = 0.5
+  with protos.fs_layout.scratch_directory() as d:
+    spool = protos.distributed.Spool(d)
+    workers = [multiprocessing.Process(target=dying_worker, args=(spool,)), multiprocessing.Process(target=late_worker, args=(spool,protocols))]
+    for w in workers:
+      w.start()
+    try:
+      x = run_spooled(d)
+    finally:
+      protos.config.spool_lease = saved
+      spool.stop()
+      for w in workers:
+        w.join()
+    assert workers[0].exitcode==1, 'Worker did not die'
+    assert x._runs[0].count==4, 'Not every protocol was run'
+
+@set_config(storage='fake')
+def test_spool_timeout():
+  saved = protos.config.spool_timeout
+  protos.config.spool_timeout = 0.5
+  with protos.fs_layout.scratch_directory() as d:
+    start = time.time()
+    try:
+      run_spooled(d) # with no workers
+      assert False, 'Protocol without a worker did not fail'
+    except RuntimeError:
+      pass
+    finally:
+      protos.config.spool_timeout = saved
+    assert time.time()-start<5., 'Timed out too late'
+    assert os.listdir(os.path.join(d,'tasks'))==[], 'Task left for workers after it failed'
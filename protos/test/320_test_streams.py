@@ -0,0 +1,136 @@
+from utils import *
+import os
+import time
+import threading
+
+@protos.protocol
+def records(experiment, n):
+  b = protos.Bundle(experiment, name='records')
+  for i in range(n):
+    time.sleep(0.01)
+    yield {'i':i}
+  b.data['count'] = n
+  yield b
+
+@protos.protocol
+def summary(experiment, stream):
+  assert isinstance(stream, protos.Stream), 'Streaming protocol output not passed as a stream'
+  b = protos.Bundle(experiment, name='summary')
+  total = 0
+  for r in stream:
+    if r['i']==0 and protos.config.jobs>1:
+      # Running alongside the producer, so it can't have finished yet.
+      with open(stream._path) as f:
+        assert '"end"' not in f.read(), 'Consumer did not start until the producer finished'
+    total += r['i']
+  b.data['total'] = total
+  assert b.data['total']==45, 'Stream chunks corrupted'
+  assert stream.bundle.data['count']==10, 'Stream bundle corrupted'
+  return b
+
+@protos.experiment
+def example_streams(protocols):
+  pass
+
+def run_streams():
+  cwd = os.getcwd()
+  x = protos.experiment_support.Experiment(example_streams)
+  (t0,t1,t2) = [protos.data_bundles.Token_Generator.new() for i in range(3)]
+  x._add(records, t0, [10], {})
+  x._add(summary, t1, [t0], {})
+  x._add(summary, t2, [t0], {})
+  try:
+    x._run()
+  finally:
+    os.chdir(cwd)
+  assert x._runs[0].count==3, 'Not every protocol was run'
+
+@set_config(storage='fake', jobs=1)
+def test_streams_serial():
+  run_streams()
+
+@set_config(storage='fake', jobs=3, stream_buffer=2)
+def test_streams_pipelined():
+  try:
+    run_streams()
+  finally:
+    (protos.config.jobs, protos.config.stream_buffer) = (1, 1000)
+
+@set_config(stream_buffer=5)
+def test_stream_buffer():
+  try:
+    with protos.fs_layout.scratch_directory() as d:
+      path = os.path.join(d,'stream')
+      xdata = protos.data_bundles.Experiment_Data(1, None, '5', d)
+      writer = protos.streams.Stream_Writer(path)
+      writer.put(0)
+      chunks = iter(protos.Stream(path, xdata))
+      assert chunks.next()==0, 'Chunks corrupted' # The consumer is now reading
+      def produce():
+        for i in range(1,100):
+          writer.put(i)
+        writer.end(protos.Bundle(xdata, name='b'))
+      producer = threading.Thread(target=produce)
+      producer.daemon = True
+      producer.start()
+      time.sleep(0.3)
+      assert writer._count==5, 'Producer got '+str(writer._count)+' chunks ahead of its consumer'
+      assert [chunks.next() for i in range(3)]==[1,2,3], 'Chunks corrupted'
+      time.sleep(0.3)
+      assert writer._count==8, 'Producer got '+str(writer._count-3)+' chunks ahead of its consumer'
+      assert list(chunks)==range(4,100), 'Chunks corrupted'
+      producer.join(5.)
+      assert not producer.is_alive(), 'Producer still blocked after its consumer finished'
+  finally:
+    protos.config.stream_buffer = 1000
+
+class Stream_Timeout():
+  def __init__(self, timeout):
+    self.timeout = timeout
+  def __enter__(self):
+    (self.saved, protos.config.stream_timeout) = (protos.config.stream_timeout, self.timeout)
+  def __exit__(self, exc_type, exc_value, trace):
+    protos.config.stream_timeout = self.saved
+
+def read_stream(path):
+  chunks = []
+  try:
+    for chunk in protos.Stream(path, None):
+      chunks.append(chunk)
+  except RuntimeError as e:
+    return (chunks, str(e))
+  return (chunks, None)
+
+@protos.protocol
+def broken(experiment):
+  raise IOError('No input')
+
+@set_config(storage='fake')
+def test_stream_failed_early():
+  # The protocol fails before it even gets to be a generator.
+  cwd = os.getcwd()
+  with protos.fs_layout.scratch_directory() as d:
+    xdata = protos.data_bundles.Experiment_Data('t', protos.storage.mechanisms['fake'](), '5', d)
+    path = os.path.join(d,'.streams','t')
+    try:
+      protos.experiment_support._invoke(broken, xdata, [], {}, stream=path)
+      assert False, 'Protocol failure not raised'
+    except IOError:
+      pass
+    finally:
+      os.chdir(cwd)
+    with Stream_Timeout(5.):
+      (chunks,error) = read_stream(path)
+    assert error is not None and 'No input' in error, 'Consumers not told about the failure: '+str(error)
+
+def test_stream_timeouts():
+  with protos.fs_layout.scratch_directory() as d:
+    path = os.path.join(d,'stream')
+    with Stream_Timeout(0.2):
+      (chunks,error) = read_stream(path)
+      assert error is not None and 'never started' in error, 'Waited for a missing stream: '+str(error)
+      with open(path,'w') as f:
+        f.write('{"chunk": 1}\n{"chunk":')
+      (chunks,error) = read_stream(path)
+      assert chunks==[1], 'Chunks before the truncated one lost'
+      assert error is not None and 'middle of a chunk' in error, 'Waited for the rest of a truncated chunk: '+str(error)
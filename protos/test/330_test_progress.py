@@ -0,0 +1,93 @@
+from utils import *
+import threading
+
+# Records what the reporter writes, instead of writing it anywhere.
+class Recording_Storage(protos.storage_adapters.adapters.Datastore):
+  def __init__(self, partial=True):
+    self.partial = partial
+    self.writes = [] # ('write' or 'update', xid, metadata)
+    self.blocked = None
+  def write_experiment_metadata(self, metadata, xid):
+    if self.blocked is not None:
+      self.blocked.wait()
+    self.writes.append( ('write',xid,dict(metadata)) )
+  def update_experiment_metadata(self, fields, xid):
+    if not self.partial:
+      raise NotImplementedError('No partial updates')
+    self.writes.append( ('update',xid,dict(fields)) )
+
+class Reporter():
+  def __init__(self, storage):
+    self.storage = storage
+    self.saved = (protos.config.progress_interval, protos.config.progress_count)
+  def __enter__(self):
+    # Only write when the tests say so.
+    (protos.config.progress_interval, protos.config.progress_count) = (3600., 1000)
+    self.reporter = protos.progress.Progress_Reporter()
+    self.reporter._storage = self.storage
+    return self.reporter
+  def __exit__(self, exc_type, exc_value, trace):
+    self.reporter.close()
+    (protos.config.progress_interval, protos.config.progress_count) = self.saved
+
+@set_config(storage='fake')
+def test_progress_coalescing():
+  storage = Recording_Storage()
+  with Reporter(storage) as reporter:
+    reporter.track({'id':'x', 'name':'x', 'progress':0}, 'x')
+    for i in range(50):
+      reporter.update('x', progress=i)
+    reporter.flush()
+    assert storage.writes==[('write','x',{'id':'x', 'name':'x', 'progress':49})], 'Updates not coalesced into one write'
+    reporter.flush()
+    assert len(storage.writes)==1, 'Wrote metadata that had not changed'
+
+@set_config(storage='fake')
+def test_progress_partial_updates():
+  storage = Recording_Storage()
+  with Reporter(storage) as reporter:
+    reporter.track({'id':'x', 'name':'x', 'progress':0}, 'x')
+    reporter.flush()
+    reporter.update('x', progress=10)
+    reporter.update('x', progress=20, eta='later')
+    reporter.flush()
+    assert storage.writes[1:]==[('update','x',{'progress':20, 'eta':'later'})], 'Only changed fields should be updated'
+
+@set_config(storage='fake')
+def test_progress_full_write_fallback():
+  storage = Recording_Storage(partial=False)
+  with Reporter(storage) as reporter:
+    reporter.track({'id':'x', 'name':'x', 'progress':0}, 'x')
+    reporter.flush()
+    reporter.update('x', progress=10)
+    reporter.flush()
+    assert storage.writes[1:]==[('write','x',{'id':'x', 'name':'x', 'progress':10})], 'No full write for an adapter without partial updates'
+
+@set_config(storage='fake')
+def test_progress_flush_on_close():
+  storage = Recording_Storage()
+  with Reporter(storage) as reporter:
+    reporter.track({'id':'x', 'progress':0}, 'x')
+    reporter.update('x', progress=100)
+    reporter.close()
+    assert storage.writes==[('write','x',{'id':'x', 'progress':100})], 'Changes not written on close'
+
+@set_config(storage='fake')
+def test_progress_update_during_write():
+  storage = Recording_Storage()
+  storage.blocked = threading.Event()
+  with Reporter(storage) as reporter:
+    reporter.track({'id':'x', 'progress':0}, 'x')
+    flusher = threading.Thread(target=reporter.flush)
+    flusher.start()
+    # The write is stuck, but updates shouldn't wait for it.
+    done = threading.Event()
+    updater = threading.Thread(target=lambda: (reporter.update('x', progress=1), done.set()))
+    updater.daemon = True
+    updater.start()
+    finished = done.wait(5.)
+    storage.blocked.set()
+    flusher.join()
+    assert finished, 'update() blocked on a datastore write'
+    reporter.flush()
+    assert storage.writes[-1]==('update','x',{'progress':1}), 'Update made during a write was lost'
@@ -0,0 +1,78 @@
+from utils import *
+import threading
+import time
+
+# Records the batches the writer writes, instead of writing them anywhere.
+class Recording_Storage(protos.storage_adapters.adapters.Datastore):
+  def __init__(self, fail=False, delay=0.):
+    self.fail = fail
+    self.delay = delay
+    self.batches = [] # (xid, [bundle ids])
+    self.writing = threading.Event() # set when a write starts
+    self.go = threading.Event() # writes wait for this
+    self.go.set()
+  def write_bundles(self, bundles, xid):
+    self.writing.set()
+    self.go.wait()
+    time.sleep(self.delay)
+    self.batches.append( (xid,[b['metadata']['id'] for b in bundles]) )
+    self.last = bundles
+    if self.fail:
+      raise IOError('Datastore is broken')
+
+def writer(storage):
+  w = protos.persistence.Bundle_Writer()
+  w._storage = storage
+  return w
+
+def bundle(i):
+  return {'metadata':{'id':'b'+str(i)}, 'data':{'values':[i]}, 'files':[]}
+
+@set_config(storage='fake')
+def test_writer_snapshot():
+  storage = Recording_Storage()
+  storage.go.clear()
+  w = writer(storage)
+  b = bundle(0)
+  w.put(b, 'x')
+  b['data']['values'].append(1) # protocols can do this to their inputs
+  storage.go.set()
+  w.close()
+  assert storage.last[0]['data']=={'values':[0]}, 'Bundle persisted as it was after put()'
+
+@set_config(storage='fake')
+def test_writer_drains_on_close():
+  storage = Recording_Storage(delay=0.01)
+  w = writer(storage)
+  for i in range(10):
+    w.put(bundle(i), 'x' if i<5 else 'y')
+  w.close()
+  assert [bid for (xid,bids) in storage.batches if xid=='x' for bid in bids]==['b'+str(i) for i in range(5)], 'Bundles lost or reordered'
+  assert [bid for (xid,bids) in storage.batches if xid=='y' for bid in bids]==['b'+str(i) for i in range(5,10)], 'Bundles lost or reordered'
+
+@set_config(storage='fake')
+def test_writer_errors():
+  storage = Recording_Storage(fail=True)
+  storage.go.clear()
+  w = writer(storage)
+  w.put(bundle(0), 'x')
+  storage.writing.wait(5.)
+  # Queued while the first (failing) write is in progress.
+  w.put(bundle(1), 'x')
+  w.put(bundle(2), 'x')
+  storage.go.set()
+  for i in range(500):
+    if w._error is not None:
+      break
+    time.sleep(0.01)
+  try:
+    w.put(bundle(3), 'x')
+    assert False, 'Write error not raised by put()'
+  except RuntimeError:
+    pass
+  try:
+    w.close()
+    assert False, 'Write error not raised by close()'
+  except RuntimeError:
+    pass
+  assert storage.batches==[('x',['b0'])], 'Kept writing after an error'
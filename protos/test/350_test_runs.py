@@ -0,0 +1,162 @@
+from utils import *
+import os
+import time
+import threading
+import multiprocessing
+
+# These run whole experiments against a real (scratch) datastore.
+class Scratch_Project():
+  def __enter__(self):
+    self.saved = (protos.config.data_dir, protos.config.storage)
+    self.scratch = protos.fs_layout.scratch_directory()
+    protos.config.data_dir = self.scratch.__enter__()
+    protos.config.storage = 'disk'
+    return protos.config.data_dir
+  def __exit__(self, exc_type, exc_value, trace):
+    (protos.config.data_dir, protos.config.storage) = self.saved
+    self.scratch.__exit__(exc_type, exc_value, trace)
+
+runs = [] # names of the protocols run, in order
+failing = set([]) # names of protocols that should fail
+slow = set(['a']) # names of protocols that take a while
+
+@protos.protocol
+def step(experiment, name, *inputs):
+  runs.append(name)
+  if name in failing:
+    raise RuntimeError('Protocol '+name+' failed')
+  if name in slow:
+    time.sleep(0.2)
+  b = protos.Bundle(experiment, name='step')
+  b.data['value'] = name+'('+','.join([i.data['value'] for i in inputs])+')'
+  return b
+
+# A protocol's own bundle class, with an attribute of its own.
+class Tally(protos.Bundle):
+  def __init__(self, experiment):
+    protos.Bundle.__init__(self, experiment, name='tally')
+    self.count = 1
+
+@protos.protocol
+def tally(experiment, name, *inputs):
+  b = Tally(experiment)
+  b.count += sum([i.count for i in inputs])
+  b.data['value'] = name+str(b.count)
+  return b
+
+@protos.experiment
+def chain(protocols):
+  pass
+
+def run(schedule, xid=None, protocol=step):
+  # Runs a schedule of (name, [input indices]) entries, and returns the experiment.
+  cwd = os.getcwd()
+  x = protos.experiment_support.Experiment(chain, xid=xid)
+  toks = [protos.data_bundles.Token_Generator.new() for s in schedule]
+  for (tok,(name,inputs)) in zip(toks,schedule):
+    x._add(protocol, tok, [name]+[toks[i] for i in inputs], {})
+  del runs[:]
+  try:
+    x._run()
+  finally:
+    os.chdir(cwd)
+  return x
+
+def stored_values(x):
+  return sorted([b['data']['value'] for b in x._storage.find_bundles({}, x._runs[0].xid)])
+
+@set_config(jobs=1, memoize=False)
+def test_resume():
+  schedule = [('a',[]), ('b',[0]), ('c',[1]), ('d',[0])]
+  with Scratch_Project():
+    failing.add('c')
+    try:
+      run(schedule)
+      assert False, 'Protocol failure not raised'
+    except RuntimeError:
+      pass
+    finally:
+      failing.clear()
+    xid = protos.query.search_experiments({'metadata':{'name':'chain'}})[0].id
+    earlier = protos.storage.mechanisms['disk']().read_experiment_metadata(xid)['resources']
+    x = run(schedule, xid=xid)
+    assert sorted(runs)==['c','d'], 'Completed protocols run again: '+str(runs)
+    assert stored_values(x)==['a()','b(a())','c(b(a()))','d(a())'], 'Resumed experiment incomplete'
+    resources = x._storage.read_experiment_metadata(xid)['resources']
+    assert earlier['wall_time']>=0.2, 'Usage of the failed attempt not recorded'
+    assert resources['wall_time']>=earlier['wall_time'], 'Usage of the failed attempt dropped from the roll-up'
+
+@set_config(jobs=2, memoize=False, async_persist=True)
+def test_parallel():
+  schedule = [('a',[]), ('b',[0]), ('c',[0]), ('d',[1,2]), ('e',[])]
+  # Workers must be forked before any of our threads exist.
+  threads = []
+  fork = multiprocessing.Pool
+  def pool(*args, **kwargs):
+    threads.extend([t.name for t in threading.enumerate() if t.name.startswith('protos-')])
+    return fork(*args, **kwargs)
+  multiprocessing.Pool = pool
+  try:
+    with Scratch_Project():
+      x = run(schedule)
+      assert stored_values(x)==['a()','b(a())','c(a())','d(b(a()),c(a()))','e()'], 'Parallel run produced the wrong bundles'
+  finally:
+    multiprocessing.Pool = fork
+    (protos.config.jobs, protos.config.async_persist) = (1, False)
+  assert threads==[], 'Workers forked while threads were running: '+str(threads)
+
+@set_config(jobs=1, memoize=True)
+def test_memoize():
+  try:
+    with Scratch_Project():
+      run([('a',[]), ('b',[0]), ('c',[1])])
+      x = run([('a',[]), ('b',[0]), ('c',[1])])
+      assert runs==[], 'Unchanged protocols run again: '+str(runs)
+      assert stored_values(x)==['a()','b(a())','c(b(a()))'], 'Reused bundles not recorded'
+      # A different input to b changes b and c, but not a.
+      x = run([('a',[]), ('b',[]), ('c',[1])])
+      assert runs==['b','c'], 'Wrong protocols run after an input changed: '+str(runs)
+      assert stored_values(x)==['a()','b()','c(b())'], 'Wrong bundles after an input changed'
+  finally:
+    protos.config.memoize = False
+
+@set_config(jobs=2, memoize=False, memory_budget=1e-6)
+def test_parallel_spill():
+  # Next to no memory, so nearly every bundle is spilled while others run.
+  schedule = [('a',[]), ('b',[0]), ('c',[]), ('d',[1,2]), ('e',[0,3])]
+  try:
+    with Scratch_Project():
+      x = run(schedule)
+      assert stored_values(x)==['a()','b(a())','c()','d(b(a()),c())','e(a(),d(b(a()),c()))'], 'Spilled bundles corrupted'
+  finally:
+    (protos.config.jobs, protos.config.memory_budget) = (1, 0)
+
+@set_config(jobs=1, memoize=False)
+def test_serial_cost_history():
+  with Scratch_Project():
+    run([('a',[]), ('b',[0])])
+    x = run([('a',[]), ('b',[0])])
+    # a is slow, so it's most of the work even when protocols run one at a time.
+    assert x._costs[0]>=0.2 and x._costs[1]<0.1, 'Serial run ignored the cost history: '+str(x._costs)
+
+@set_config(jobs=2, memoize=False)
+def test_parallel_bundle_class():
+  # Workers and the experiment rebuild each other's bundles as Tally objects.
+  try:
+    with Scratch_Project():
+      x = run([('a',[]), ('b',[0]), ('c',[0,1])], protocol=tally)
+      assert stored_values(x)==['a1','b2','c4'], 'Bundle attributes lost between processes: '+str(stored_values(x))
+  finally:
+    protos.config.jobs = 1
+
+@set_config(jobs=1, memoize=False, deduplicate=True)
+def test_duplicate_progress():
+  # Both a's are run once, and their cost is only counted once.
+  try:
+    with Scratch_Project():
+      x = run([('a',[]), ('b',[0]), ('a',[])])
+      r = x._runs[0]
+      assert runs==['a','b'], 'Duplicate not eliminated: '+str(runs)
+      assert abs(r.done-r.work)<1e-6, 'Progress counted a merged invocation twice: '+str((r.done,r.work))
+  finally:
+    protos.config.deduplicate = False
@@ -1,5 +1,6 @@
 from utils import *
 import os
+import json
 
 ##### Make sure adapters return sane values for null requests.
 
@@ -13,3 +14,209 @@ def test_disk_expsearch():
   xs = protos.query.search_experiments({})
   assert type(xs) is list, 'Bad return value'
 
+
+@set_config(data_dir='/tmp/data', storage='disk')
+def test_disk_bundle_handles():
+  disk = protos.storage.mechanisms['disk']()
+  xid = disk.create_experiment_id('handles')
+  try:
+    disk.write_experiment_metadata({'id':xid, 'name':'handles'}, xid)
+    for i in range(3):
+      disk.write_bundle({'metadata':{'id':'b'+str(i), 'bundle_type':'test'}, 'data':{'i':i}, 'files':[]}, xid)
+    assert protos.query.exact_experiment(xid).exact_bundle('b1')['data']=={'i':1}, 'Wrong bundle found'
+    handle = protos.query.Bundle_Handle(disk, xid, {'metadata':{'id':'b2'}})
+    assert not handle.loaded, 'Handle loaded too early'
+    protos.query.prefetch([handle])
+    assert handle.loaded and handle['data']=={'i':2}, 'Handle not loaded by prefetch'
+    xdata = protos.data_bundles.Experiment_Data(0, disk, xid, '/tmp')
+    bundle = protos.Bundle(xdata, _init=protos.query.Bundle_Handle(disk, xid, {'metadata':{'id':'b0'}}))
+    assert bundle.data=={'i':0} and bundle.metadata['bundle_type']=='test', 'Handle not usable as a stored bundle'
+  finally:
+    disk.delete_experiment(xid)
+
+@set_config(storage='disk')
+def test_disk_experiment_index():
+  data_dir = protos.config.data_dir
+  with protos.fs_layout.scratch_directory() as d:
+    protos.config.data_dir = d
+    try:
+      check_experiment_index(d)
+    finally:
+      protos.config.data_dir = data_dir
+
+def check_experiment_index(d):
+  disk = protos.storage.mechanisms['disk']()
+  xids = []
+  for (name,tags,t) in [('a',['x'],'2016-01-01'), ('a',['y'],'2016-02-01'), ('b',['x','y'],'2016-03-01')]:
+    xid = disk.create_experiment_id(name)
+    disk.write_experiment_metadata({'id':xid, 'name':name, 'tags':tags, 'time':t+'_00-00-00-000000_UTC'}, xid)
+    xids.append(xid)
+  assert sorted(disk.find_experiments({'metadata':{'name':'a'}}))==sorted(xids[0:2]), 'Wrong experiments found by name'
+  assert sorted(disk.find_experiments({'metadata':{'tags':['y']}}))==sorted(xids[1:3]), 'Wrong experiments found by tag'
+  assert disk.find_experiments({'metadata':{'id':xids[2], 'name':'a'}})==[], 'Id lookup ignores the rest of the pattern'
+  assert sorted(disk.find_experiments_between({}, '2016-02', '2016-03-01'))==sorted(xids[1:3]), 'Wrong experiments found by time'
+  assert disk.find_recent_experiments({}, 2)==[xids[2],xids[1]], 'Wrong recent experiments found'
+  disk.delete_experiment(xids[0])
+  assert xids[0] not in disk.find_experiments({}), 'Deleted experiment still indexed'
+  # Changes protos didn't make should be noticed, too.
+  import shutil
+  shutil.rmtree(disk._get_xpath(xids[1]))
+  assert disk.find_experiments({})==[xids[2]], 'Stale index not rebuilt'
+
+@set_config(data_dir='/tmp/data', storage='disk')
+def test_disk_bundle_manifest():
+  disk = protos.storage.mechanisms['disk']()
+  xid = disk.create_experiment_id('manifest')
+  try:
+    disk.write_experiment_metadata({'id':xid, 'name':'manifest'}, xid)
+    for i in range(3):
+      disk.write_bundle({'metadata':{'id':'b'+str(i), 'bundle_type':'even' if i%2==0 else 'odd'}, 'data':{'i':i}, 'files':[]}, xid)
+    found = disk.find_bundle_metadata({'metadata':{'bundle_type':'even'}}, xid)
+    assert sorted([b['metadata']['id'] for b in found])==['b0','b2'], 'Wrong bundles found in manifest'
+    assert 'data' not in found[0], 'Bundle bodies read for a metadata search'
+    assert [b['metadata']['id'] for b in disk.find_bundles({'data':{'i':1}}, xid)]==['b1'], 'Wrong bundles found by data'
+    # Bundles written without updating the manifest are still found.
+    os.remove(os.path.join(disk._get_xpath(xid), '.manifest'))
+    with open(os.path.join(disk._get_xpath(xid), 'b3'), 'w') as f:
+      json.dump({'metadata':{'id':'b3', 'bundle_type':'odd'}, 'data':{}, 'files':[]}, f)
+    assert sorted([b['metadata']['id'] for b in disk.find_bundle_metadata({'metadata':{'bundle_type':'odd'}}, xid)])==['b1','b3'], 'Manifest not repaired'
+  finally:
+    disk.delete_experiment(xid)
+
+def test_serialization():
+  from protos.storage_adapters import serialization
+  value = {'data':{'xs':range(100), 's':'text'}, 'files':[], 'metadata':{'id':'b0'}}
+  for codec in serialization.CODECS:
+    for compression in ['','gzip']:
+      s = serialization.encode(value, codec, compression)
+      assert serialization.decode(s)==value, 'Value changed by '+codec+' '+compression
+  assert serialization.decode(json.dumps(value,indent=2))==value, 'Old JSON files no longer readable'
+
+@set_config(data_dir='/tmp/data', storage='disk')
+def test_disk_compressed():
+  disk = protos.storage.mechanisms['disk']()
+  xid = disk.create_experiment_id('compressed')
+  try:
+    protos.config.codec = 'marshal'
+    protos.config.compression = 'gzip'
+    disk.write_experiment_metadata({'id':xid, 'name':'compressed'}, xid)
+    disk.write_bundle({'metadata':{'id':'b0'}, 'data':{'xs':range(1000)}, 'files':[]}, xid)
+    protos.config.codec = 'json'
+    protos.config.compression = ''
+    assert disk.read_experiment_metadata(xid)['name']=='compressed', 'Compressed metadata not readable'
+    assert disk.find_bundles({'metadata':{'id':'b0'}}, xid)[0]['data']['xs']==range(1000), 'Compressed bundle not readable'
+  finally:
+    protos.config.codec = 'json'
+    protos.config.compression = ''
+    disk.delete_experiment(xid)
+
+@set_config(storage='disk')
+def test_disk_layout_migration():
+  data_dir = protos.config.data_dir
+  with protos.fs_layout.scratch_directory() as d:
+    protos.config.data_dir = d
+    try:
+      check_layout_migration(d)
+    finally:
+      protos.config.data_dir = data_dir
+
+def check_layout_migration(d):
+  # An experiment stored the old way, straight in the project directory.
+  xpath = os.path.join(d, protos.config.project_name, 'old_x')
+  os.makedirs(xpath)
+  with open(os.path.join(xpath,'metadata'),'w') as f:
+    json.dump({'id':'old_x', 'name':'old'}, f, indent=2)
+  with open(os.path.join(xpath,'b0'),'w') as f:
+    json.dump({'metadata':{'id':'b0'}, 'data':{'i':0}, 'files':[]}, f, indent=2)
+  disk = protos.storage.mechanisms['disk']()
+  assert disk.find_experiments({'metadata':{'name':'old'}})==['old_x'], 'Flat experiment not found'
+  assert disk.find_bundles({'metadata':{'id':'b0'}}, 'old_x')[0]['data']=={'i':0}, 'Flat bundle not found'
+  assert disk.migrate_layout()==1, 'Experiment not migrated'
+  assert not os.path.isdir(xpath), 'Experiment left in place'
+  assert disk._get_xpath('old_x')!=xpath and os.path.isdir(disk._get_xpath('old_x')), 'Experiment not sharded'
+  assert disk.find_experiments({'metadata':{'name':'old'}})==['old_x'], 'Migrated experiment not found'
+  assert [b['metadata']['id'] for b in disk.find_bundle_metadata({}, 'old_x')]==['b0'], 'Migrated bundle not found'
+  assert disk.read_bundles(['b0'], 'old_x')[0]['data']=={'i':0}, 'Migrated bundle not readable'
+  assert disk.migrate_layout()==0, 'Migration not idempotent'
+
+@set_config(storage='disk')
+def test_disk_interrupted_migration():
+  data_dir = protos.config.data_dir
+  move = protos.storage_adapters.disk.move
+  with protos.fs_layout.scratch_directory() as d:
+    protos.config.data_dir = d
+    try:
+      project = os.path.join(d, protos.config.project_name)
+      for xid in ['x0','x1']:
+        os.makedirs(os.path.join(project, xid))
+        with open(os.path.join(project, xid, 'metadata'),'w') as f:
+          json.dump({'id':xid, 'name':'old'}, f)
+        with open(os.path.join(project, xid, 'b_'+xid),'w') as f:
+          json.dump({'metadata':{'id':'b_'+xid}, 'data':{}, 'files':[]}, f)
+      moves = []
+      def failing_move(src, dst):
+        if len(moves)==2: # one experiment (and its bundle) moved
+          raise OSError('Interrupted')
+        moves.append(dst)
+        move(src, dst)
+      protos.storage_adapters.disk.move = failing_move
+      disk = protos.storage.mechanisms['disk']()
+      try:
+        disk.migrate_layout()
+        assert False, 'Migration not interrupted'
+      except OSError:
+        pass
+      finally:
+        protos.storage_adapters.disk.move = move
+      assert not os.path.isfile(os.path.join(project, '.layout')), 'Project marked as sharded before migrating'
+      for xid in ['x0','x1']:
+        assert [b['metadata']['id'] for b in disk.find_bundles({}, xid)]==['b_'+xid], 'Bundles lost by an interrupted migration'
+      assert disk.migrate_layout()==1, 'Migration not resumed'
+      assert disk._layout.sharded, 'Project not marked as sharded'
+    finally:
+      protos.config.data_dir = data_dir
+
+@set_config(storage='disk')
+def test_disk_manifest_disagrees():
+  data_dir = protos.config.data_dir
+  with protos.fs_layout.scratch_directory() as d:
+    protos.config.data_dir = d
+    try:
+      disk = protos.storage.mechanisms['disk']()
+      xid = disk.create_experiment_id('manifest')
+      disk.write_experiment_metadata({'id':xid, 'name':'manifest'}, xid)
+      for bid in ['b0','b1']:
+        disk.write_bundle({'metadata':{'id':bid}, 'data':{}, 'files':[]}, xid)
+      # Swap b1's manifest entry for one whose file doesn't exist.
+      xpath = disk._get_xpath(xid)
+      with open(os.path.join(xpath,'.manifest'),'w') as f:
+        for bid in ['b0','gone']:
+          f.write(json.dumps({'id':bid, 'metadata':{'id':bid}})+'\n')
+      protos.storage_adapters.disk_index._manifests.clear()
+      assert sorted([b['metadata']['id'] for b in disk.find_bundles({}, xid)])==['b0','b1'], 'Manifest trusted over the bundle files'
+    finally:
+      protos.config.data_dir = data_dir
+
+@set_config(storage='disk')
+def test_disk_index_read_lock():
+  data_dir = protos.config.data_dir
+  lockf = protos.storage_adapters.disk_index.fcntl.lockf
+  locks = []
+  def recording_lockf(f, op):
+    locks.append(op)
+    return lockf(f, op)
+  with protos.fs_layout.scratch_directory() as d:
+    protos.config.data_dir = d
+    try:
+      disk = protos.storage.mechanisms['disk']()
+      xid = disk.create_experiment_id('locks')
+      disk.write_experiment_metadata({'id':xid, 'name':'locks'}, xid)
+      protos.storage_adapters.disk_index.fcntl.lockf = recording_lockf
+      disk.find_experiments({}) # builds the snapshot
+      assert locks[-1]==protos.storage_adapters.disk_index.fcntl.LOCK_EX, 'Snapshot written without an exclusive lock'
+      del locks[:]
+      assert disk.find_experiments({})==[xid], 'Experiment not found'
+      assert locks==[protos.storage_adapters.disk_index.fcntl.LOCK_SH], 'Search of a fresh index not done under a shared lock'
+    finally:
+      protos.storage_adapters.disk_index.fcntl.lockf = lockf
+      protos.config.data_dir = data_dir
@@ -17,6 +17,42 @@ def test_sanitize():
   for (lhs,rhs,why) in cases:
     assert sani(lhs)==rhs, why
 
+# Stands in for a psycopg2 connection, so pooling can be tested without a server.
+class Pretend_Connection():
+  opened = 0
+  def __init__(self):
+    Pretend_Connection.opened += 1
+    self.closed = 0
+    self.broken = False
+  def close(self):
+    self.closed = 1
+  def cursor(self, cursor_factory=None):
+    return self
+  def execute(self, sql):
+    if self.broken:
+      raise protos.storage_adapters.postgres.pg.OperationalError('server closed the connection')
+  def commit(self):
+    pass
+  def rollback(self):
+    pass
+
+def test_connection_pool():
+  Pretend_Connection.opened = 0
+  pool = protos.storage_adapters.postgres.Connection_Pool(Pretend_Connection)
+  with protos.storage_adapters.postgres.Borrowed(pool) as c1:
+    pass
+  with protos.storage_adapters.postgres.Borrowed(pool) as c2:
+    with protos.storage_adapters.postgres.Borrowed(pool) as c3:
+      pass
+  assert c1 is c2 and c2 is not c3, 'Connections not reused'
+  assert Pretend_Connection.opened==2, 'Too many connections opened'
+  # Connections that have been idle are checked before they're reused.
+  c2.broken = True
+  pool._idle = [(conn,since-protos.storage_adapters.postgres.HEALTH_CHECK_AFTER) for (conn,since) in pool._idle]
+  with protos.storage_adapters.postgres.Borrowed(pool) as c4:
+    assert c4 is c3 and c2.closed!=0, 'Broken connection not dropped'
+  assert Pretend_Connection.opened==2, 'Healthy connection not reused'
+
 # Auto-cleanup for test database tables
 class ProjectDB():
   def __init__(self):
@@ -29,21 +65,22 @@ class ProjectDB():
     self.pg = protos.storage_adapters.postgres.Postgres()
     return self.pg
   def __exit__(self, exc_type, exc_value, trace):
-    self.pg._set_role_rw()
-    with protos.storage_adapters.postgres.Transaction(self.pg._conn) as x:
+    with self.pg._connection() as conn, protos.storage_adapters.postgres.Transaction(conn) as x:
       x.execute('DROP TABLE IF EXISTS test_project CASCADE')
       x.execute('DROP TABLE IF EXISTS test_project_bundles CASCADE')
+    self.pg._pool.initialized.discard('test_project') # so the tables are made again
 
 @set_config(storage='postgres', storage_server=STORAGE_SERVER, project_name='test_project')
 def test_authentication():
   with ProjectDB() as pg:
-    assert pg._conn.closed==0, 'Connection failed'
+    with pg._connection() as conn:
+      assert conn.closed==0, 'Connection failed'
 
 
 @set_config(storage='postgres', storage_server=STORAGE_SERVER, project_name='test_project')
 def test_init():
   with ProjectDB() as pg:
-    with protos.storage_adapters.postgres.Transaction(pg._conn) as x:
+    with pg._connection() as conn, protos.storage_adapters.postgres.Transaction(conn) as x:
       x.execute('SELECT xid FROM "test_project" WHERE false')
       x.execute('SELECT xid FROM "test_project_bundles" WHERE false')
       # We don't care about the result. Just testing whether the table exists.
@@ -52,13 +89,13 @@ def test_init():
 def test_xid():
   with ProjectDB() as pg:
     xid = pg.create_experiment_id('x1')
-    with protos.storage_adapters.postgres.Transaction(pg._conn) as x:
+    with pg._connection() as conn, protos.storage_adapters.postgres.Transaction(conn) as x:
       x.execute('SELECT * FROM test_project;')
       r = x.fetchall()
       assert len(r)==1, 'Incorrect number of results.'
 
     xid = pg.create_experiment_id('x2')
-    with protos.storage_adapters.postgres.Transaction(pg._conn) as x:
+    with pg._connection() as conn, protos.storage_adapters.postgres.Transaction(conn) as x:
       x.execute('SELECT * FROM test_project;')
       r = x.fetchall()
       assert len(r)==2, 'Incorrect number of results.'
@@ -130,6 +167,16 @@ def test_bundles():
     assert b['metadata']['bundle_type']==b3['metadata']['bundle_type'], 'bundle type corrupted'
     assert b['metadata']['time']==b3['metadata']['time'], 'time corrupted'
 
+@set_config(storage='postgres', storage_server=STORAGE_SERVER, project_name='test_project')
+def test_bundle_ids():
+  with ProjectDB() as pg:
+    x = pg.create_experiment_id('x')
+    bundles = [{'metadata': {'bundle_type':'placeholder'}, 'data': {'i':i}, 'files': [] } for i in range(20)]
+    bids = pg.write_bundles(bundles, x)
+    assert len(set(bids))==20, 'Bad bundle ids'
+    for i in range(20):
+      assert pg.read_bundles([bids[i]], x)[0]['data']=={'i':i}, 'Bundle ids returned out of order'
+
 
 @set_config(storage='postgres', storage_server=STORAGE_SERVER, project_name='test_project')
 def test_delete_experiment():
@@ -155,3 +202,22 @@ def test_delete_experiment():
     bids = pg.find_bundles({},x)
     assert len(bids)==0, 'Bundle still exists after deleting'
 
+
+@set_config(storage='postgres', storage_server=STORAGE_SERVER, project_name='test_project')
+def test_round_trips():
+  with ProjectDB() as pg:
+    x = pg.create_experiment_id('x')
+    pg.write_experiment_metadata({'id':x, 'name':'x', 'progress':'0'}, x)
+    pg.update_experiment_metadata({'progress':'50'}, x)
+    pg.read_experiment_metadata(x)
+    pg.find_experiments({'metadata':{'name':'x'}})
+    b = {'metadata': {'bundle_type':'placeholder', 'time':'now'}, 'data': {'values':[0, 1, 2]}, 'files': [] }
+    bid = pg.write_bundle(b, x)
+    bids = pg.write_bundles([b,b,b], x)
+    assert bids[0]>bid and len(set(bids))==3, 'Bad bundle ids'
+    pg.find_bundles({}, x)
+    pg.read_bundles(bids, x)
+    pg.delete_experiment(x)
+    for (op,n) in sorted(pg.round_trips.items()):
+      assert n==1, op+' took '+str(n)+' round trips'
+    assert len(pg.round_trips)==10, 'Round trips not counted for every operation'
@@ -0,0 +1,66 @@
+from utils import *
+
+# Each test gets a fresh database in a scratch data directory.
+class ProjectDB():
+  def __enter__(self):
+    self.data_dir = protos.config.data_dir
+    self.scratch = protos.fs_layout.scratch_directory()
+    protos.config.data_dir = self.scratch.__enter__()
+    return protos.storage_adapters.sqlite.Sqlite()
+  def __exit__(self, exc_type, exc_value, trace):
+    protos.config.data_dir = self.data_dir
+    self.scratch.__exit__(exc_type, exc_value, trace)
+
+@set_config(storage='sqlite', project_name='test_project')
+def test_wal():
+  with ProjectDB() as db:
+    assert db._conn.execute('PRAGMA journal_mode').fetchone()[0]=='wal', 'Database not in WAL mode'
+
+@set_config(storage='sqlite', project_name='test_project')
+def test_experiment_metadata():
+  with ProjectDB() as db:
+    xid = db.create_experiment_id('x1')
+    md = db.read_experiment_metadata(xid)
+    assert md['id']==xid and md['name']=='x1', 'New experiment has the wrong metadata'
+    md = {'id':xid, 'name':'example', 'tags':['tag1','tag2'], 'progress':'60', 'resources':{'wall_time':1.5}}
+    db.write_experiment_metadata(md, xid)
+    assert db.read_experiment_metadata(xid)==md, 'Metadata corrupted'
+    db.update_experiment_metadata({'progress':'100', 'resources':{'wall_time':2.0}}, xid)
+    md_back = db.read_experiment_metadata(xid)
+    assert md_back['progress']=='100' and md_back['resources']=={'wall_time':2.0}, 'Metadata not updated'
+    assert md_back['tags']==['tag1','tag2'], 'Update changed other fields'
+
+@set_config(storage='sqlite', project_name='test_project')
+def test_find_experiments():
+  with ProjectDB() as db:
+    xids = []
+    for (name,tags,t) in [('a',['x'],'2016-01-01'), ('a',['y'],'2016-02-01'), ('b',['x','y'],'2016-03-01')]:
+      xid = db.create_experiment_id(name)
+      db.write_experiment_metadata({'id':xid, 'name':name, 'tags':tags, 'time':t+'_00-00-00-000000_UTC'}, xid)
+      xids.append(xid)
+    assert db.find_experiments({})==xids, 'Couldnt find all the experiments'
+    assert db.find_experiments({'metadata':{'name':'a'}})==xids[0:2], 'Wrong experiments found by name'
+    assert db.find_experiments({'metadata':{'tags':['y']}})==xids[1:3], 'Wrong experiments found by tag'
+    assert db.find_experiments({'metadata':{'id':xids[2], 'name':'a'}})==[], 'Id lookup ignores the rest of the pattern'
+    assert db.find_experiments({'metadata':{'id':'1234'}})==[], 'Found a nonexistent experiment'
+    assert db.find_experiments_between({}, '2016-02', '2016-03-01')==xids[1:3], 'Wrong experiments found by time'
+    assert db.find_recent_experiments({}, 2)==[xids[2],xids[1]], 'Wrong recent experiments found'
+    assert db.find_recent_experiments({'metadata':{'tags':['x']}}, 5)==[xids[2],xids[0]], 'Wrong recent experiments found by tag'
+    assert db.delete_experiment(xids[0]), 'Delete failed'
+    assert db.find_experiments({})==xids[1:3], 'Deleted experiment still found'
+
+@set_config(storage='sqlite', project_name='test_project')
+def test_bundles():
+  with ProjectDB() as db:
+    x = db.create_experiment_id('x')
+    bundles = [{'metadata':{'id':'b'+str(i), 'bundle_type':'even' if i%2==0 else 'odd', 'cache_key':'k'+str(i)}, 'data':{'i':i}, 'files':[]} for i in range(4)]
+    assert db.write_bundles(bundles[0:3], x)==['b0','b1','b2'], 'Wrong bundle ids returned'
+    assert db.write_bundle(bundles[3], x)=='b3', 'Wrong bundle id returned'
+    found = db.find_bundle_metadata({'metadata':{'bundle_type':'even'}}, x)
+    assert sorted([b['metadata']['id'] for b in found])==['b0','b2'], 'Wrong bundles found by type'
+    assert 'data' not in found[0], 'Bundle contents read for a metadata search'
+    assert db.find_bundles({'metadata':{'cache_key':'k3'}}, x)==[bundles[3]], 'Bundle corrupted'
+    assert db.find_bundles({'data':{'i':1}}, x)==[bundles[1]], 'Wrong bundles found by data'
+    assert sorted([b['metadata']['id'] for b in db.read_bundles(['b1','b3','nope'], x)])==['b1','b3'], 'Wrong bundles read'
+    db.delete_experiment(x)
+    assert db._conn.execute('SELECT COUNT(*) FROM "bundles"').fetchone()[0]==0, 'Bundles not deleted'
@@ -8,10 +8,10 @@ STORAGE_SERVER=os.getenv('PROTOS_STORAGE_SERVER', '127.0.0.1')
 @set_config(storage='postgres', storage_server=STORAGE_SERVER, project_name='default')
 def populate_test_db():
   pg = protos.storage_adapters.postgres.Postgres()
-  pg._set_role_rw()
-  with protos.storage_adapters.postgres.Transaction(pg._conn) as x:
+  with pg._connection() as conn, protos.storage_adapters.postgres.Transaction(conn) as x:
     x.execute('DROP TABLE "default_bundles"')
     x.execute('DROP TABLE "default"')
+  pg._pool.initialized.discard('default')
   pg = protos.storage_adapters.postgres.Postgres()
 
   ids = range(1,5)
@@ -1,7 +1,7 @@
 import logging
 import os
 import os.path
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Common timestamp format.
 # We use timestamps all over protos, and it's too easy to use different
@@ -11,8 +11,9 @@ from datetime import datetime
 #   microsecond-resolution
 #   relative to year 0 AD
 #   24-hour
-def timestamp():
-  return datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S-%f_UTC')
+# An offset (in seconds) gives a time in the future instead of now.
+def timestamp(offset=0):
+  return (datetime.utcnow()+timedelta(seconds=offset)).strftime('%Y-%m-%d_%H-%M-%S-%f_UTC')
 
 # If a computer needs to understand a timestamp, turn it into a datetime object.
 # Note that timezone is not explicit in this object. Assume UTC.